@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
+from datetime import timedelta
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -176,9 +177,71 @@ REST_FRAMEWORK = {
 
 }
 
+# Загрузка прайс-листов: каталог для временных файлов (None - системный)
+# и таймаут запроса к серверу поставщика в секундах. Загруженные файлы
+# разбирает воркер celery, поэтому каталог должен быть ему доступен
+FEED_SPOOL_DIR = None
+FEED_FETCH_TIMEOUT = 60
+
+# Плановые загрузки: не больше IMPORT_MAX_CONCURRENCY одновременно,
+# загрузка дольше IMPORT_JOB_TIMEOUT считается зависшей
+IMPORT_MAX_CONCURRENCY = 4
+IMPORT_JOB_TIMEOUT = timedelta(hours=2)
+
+# Время хранения ответов на запросы с заголовком Idempotency-Key.
+# Ключ запроса без ответа дольше IDEMPOTENCY_KEY_LEASE (процесс убит
+# или оборвался по таймауту) может занять повтор, поэтому аренда должна
+# быть дольше таймаута запроса
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+IDEMPOTENCY_KEY_LEASE = timedelta(minutes=2)
+
+# Время жизни словарей имен параметров и категорий в памяти процесса, с
+NAME_CACHE_TIMEOUT = 300
+
+# Наибольшее число процессов разбора в параллельном режиме загрузки
+IMPORT_MAX_WORKERS = os.cpu_count() or 1
+
+# Кэш ответов каталога и счетчики их версий. При запуске с воркером
+# celery кэш должен быть общим для веб-процессов и воркера: загрузки
+# прайс-листов увеличивают версии в воркере, а ETag и ответы читаются
+# в веб-процессах. Переменная окружения CACHE_DIR включает файловый кэш
+# в этом каталоге, в продакшене здесь указывается Redis или memcached.
+# Без нее кэш хранится в памяти процесса
+CACHE_DIR = os.environ.get('CACHE_DIR')
+if CACHE_DIR:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': CACHE_DIR,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+CATALOG_CACHE_TIMEOUT = 600
+
+# Конфигурация полнотекстового поиска PostgreSQL
+SEARCH_CONFIG = 'russian'
+
 BROKER_URL = 'redis://localhost:6379'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379'
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Africa/Nairobi'
+CELERY_ROUTES = {
+    'orders.tasks.load_info_task': {'queue': 'imports'},
+}
+CELERYBEAT_SCHEDULE = {
+    'schedule-imports': {
+        'task': 'orders.tasks.schedule_imports_task',
+        'schedule': timedelta(minutes=1),
+    },
+    'cleanup-idempotency-keys': {
+        'task': 'orders.tasks.cleanup_idempotency_keys_task',
+        'schedule': timedelta(hours=1),
+    },
+}
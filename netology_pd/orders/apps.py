@@ -1,8 +1,10 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class OrdersConfig(AppConfig):
     name = 'orders'
 
     def ready(self):
-        pass
\ No newline at end of file
+        from .search import create_search_indexes
+        post_migrate.connect(create_search_indexes, sender=self)
\ No newline at end of file
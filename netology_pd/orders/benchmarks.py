@@ -0,0 +1,298 @@
+import csv
+import io
+import json
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import DatabaseError, connection, connections
+from django.db.models import Sum
+from django.utils import timezone
+
+from .feeds import CSV_COLUMNS, FeedError, iter_feed, msgpack
+from .importers import import_feed
+from .models import (Category, Contact, Order, OrderItem, Product,
+                     ProductInfo, Shop, StockReservation, User)
+from .offers import refresh_offers
+from .stock import StockError, checkout_order
+
+COLORS = ('белый', 'черный', 'красный', 'синий', 'золотистый', 'серый')
+
+
+def generate_goods(goods, categories, parameters, seed=0):
+    """
+    Синтетические товары в схеме прайс-листа магазина
+    """
+    rnd = random.Random(seed)
+    for number in range(1, goods + 1):
+        price = rnd.randint(100, 200000)
+        yield {
+            'id': number,
+            'category': rnd.randint(1, categories),
+            'model': 'model/{}'.format(number % 1000),
+            'name': f'Товар {number}',
+            'price': price,
+            'price_rrc': price + rnd.randint(0, 1000),
+            'quantity': rnd.randint(0, 100),
+            'parameters': {
+                f'Параметр {index}': rnd.choice(COLORS) if index % 2
+                else rnd.randint(1, 512)
+                for index in range(parameters)
+            },
+        }
+
+
+def write_feed(stream, goods, categories=10, parameters=4, feed_format='yaml',
+               shop='Benchmark', seed=0):
+    """
+    Запись синтетического прайс-листа в двоичный поток
+
+    Поддерживаются все форматы загрузки: yaml, jsonl, csv и msgpack.
+    Товары формируются и пишутся по одному, поэтому размер прайс-листа
+    не ограничен памятью.
+    """
+    category_list = [{'id': number, 'name': f'Категория {number}'}
+                     for number in range(1, categories + 1)]
+    items = generate_goods(goods, categories, parameters, seed=seed)
+
+    if feed_format == 'msgpack':
+        if msgpack is None:
+            raise FeedError('Для записи прайс-листов MessagePack '
+                            'необходим пакет msgpack')
+        packer = msgpack.Packer()
+        stream.write(packer.pack({'shop': shop,
+                                  'categories': category_list}))
+        for item in items:
+            stream.write(packer.pack(item))
+        return
+
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    try:
+        if feed_format == 'jsonl':
+            _write_jsonl_feed(text, shop, category_list, items)
+        elif feed_format == 'csv':
+            _write_csv_feed(text, shop, category_list, items)
+        elif feed_format == 'yaml':
+            _write_yaml_feed(text, shop, category_list, items)
+        else:
+            raise FeedError(f'Неизвестный формат прайс-листа: {feed_format}')
+    finally:
+        # поток остается открытым у вызывающего кода
+        text.flush()
+        text.detach()
+
+
+def _write_jsonl_feed(stream, shop, category_list, items):
+    stream.write(json.dumps({'shop': shop, 'categories': category_list},
+                            ensure_ascii=False) + '\n')
+    for item in items:
+        stream.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+
+def _write_csv_feed(stream, shop, category_list, items):
+    names = {category['id']: category['name'] for category in category_list}
+    writer = csv.writer(stream)
+    writer.writerow(CSV_COLUMNS)
+    for item in items:
+        row = dict(item, shop=shop, category_name=names[item['category']],
+                   parameters=json.dumps(item['parameters'],
+                                         ensure_ascii=False))
+        writer.writerow([row[column] for column in CSV_COLUMNS])
+
+
+def _write_yaml_feed(stream, shop, category_list, items):
+    def quote(value):
+        return json.dumps(value, ensure_ascii=False)
+
+    stream.write(f'shop: {quote(shop)}\ncategories:\n')
+    for category in category_list:
+        stream.write('  - id: {id}\n    name: {name}\n'.format(
+            id=category['id'], name=quote(category['name'])))
+    stream.write('goods:\n')
+    for item in items:
+        stream.write(
+            '  - id: {id}\n    category: {category}\n    model: {model}\n'
+            '    name: {name}\n    price: {price}\n'
+            '    price_rrc: {price_rrc}\n    quantity: {quantity}\n'
+            '    parameters:\n'.format(
+                id=item['id'], category=item['category'],
+                model=quote(item['model']), name=quote(item['name']),
+                price=item['price'], price_rrc=item['price_rrc'],
+                quantity=item['quantity'])
+        )
+        for name, value in item['parameters'].items():
+            stream.write(f'      {quote(name)}: {quote(value)}\n')
+
+
+def measure_import(path, feed_format, user_id, **options):
+    """
+    Загрузка прайс-листа с замером скорости, числа запросов и памяти
+
+    Память считается tracemalloc только на время этой загрузки, поэтому
+    замеры нескольких размеров в одном процессе не влияют друг на
+    друга. Память дочерних процессов разбора в замер не входит.
+    """
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_queries), \
+                open(path, 'rb') as stream:
+            records = iter_feed(stream, feed_format,
+                                raw=options.get('workers', 0) > 1)
+            importer = import_feed(records, user_id, **options)
+        seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'vendor': connection.vendor,
+        'rows': importer.rows_parsed,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(importer.rows_parsed / seconds, 1),
+        'queries': queries,
+        'peak_memory_mb': round(peak / 2 ** 20, 1),
+        'timings': {stage: round(seconds, 3)
+                    for stage, seconds in importer.timings.items()},
+    }
+
+
+def create_checkouts(buyers, products, stock, items, seed=0):
+    """
+    Магазин с products товарами по stock штук и корзины buyers
+    покупателей по items случайных товаров в каждой
+
+    Возвращает список (id корзины, id пользователя, id контакта).
+    """
+    rnd = random.Random(seed)
+    shop_user = User.objects.create_user(email='checkout-shop@example.com',
+                                         type='shop', is_active=True)
+    shop = Shop.objects.create(name='Checkout benchmark', user=shop_user)
+    category = Category.objects.create(name='Checkout benchmark')
+    ProductInfo.objects.bulk_create([
+        ProductInfo(product=Product.objects.create(
+            name=f'Товар {number}', category=category),
+            shop=shop, external_id=number, model='', quantity=stock,
+            price=100, price_rrc=100)
+        for number in range(1, products + 1)
+    ])
+    product_infos = list(ProductInfo.objects.filter(
+        shop=shop).values_list('id', flat=True))
+    refresh_offers(product_infos)
+
+    checkouts = []
+    for number in range(buyers):
+        user = User.objects.create_user(
+            email=f'checkout-{number}@example.com', is_active=True)
+        contact = Contact.objects.create(user=user, city='Москва',
+                                         street='Тверская', phone='+7000')
+        order = Order.objects.create(user=user, state='basket')
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_info_id=product_info_id,
+                      quantity=rnd.randint(1, 3), price=100)
+            for product_info_id in rnd.sample(product_infos,
+                                              min(items, products))
+        ])
+        checkouts.append((order.id, user.id, contact.id))
+    return checkouts
+
+
+def measure_checkout(checkouts, threads):
+    """
+    Параллельное оформление корзин с замером скорости и конфликтов
+
+    Каждый поток работает со своим соединением. Результат: число
+    оформленных заказов, отказов из-за остатков и ошибок базы
+    (таймауты блокировок, занятая база SQLite), задержки оформления и
+    проверка, что проданное количество совпадает со списанным.
+    """
+    initial = ProductInfo.objects.aggregate(total=Sum('quantity'))['total']
+
+    def run(checkout):
+        started = time.perf_counter()
+        try:
+            checkout_order(*checkout)
+            outcome = 'placed'
+        except StockError:
+            outcome = 'sold_out'
+        except DatabaseError:
+            outcome = 'failed'
+        finally:
+            connections.close_all()
+        return outcome, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        outcomes = list(executor.map(run, checkouts))
+    seconds = time.perf_counter() - started
+
+    latencies = sorted(latency for _, latency in outcomes)
+    counts = {name: sum(1 for outcome, _ in outcomes if outcome == name)
+              for name in ('placed', 'sold_out', 'failed')}
+    remaining = ProductInfo.objects.aggregate(
+        total=Sum('quantity'))['total']
+    reserved = StockReservation.objects.aggregate(
+        total=Sum('quantity'))['total'] or 0
+    return dict(
+        counts,
+        vendor=connection.vendor,
+        checkouts=len(checkouts),
+        threads=threads,
+        seconds=round(seconds, 3),
+        checkouts_per_sec=round(len(checkouts) / seconds, 1),
+        p50_ms=round(statistics.median(latencies) * 1000, 1),
+        p95_ms=round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        oversold=remaining < 0 or initial - remaining != reserved,
+    )
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def record_result(path, result, threshold=0.1):
+    """
+    Сохранение результата и сравнение с прошлым замером
+
+    Возвращает предыдущий результат с той же СУБД, форматом, режимом,
+    числом процессов и размером прайс-листа, если скорость загрузки
+    упала больше чем на threshold, иначе None.
+    """
+    result = dict(result, commit=current_commit(),
+                  date=timezone.now().isoformat())
+    previous = None
+    try:
+        with open(path) as stream:
+            for line in stream:
+                record = json.loads(line)
+                if all(record.get(key, 0) == result.get(key, 0)
+                       for key in ('vendor', 'rows', 'format', 'mode',
+                                   'workers')):
+                    previous = record
+    except FileNotFoundError:
+        pass
+
+    with open(path, 'a') as stream:
+        stream.write(json.dumps(result) + '\n')
+
+    if previous and result['rows_per_sec'] < (
+            previous['rows_per_sec'] * (1 - threshold)):
+        return previous
+    return None
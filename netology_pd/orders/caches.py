@@ -0,0 +1,257 @@
+import hashlib
+import time
+import uuid
+
+from rest_framework.response import Response
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from .models import Category, Parameter
+
+
+class NameCache:
+    """
+    Словарь имя -> id справочной таблицы в памяти процесса
+
+    Словарь целиком читается из таблицы при первом обращении вне
+    транзакции и перечитывается раз в NAME_CACHE_TIMEOUT секунд,
+    промахи догружаются одним запросом на пачку имен. Строки,
+    прочитанные внутри транзакции, попадают в словарь только после ее
+    фиксации, чтобы откат загрузки не оставил в кэше несуществующих id.
+    """
+
+    def __init__(self, model, field='name'):
+        self.model = model
+        self.field = field
+        self.ids = {}
+        self.names = {}
+        self.loaded_at = None
+
+    def warm(self):
+        rows = self.model.objects.order_by().values_list('id', self.field)
+        self.names = dict(rows)
+        self.ids = {name: pk for pk, name in self.names.items()}
+        self.loaded_at = time.monotonic()
+
+    def clear(self):
+        self.ids = {}
+        self.names = {}
+        self.loaded_at = None
+
+    def check(self):
+        """
+        Перечитывание устаревшего словаря, если нет открытой транзакции
+        """
+        if connection.in_atomic_block:
+            return
+        if (self.loaded_at is None or time.monotonic() - self.loaded_at >
+                settings.NAME_CACHE_TIMEOUT):
+            self.warm()
+
+    def store(self, rows):
+        for pk, name in rows:
+            self.names[pk] = name
+            self.ids[name] = pk
+
+    def remember(self, rows):
+        """
+        Добавление пар (id, имя) в словарь после фиксации транзакции
+        """
+        rows = list(rows)
+        transaction.on_commit(lambda: self.store(rows))
+
+    def _fetch(self, **lookup):
+        rows = list(self.model.objects.filter(**lookup).order_by(
+        ).values_list('id', self.field))
+        self.remember(rows)
+        return rows
+
+    def get_ids(self, names, create=False):
+        """
+        Словарь имя -> id для переданных имен
+
+        С create=True отсутствующие в таблице записи создаются, при
+        одновременной вставке тех же имен выручает уникальный индекс.
+        """
+        self.check()
+        found = {name: self.ids[name] for name in names if name in self.ids}
+        missing = set(names).difference(found)
+        if missing:
+            found.update({name: pk for pk, name in self._fetch(
+                **{f'{self.field}__in': missing})})
+            missing.difference_update(found)
+        if missing and create:
+            self.model.objects.bulk_create(
+                [self.model(**{self.field: name}) for name in missing],
+                ignore_conflicts=True
+            )
+            found.update({name: pk for pk, name in self._fetch(
+                **{f'{self.field}__in': missing})})
+        return found
+
+    def get_names(self, pks):
+        """
+        Словарь id -> имя для переданных id, отсутствующие пропускаются
+        """
+        self.check()
+        found = {pk: self.names[pk] for pk in pks if pk in self.names}
+        missing = set(pks).difference(found)
+        if missing:
+            found.update(self._fetch(id__in=missing))
+        return found
+
+    def get_name(self, pk):
+        return self.get_names([pk]).get(pk)
+
+
+parameter_cache = NameCache(Parameter)
+
+category_cache = NameCache(Category)
+
+
+def version_key(scope, pk=None):
+    if pk is None:
+        return f'catalog:version:{scope}'
+    return f'catalog:version:{scope}:{pk}'
+
+
+def new_version():
+    return uuid.uuid4().hex
+
+
+def get_versions(keys):
+    """
+    Текущие значения версий каталога
+
+    Отсутствующая или вытесненная из кэша версия заводится заново со
+    случайным значением, чтобы не совпасть со старой.
+    """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, new_version(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_versions(keys):
+    """
+    Смена версий после фиксации транзакции
+
+    Каждая смена записывает новое случайное значение, а не увеличивает
+    счетчик: incr файлового и табличного кэша - чтение и запись, и две
+    параллельные смены дали бы одно и то же значение.
+    """
+    def bump():
+        cache.set_many({key: new_version() for key in keys}, None)
+
+    transaction.on_commit(bump)
+
+
+def bump_catalog(shop_ids=(), category_ids=(), lists=True):
+    """
+    Сброс кэша ответов каталога для изменившихся магазинов и категорий
+
+    lists=False - изменились только остатки предложений, списки
+    магазинов и категорий не сбрасываются. Список товаров без фильтров
+    показывает остатки, поэтому сбрасывается всегда.
+    """
+    keys = [version_key('products')]
+    if lists:
+        keys += [version_key('shops'), version_key('categories')]
+    keys += [version_key('shop', pk) for pk in set(shop_ids)]
+    keys += [version_key('category', pk) for pk in set(category_ids)
+             if pk is not None]
+    bump_versions(keys)
+
+
+def count_cache(result):
+    key = f'catalog:stats:{result}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+def cache_stats():
+    stats = cache.get_many(['catalog:stats:hit', 'catalog:stats:miss'])
+    return {'hits': stats.get('catalog:stats:hit', 0),
+            'misses': stats.get('catalog:stats:miss', 0)}
+
+
+def reset_cache_stats():
+    cache.delete_many(['catalog:stats:hit', 'catalog:stats:miss'])
+
+
+def catalog_digest(request, scopes, *extra):
+    """
+    Хэш пути, строки запроса и версий областей каталога
+    """
+    keys = [version_key(*scope) for scope in scopes]
+    versions = get_versions(keys)
+    return hashlib.md5('|'.join(
+        [request.path, request.GET.urlencode()] + list(extra) +
+        [f'{key}={version}' for key, version in zip(keys, versions)]
+    ).encode()).hexdigest()
+
+
+def catalog_etag(scopes):
+    """
+    Функция etag_func для декоратора django condition
+
+    ETag считается по счетчикам версий каталога, а не по телу ответа,
+    поэтому ответ 304 отдается без обращения к сериализаторам. scopes -
+    список областей или функция, получающая их по аргументам запроса,
+    None означает ответ без ETag.
+    """
+    def etag(request, *args, **kwargs):
+        request_scopes = scopes
+        if callable(scopes):
+            request_scopes = scopes(request, *args, **kwargs)
+        if request_scopes is None:
+            return None
+        # браузерное представление API и JSON - разные ответы
+        return catalog_digest(request, request_scopes,
+                              request.META.get('HTTP_ACCEPT', ''))
+    return etag
+
+
+def cached_response(request, scopes, build):
+    """
+    Ответ каталога из кэша или построенный функцией build
+
+    Ключ собирается из пути, строки запроса и версий перечисленных
+    областей каталога (scope, id), поэтому после загрузки прайс-листа
+    или смены статуса магазина устаревшие ответы просто перестают
+    запрашиваться. Кэшируются только успешные ответы DRF.
+    """
+    key = 'catalog:response:' + catalog_digest(request, scopes)
+
+    data = cache.get(key)
+    if data is not None:
+        count_cache('hit')
+        response = Response(data)
+        response['X-Cache'] = 'HIT'
+        return response
+
+    count_cache('miss')
+    response = build()
+    if response.status_code == 200 and hasattr(response, 'data'):
+        cache.set(key, response.data, settings.CATALOG_CACHE_TIMEOUT)
+    response['X-Cache'] = 'MISS'
+    return response
+
+
+class CachedListMixin:
+    """
+    Кэширование списка ReadOnlyModelViewSet по версиям cache_scopes
+    """
+    cache_scopes = ()
+
+    def list(self, request, *args, **kwargs):
+        build = super().list
+        return cached_response(request, self.cache_scopes,
+                               lambda: build(request, *args, **kwargs))
@@ -0,0 +1,194 @@
+import json
+
+from django.db.models import F
+
+from .models import Order, OrderItem, ProductInfo, STATE_CHOICES
+
+CART_STATE = STATE_CHOICES[0][0]
+
+
+class CartError(Exception):
+    """Некорректное тело запроса изменения корзины"""
+
+
+def parse_list(value):
+    """
+    Список из тела запроса: массив JSON или строка с ним
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise CartError('Неверный формат запроса: ожидается массив JSON')
+    if not isinstance(value, list):
+        raise CartError('Неверный формат запроса: ожидается массив JSON')
+    return value
+
+
+def parse_items(value, key):
+    """
+    Позиции корзины вида {key: id, "quantity": количество}
+    """
+    items = parse_list(value)
+    for index, item in enumerate(items):
+        if (not isinstance(item, dict) or
+                not is_positive_int(item.get(key)) or
+                not is_positive_int(item.get('quantity'))):
+            raise CartError(f'Позиция {index}: поля {key} и quantity '
+                            f'должны быть положительными числами')
+    return items
+
+
+def parse_ids(value):
+    """
+    id позиций корзины: массив JSON или строка с id через запятую
+    """
+    if isinstance(value, str) and not value.lstrip().startswith('['):
+        value = [item.strip() for item in value.split(',') if item.strip()]
+    ids = []
+    for item in parse_list(value):
+        try:
+            ids.append(int(item))
+        except (TypeError, ValueError):
+            raise CartError(f'Некорректный id позиции корзины: {item}')
+    return ids
+
+
+def is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def stock_error(product_info):
+    return ('У магазина {} недостаточное количество товара {} для '
+            'добавления в корзину.Всего в магазине {} штук, доступных '
+            'для добавления в корзину'.format(product_info.shop.name,
+                                              product_info.product.name,
+                                              product_info.quantity))
+
+
+def change_totals(order_id, total_sum, items_count):
+    """
+    Изменение суммы и числа позиций заказа на переданные величины
+
+    Обновление выражениями F() не теряет изменения параллельных
+    запросов к той же корзине.
+    """
+    if total_sum or items_count:
+        Order.objects.filter(id=order_id).update(
+            total_sum=F('total_sum') + total_sum,
+            items_count=F('items_count') + items_count
+        )
+
+
+def add_items(cart, items):
+    """
+    Добавление позиций в корзину
+
+    Информация о продуктах читается одним запросом, проверки идут
+    в памяти, позиции создаются одним bulk_create. При ошибке хотя бы
+    в одной позиции корзина не меняется, возвращается список ошибок.
+    """
+    ids = {item['product_info'] for item in items}
+    product_infos = ProductInfo.objects.select_related(
+        'shop', 'product').in_bulk(ids)
+    in_cart = set(OrderItem.objects.filter(
+        order=cart, product_info_id__in=ids
+    ).values_list('product_info_id', flat=True))
+
+    errors = []
+    to_create = []
+    for index, item in enumerate(items):
+        product_info = product_infos.get(item['product_info'])
+        if product_info is None:
+            error = 'Информация о товаре отсутствует'
+        elif product_info.id in in_cart:
+            error = ('В корзину уже добавлен товар с информацией по id {}. '
+                     'Если хотите изменить информацию по данному id '
+                     'используйте метод PUT'.format(product_info.id))
+        elif product_info.quantity < item['quantity']:
+            error = stock_error(product_info)
+        elif not product_info.shop.state:
+            error = 'Магазин {} не принимает заказы в данный момент'.format(
+                product_info.shop.name)
+        else:
+            in_cart.add(product_info.id)
+            to_create.append(OrderItem(order=cart,
+                                       product_info=product_info,
+                                       quantity=item['quantity'],
+                                       price=product_info.price))
+            continue
+        errors.append({'index': index, 'Error': error})
+
+    if not errors:
+        OrderItem.objects.bulk_create(to_create)
+        change_totals(cart.id,
+                      sum(item.quantity * item.price for item in to_create),
+                      len(to_create))
+    return errors
+
+
+def update_items(user, items):
+    """
+    Изменение количества товаров в позициях корзины пользователя
+
+    Цена позиции обновляется до текущей цены магазина.
+    """
+    order_items = OrderItem.objects.select_related(
+        'order', 'product_info__shop', 'product_info__product'
+    ).in_bulk({item['id'] for item in items})
+
+    errors = []
+    to_update = []
+    total_sum = 0
+    for index, item in enumerate(items):
+        order_item = order_items.get(item['id'])
+        if order_item is None:
+            error = 'Информация о товаре отсутствует'
+        elif (order_item.order.user_id != user.id or
+              order_item.order.state != CART_STATE):
+            error = 'Нельзя вносить изменения не в свою корзину'
+        elif order_item.product_info.quantity < item['quantity']:
+            error = stock_error(order_item.product_info)
+        else:
+            total_sum -= order_item.quantity * order_item.price
+            order_item.quantity = item['quantity']
+            order_item.price = order_item.product_info.price
+            total_sum += order_item.quantity * order_item.price
+            to_update.append(order_item)
+            continue
+        errors.append({'index': index, 'Error': error})
+
+    if not errors and to_update:
+        OrderItem.objects.bulk_update(to_update, ['quantity', 'price'])
+        change_totals(to_update[0].order_id, total_sum, 0)
+    return errors
+
+
+def delete_items(user, ids):
+    """
+    Удаление позиций корзины пользователя одним запросом
+    """
+    rows = OrderItem.objects.filter(id__in=ids).values_list(
+        'id', 'order__user_id', 'order__state', 'order_id', 'quantity',
+        'price')
+    owners = {}
+    totals = {}
+    for pk, user_id, state, order_id, quantity, price in rows:
+        owners[pk] = (user_id, state)
+        totals[pk] = quantity * price
+
+    errors = []
+    for index, pk in enumerate(ids):
+        if pk not in owners:
+            errors.append({'index': index,
+                           'Error': 'Информация о товаре отсутствует'})
+        elif owners[pk] != (user.id, CART_STATE):
+            errors.append({'index': index,
+                           'Error': 'Нельзя вносить изменения '
+                                    'не в свою корзину'})
+
+    if not errors and totals:
+        # все позиции лежат в единственной корзине пользователя
+        OrderItem.objects.filter(id__in=ids).delete()
+        change_totals(order_id, -sum(totals.values()), -len(totals))
+    return errors
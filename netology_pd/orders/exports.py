@@ -0,0 +1,115 @@
+import csv
+import io
+import json
+import zlib
+
+from .models import CatalogOffer
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', '.ndjson'),
+    'csv': ('text/csv', '.csv'),
+}
+
+EXPORT_FIELDS = ('id', 'external_id', 'product', 'product_name', 'category',
+                 'category_name', 'shop', 'shop_name', 'model', 'quantity',
+                 'price', 'price_rrc', 'parameters')
+
+# строк каталога, читаемых с сервера за один запрос курсора
+EXPORT_CHUNK_SIZE = 2000
+
+# размер куска ответа, меньшие строки склеиваются до него
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+
+def export_rows(shop_id=None, category_id=None):
+    """
+    Предложения магазинов, принимающих заказы, в порядке id
+
+    Строки читаются через iterator(), в PostgreSQL это серверный
+    курсор, поэтому память не зависит от размера каталога.
+    """
+    offers = CatalogOffer.objects.filter(shop_state=True)
+    if shop_id:
+        offers = offers.filter(shop_id=shop_id)
+    if category_id:
+        offers = offers.filter(category_id=category_id)
+    return offers.order_by('product_info').values_list(
+        'product_info', *EXPORT_FIELDS[1:]
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def iter_ndjson(rows):
+    """
+    Строки каталога в формате NDJSON, параметры - объектом
+    """
+    for row in rows:
+        offer = dict(zip(EXPORT_FIELDS, row))
+        offer['parameters'] = dict(json.loads(offer['parameters']))
+        yield json.dumps(offer, ensure_ascii=False).encode() + b'\n'
+
+
+class Echo:
+    """
+    Файлоподобный объект, возвращающий записанную строку
+    """
+
+    @staticmethod
+    def write(value):
+        return value
+
+
+def iter_csv(rows):
+    """
+    Строки каталога в формате CSV, параметры - строкой JSON
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS).encode()
+    for row in rows:
+        yield writer.writerow(row).encode()
+
+
+def buffered(chunks, size=EXPORT_BUFFER_SIZE):
+    """
+    Склеивание мелких кусков в куски не меньше size байт
+
+    Первый кусок отдается сразу, чтобы клиент получил начало ответа
+    без ожидания целого буфера.
+    """
+    buffer = io.BytesIO()
+    first = True
+    for chunk in chunks:
+        buffer.write(chunk)
+        if first or buffer.tell() >= size:
+            yield buffer.getvalue()
+            buffer = io.BytesIO()
+            first = False
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzipped(chunks):
+    """
+    Потоковое сжатие кусков в формат gzip
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_catalog(export_format='ndjson', compress=False, shop_id=None,
+                   category_id=None):
+    """
+    Поток байтов выгрузки каталога в формате ndjson или csv
+    """
+    rows = export_rows(shop_id=shop_id, category_id=category_id)
+    if export_format == 'csv':
+        chunks = iter_csv(rows)
+    else:
+        chunks = iter_ndjson(rows)
+    chunks = buffered(chunks)
+    if compress:
+        chunks = gzipped(chunks)
+    return chunks
@@ -0,0 +1,177 @@
+import re
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count
+
+from .caches import parameter_cache
+from .models import Category, FacetCount, ProductInfo, ProductParameter
+
+PARAM_RE = re.compile(r'^param\[(.+)\]$')
+
+
+def parameter_filters(query_params):
+    """
+    Фильтры вида param[Цвет]=красный из строки запроса
+
+    Возвращает словарь имя параметра -> список допустимых значений,
+    повтор параметра в строке запроса означает "любое из значений".
+    """
+    filters = {}
+    for key in query_params:
+        match = PARAM_RE.match(key)
+        if match:
+            values = [value for value in query_params.getlist(key) if value]
+            if values:
+                filters[match.group(1)] = values
+    return filters
+
+
+def filter_by_parameters(queryset, filters):
+    """
+    Отбор информации о продуктах или строк каталога по значениям
+    параметров
+
+    Условия по разным параметрам объединяются через И.
+    """
+    if not filters:
+        return queryset
+    ids = parameter_cache.get_ids(list(filters))
+    if len(ids) < len(filters):
+        return queryset.none()
+    for name, values in filters.items():
+        queryset = queryset.filter(
+            pk__in=ProductParameter.objects.filter(
+                parameter_id=ids[name], value__in=values
+            ).values('product_info_id')
+        )
+    return queryset
+
+
+def lock_categories(category_ids):
+    """
+    Блокировка строк категорий в порядке id
+
+    Счетчики категории меняет только держатель блокировки, поэтому
+    параллельные загрузки и смена статуса магазина не вставляют одну
+    строку счетчика дважды.
+    """
+    list(Category.objects.select_for_update().filter(
+        id__in=category_ids).order_by('id').values_list('id', flat=True))
+
+
+def facet_counts(**lookup):
+    """
+    Число строк параметров по ключам (категория, параметр, значение)
+
+    lookup - условие отбора строк ProductParameter, например только
+    удаляемых информаций о продуктах или одного магазина.
+    """
+    rows = ProductParameter.objects.filter(**lookup).order_by().values(
+        'product_info__product__category_id', 'parameter_id', 'value'
+    ).annotate(count=Count('id')).values_list(
+        'product_info__product__category_id', 'parameter_id', 'value',
+        'count'
+    )
+    return Counter({(category_id, parameter_id, value): count
+                    for category_id, parameter_id, value, count in rows
+                    if category_id is not None})
+
+
+def apply_facet_deltas(deltas):
+    """
+    Изменение счетчиков значений параметров на величины deltas
+
+    deltas - словарь (категория, параметр, значение) -> изменение,
+    собранный из добавленных, измененных и удаленных строк параметров.
+    Категории блокируются, счетчики читаются одним запросом и
+    записываются пачками, обнулившиеся строки удаляются.
+    """
+    deltas = {key: delta for key, delta in deltas.items()
+              if delta and key[0] is not None}
+    if not deltas:
+        return
+    categories = {category_id for category_id, _, _ in deltas}
+    with transaction.atomic(savepoint=False):
+        lock_categories(categories)
+        existing = {
+            (row.category_id, row.parameter_id, row.value): row
+            for row in FacetCount.objects.filter(
+                category_id__in=categories,
+                parameter_id__in={parameter_id for _, parameter_id, _
+                                  in deltas},
+                value__in={value for _, _, value in deltas}
+            )
+        }
+        to_create = []
+        to_update = []
+        to_delete = []
+        for key, delta in deltas.items():
+            row = existing.get(key)
+            if row is None:
+                if delta > 0:
+                    to_create.append(FacetCount(
+                        category_id=key[0], parameter_id=key[1],
+                        value=key[2], count=delta))
+            elif row.count + delta > 0:
+                row.count += delta
+                to_update.append(row)
+            else:
+                to_delete.append(row.id)
+        FacetCount.objects.bulk_create(to_create)
+        FacetCount.objects.bulk_update(to_update, ['count'])
+        if to_delete:
+            FacetCount.objects.filter(id__in=to_delete).delete()
+
+
+def refresh_facets(category_ids):
+    """
+    Полный пересчет счетчиков значений параметров указанных категорий
+
+    Загрузка прайс-листа и смена статуса магазина меняют счетчики на
+    разницу через apply_facet_deltas, полный пересчет нужен для
+    первичного заполнения.
+    """
+    category_ids = [pk for pk in set(category_ids) if pk is not None]
+    if not category_ids:
+        return
+    with transaction.atomic(savepoint=False):
+        lock_categories(category_ids)
+        _refresh_facets(category_ids)
+
+
+def _refresh_facets(category_ids):
+    FacetCount.objects.filter(category_id__in=category_ids).delete()
+    counts = ProductParameter.objects.filter(
+        product_info__product__category_id__in=category_ids,
+        product_info__shop__state=True
+    ).order_by().values(
+        'product_info__product__category_id', 'parameter_id', 'value'
+    ).annotate(count=Count('id'))
+    FacetCount.objects.bulk_create([
+        FacetCount(category_id=row['product_info__product__category_id'],
+                   parameter_id=row['parameter_id'], value=row['value'],
+                   count=row['count'])
+        for row in counts
+    ])
+
+
+def shop_categories(shop_id):
+    return ProductInfo.objects.filter(shop_id=shop_id).order_by().values_list(
+        'product__category_id', flat=True).distinct()
+
+
+def category_facets(category_id):
+    """
+    Фасеты категории: параметры со значениями и числом предложений
+    """
+    facets = {}
+    rows = FacetCount.objects.filter(category_id=category_id).order_by(
+        'parameter_id', 'value').values_list('parameter_id', 'value', 'count')
+    for parameter_id, value, count in rows:
+        facets.setdefault(parameter_id, []).append(
+            {'value': value, 'count': count}
+        )
+    names = parameter_cache.get_names(list(facets))
+    return [{'parameter': names.get(parameter_id), 'values': values}
+            for parameter_id, values in facets.items()]
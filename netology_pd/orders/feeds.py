@@ -0,0 +1,258 @@
+import csv
+import io
+import json
+import os
+
+from yaml import (AliasEvent, MappingEndEvent, MappingStartEvent, ScalarEvent,
+                  ScalarNode, SequenceEndEvent, SequenceStartEvent,
+                  StreamEndEvent)
+
+try:
+    from yaml import CSafeLoader as FeedLoader
+except ImportError:
+    from yaml import SafeLoader as FeedLoader
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FEED_FORMATS = {
+    'yaml': ('.yaml', '.yml'),
+    'jsonl': ('.jsonl', '.ndjson'),
+    'msgpack': ('.msgpack', '.mpk'),
+    'csv': ('.csv',),
+}
+
+FEED_CONTENT_TYPES = {
+    'application/x-ndjson': 'jsonl',
+    'application/jsonl': 'jsonl',
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+    'application/vnd.msgpack': 'msgpack',
+    'text/csv': 'csv',
+    'application/x-yaml': 'yaml',
+    'application/yaml': 'yaml',
+    'text/yaml': 'yaml',
+}
+
+CSV_COLUMNS = ('shop', 'category', 'category_name', 'id', 'model', 'name',
+               'price', 'price_rrc', 'quantity', 'parameters')
+
+CSV_INTEGER_FIELDS = ('id', 'category', 'price', 'price_rrc', 'quantity')
+
+
+class FeedError(Exception):
+    """Ошибка разбора прайс-листа"""
+
+
+def detect_format(name, content_type=None):
+    """
+    Определение формата прайс-листа по типу содержимого или расширению
+    """
+    if content_type:
+        content_type = content_type.split(';')[0].strip().lower()
+        if content_type in FEED_CONTENT_TYPES:
+            return FEED_CONTENT_TYPES[content_type]
+    extension = os.path.splitext(name.split('?')[0])[1].lower()
+    for feed_format, extensions in FEED_FORMATS.items():
+        if extension in extensions:
+            return feed_format
+    return 'yaml'
+
+
+def iter_feed(stream, feed_format='yaml', raw=False):
+    """
+    Потоковое чтение прайс-листа в виде записей (тип, значение)
+
+    Типы записей: shop - название магазина, category - категория,
+    goods - товар. Название магазина всегда идет первой записью.
+    С raw=True товары JSON Lines отдаются неразобранными строками,
+    чтобы разбор можно было выполнить в другом процессе.
+    """
+    if feed_format == 'jsonl':
+        return iter_jsonl_feed(stream, raw=raw)
+    if feed_format == 'msgpack':
+        return iter_msgpack_feed(stream)
+    if feed_format == 'csv':
+        return iter_csv_feed(stream)
+    return iter_yaml_feed(stream)
+
+
+def iter_parsed_feed(data):
+    """
+    Записи прайс-листа, уже загруженного в память целиком
+    """
+    yield 'shop', data['shop']
+    for category in data['categories']:
+        yield 'category', category
+    for item in data['goods']:
+        yield 'goods', item
+
+
+def iter_yaml_feed(stream):
+    """
+    Чтение YAML по событиям парсера без построения всего дерева
+
+    В памяти одновременно находится только текущий товар, при наличии
+    libyaml используется его парсер. Ключи верхнего уровня могут идти
+    в любом порядке, но название магазина должно встретиться раньше
+    товаров: категории до него копятся в памяти и отдаются сразу после
+    названия магазина, а товары не копятся.
+    """
+    loader = FeedLoader(stream)
+    shop_seen = False
+    categories = []
+    try:
+        loader.get_event()
+        if loader.check_event(StreamEndEvent):
+            return
+        loader.get_event()
+        if not loader.check_event(MappingStartEvent):
+            raise FeedError('Прайс-лист должен быть словарем')
+        loader.get_event()
+        while not loader.check_event(MappingEndEvent):
+            key = _construct(loader)
+            if key in ('categories', 'goods'):
+                kind = 'category' if key == 'categories' else 'goods'
+                if not loader.check_event(SequenceStartEvent):
+                    raise FeedError(f'Раздел {key} должен быть списком')
+                if kind == 'goods' and not shop_seen:
+                    raise FeedError('Название магазина (shop) должно '
+                                    'идти в прайс-листе до товаров')
+                loader.get_event()
+                while not loader.check_event(SequenceEndEvent):
+                    if shop_seen:
+                        yield kind, _construct(loader)
+                    else:
+                        categories.append(_construct(loader))
+                loader.get_event()
+            elif key == 'shop':
+                yield 'shop', _construct(loader)
+                shop_seen = True
+                for category in categories:
+                    yield 'category', category
+                categories = []
+            else:
+                _construct(loader)
+        if not shop_seen:
+            raise FeedError('В прайс-листе не указано название магазина')
+    finally:
+        loader.dispose()
+
+
+def _construct(loader):
+    """
+    Построение значения очередного узла YAML из потока событий
+    """
+    event = loader.get_event()
+    if isinstance(event, ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(ScalarNode, event.value, event.implicit)
+        node = ScalarNode(tag, event.value, event.start_mark,
+                          event.end_mark, event.style)
+        constructor = loader.yaml_constructors.get(
+            tag, loader.yaml_constructors[None]
+        )
+        return constructor(loader, node)
+    if isinstance(event, MappingStartEvent):
+        value = {}
+        while not loader.check_event(MappingEndEvent):
+            key = _construct(loader)
+            value[key] = _construct(loader)
+        loader.get_event()
+        return value
+    if isinstance(event, SequenceStartEvent):
+        value = []
+        while not loader.check_event(SequenceEndEvent):
+            value.append(_construct(loader))
+        loader.get_event()
+        return value
+    if isinstance(event, AliasEvent):
+        raise FeedError('Ссылки YAML в прайс-листе не поддерживаются')
+    raise FeedError(f'Неожиданный элемент прайс-листа: {event}')
+
+
+def iter_jsonl_feed(stream, raw=False):
+    """
+    Чтение прайс-листа в формате JSON Lines
+
+    Первая строка - заголовок с ключами shop и categories,
+    каждая следующая строка - отдельный товар.
+    """
+    def objects():
+        header = True
+        for number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            if raw and not header:
+                yield line
+                continue
+            header = False
+            try:
+                yield json.loads(line)
+            except ValueError as exc:
+                raise FeedError(f'Строка {number}: {exc}')
+
+    return _iter_header_feed(objects())
+
+
+def iter_msgpack_feed(stream):
+    """
+    Чтение прайс-листа из потока объектов MessagePack
+
+    Порядок объектов тот же, что и у строк JSON Lines.
+    """
+    if msgpack is None:
+        raise FeedError('Для загрузки прайс-листов MessagePack '
+                        'необходим пакет msgpack')
+    unpacker = msgpack.Unpacker(stream, raw=False)
+    try:
+        yield from _iter_header_feed(unpacker)
+    except (ValueError, msgpack.UnpackException) as exc:
+        raise FeedError(f'Некорректный MessagePack: {exc}')
+
+
+def _iter_header_feed(objects):
+    header = next(objects, None)
+    if not isinstance(header, dict) or 'shop' not in header:
+        raise FeedError('Первая запись прайс-листа должна содержать '
+                        'название магазина')
+    yield 'shop', header['shop']
+    for category in header.get('categories', ()):
+        yield 'category', category
+    for item in objects:
+        yield 'goods', item
+
+
+def iter_csv_feed(stream):
+    """
+    Чтение прайс-листа в формате CSV
+
+    Колонки: shop, category, category_name, id, model, name, price,
+    price_rrc, quantity, parameters. Параметры товара передаются
+    JSON-объектом, категория добавляется при первом упоминании.
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig',
+                                             newline=''))
+    categories = set()
+    for number, row in enumerate(reader):
+        if number == 0:
+            yield 'shop', row.get('shop')
+        category_name = row.pop('category_name', None)
+        row.pop('shop', None)
+        for field in CSV_INTEGER_FIELDS:
+            try:
+                row[field] = int(row[field])
+            except (KeyError, TypeError, ValueError):
+                pass
+        if row.get('category') not in categories:
+            categories.add(row.get('category'))
+            yield 'category', {'id': row.get('category'),
+                               'name': category_name}
+        try:
+            row['parameters'] = json.loads(row.get('parameters') or '{}')
+        except ValueError:
+            pass
+        yield 'goods', row
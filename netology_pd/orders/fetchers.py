@@ -0,0 +1,146 @@
+import gzip
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from requests import get
+
+from .feeds import detect_format, FEED_FORMATS
+
+CHUNK_SIZE = 64 * 1024
+
+GZIP_CONTENT_TYPES = ('application/gzip', 'application/x-gzip')
+
+
+class FeedFile:
+    """
+    Скачанный прайс-лист во временном файле
+
+    Атрибуты:
+        path -- путь к файлу, None если прайс-лист не изменился
+        feed_format -- формат прайс-листа
+        compressed -- файл сжат gzip
+        etag, last_modified, content_hash -- данные для следующего запроса
+    """
+
+    def __init__(self, path=None, feed_format='yaml', compressed=False,
+                 etag='', last_modified='', content_hash=''):
+        self.path = path
+        self.feed_format = feed_format
+        self.compressed = compressed
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+
+    @property
+    def modified(self):
+        return self.path is not None
+
+    def open(self):
+        if self.compressed:
+            return gzip.open(self.path, 'rb')
+        return open(self.path, 'rb')
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def fetch_feed(source):
+    """
+    Условное скачивание прайс-листа по ссылке источника
+
+    Запрос отправляется с сохраненными ETag/Last-Modified, тело ответа
+    пишется на диск по частям. При ответе 304 или совпадении хэша
+    содержимого с прошлой загрузкой файл не сохраняется.
+    """
+    headers = {'Accept-Encoding': 'gzip'}
+    if source.etag:
+        headers['If-None-Match'] = source.etag
+    if source.last_modified:
+        headers['If-Modified-Since'] = source.last_modified
+
+    with get(source.url, headers=headers, stream=True,
+             timeout=settings.FEED_FETCH_TIMEOUT) as response:
+        if response.status_code == 304:
+            return FeedFile(etag=source.etag,
+                            last_modified=source.last_modified,
+                            content_hash=source.content_hash)
+        response.raise_for_status()
+
+        content_type = response.headers.get('Content-Type', '')
+        name = source.url.split('?')[0]
+        compressed = (name.endswith('.gz') or
+                      content_type.split(';')[0] in GZIP_CONTENT_TYPES)
+        if name.endswith('.gz'):
+            name = name[:-3]
+
+        digest = hashlib.sha256()
+        spool = tempfile.NamedTemporaryFile(dir=settings.FEED_SPOOL_DIR,
+                                            prefix='feed-', delete=False)
+        try:
+            with spool:
+                # requests сам распаковывает ответ с Content-Encoding: gzip
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    spool.write(chunk)
+        except BaseException:
+            # оборванная загрузка не оставляет файл в каталоге
+            os.remove(spool.name)
+            raise
+
+    feed = FeedFile(
+        path=spool.name,
+        feed_format=detect_format(
+            name, None if compressed else content_type
+        ),
+        compressed=compressed,
+        etag=response.headers.get('ETag', ''),
+        last_modified=response.headers.get('Last-Modified', ''),
+        content_hash=digest.hexdigest(),
+    )
+    if source.content_hash and feed.content_hash == source.content_hash:
+        feed.remove()
+        feed.path = None
+    return feed
+
+
+def local_feed(path):
+    """
+    Прайс-лист, уже сохраненный на диск
+    """
+    compressed = path.endswith('.gz')
+    return FeedFile(path=path,
+                    feed_format=detect_format(path[:-3] if compressed
+                                              else path),
+                    compressed=compressed)
+
+
+def spool_upload(upload):
+    """
+    Сохранение загруженного файла прайс-листа во временный каталог
+
+    Формат определяется по типу содержимого или имени файла и
+    закрепляется расширением временного файла.
+    """
+    name = upload.name or ''
+    compressed = name.endswith('.gz')
+    if compressed:
+        name = name[:-3]
+    feed_format = detect_format(
+        name, None if compressed else upload.content_type
+    )
+    suffix = FEED_FORMATS[feed_format][0] + ('.gz' if compressed else '')
+
+    spool = tempfile.NamedTemporaryFile(dir=settings.FEED_SPOOL_DIR,
+                                        prefix='upload-', suffix=suffix,
+                                        delete=False)
+    try:
+        with spool:
+            for chunk in upload.chunks():
+                spool.write(chunk)
+    except BaseException:
+        os.remove(spool.name)
+        raise
+    return local_feed(spool.name)
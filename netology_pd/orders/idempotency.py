@@ -0,0 +1,159 @@
+import hashlib
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.template.response import SimpleTemplateResponse
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+# заголовок ответа, полученного из сохраненного
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+
+def request_fingerprint(request):
+    """
+    Отпечаток запроса: метод, путь и тело
+
+    Тело берется из request.data, поэтому JSON и форма с теми же
+    значениями дают одинаковый отпечаток.
+    """
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+    payload = json.dumps([request.method, request.path, data],
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def reclaim(stored, now):
+    """
+    Повторное занятие ключа, запрос по которому не ответил за время
+    аренды
+    """
+    if (stored.status_code is not None or
+            stored.created_at >= now - settings.IDEMPOTENCY_KEY_LEASE):
+        return False
+    return bool(IdempotencyKey.objects.filter(
+        id=stored.id, status_code=None, created_at=stored.created_at
+    ).update(created_at=now))
+
+
+def claim_key(user_id, key, fingerprint, now):
+    """
+    Занятие ключа под выполнение запроса, now - время занятия
+
+    Возвращает None, если ключ занят этим вызовом, иначе занявшую его
+    строку. Повтор обходится одним чтением. Уникальный индекс
+    (пользователь, ключ) не дает двум параллельным повторам выполнить
+    запрос дважды, истекшая строка заменяется новой. Ключ без ответа
+    старше IDEMPOTENCY_KEY_LEASE занимается заново условным UPDATE,
+    поэтому его получает только один из параллельных повторов.
+    """
+    for _ in range(2):
+        stored = IdempotencyKey.objects.filter(
+            user_id=user_id, key=key).first()
+        if stored is not None and stored.created_at >= (
+                now - settings.IDEMPOTENCY_KEY_TTL):
+            if stored.fingerprint == fingerprint and reclaim(stored, now):
+                return None
+            return stored
+        if stored is not None:
+            stored.delete()
+        try:
+            with transaction.atomic():
+                IdempotencyKey.objects.create(user_id=user_id, key=key,
+                                              fingerprint=fingerprint,
+                                              created_at=now)
+            return None
+        except IntegrityError:
+            continue
+    # ключ без конца занимают параллельные запросы - отвечаем, что
+    # запрос еще выполняется
+    return IdempotencyKey(user_id=user_id, key=key, fingerprint=fingerprint)
+
+
+def replay(stored, fingerprint):
+    """
+    Ответ на повтор запроса по занятому ключу
+    """
+    if stored.fingerprint != fingerprint:
+        return JsonResponse({
+            'Status': False,
+            'Error': 'Ключ идемпотентности уже использован для другого '
+                     'запроса'
+        }, status=422)
+    if stored.status_code is None:
+        return JsonResponse({
+            'Status': False,
+            'Error': 'Запрос с этим ключом идемпотентности еще выполняется'
+        }, status=409)
+    response = HttpResponse(stored.content, status=stored.status_code,
+                            content_type=stored.content_type)
+    response[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Поддержка заголовка Idempotency-Key у метода APIView
+
+    Без заголовка или без авторизации метод выполняется как обычно.
+    С заголовком первый запрос выполняется и его ответ сохраняется,
+    повторы с тем же ключом и телом получают сохраненный ответ, метод
+    при этом не вызывается. Ответы 5xx и исключения не сохраняются,
+    такой запрос можно повторить с тем же ключом. Повтор запроса,
+    оборвавшегося без ответа, выполняется заново после истечения
+    аренды IDEMPOTENCY_KEY_LEASE.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.META.get(IDEMPOTENCY_HEADER)
+        if not key or not request.user.is_authenticated:
+            return view(request, *args, **kwargs)
+        if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Слишком длинный ключ идемпотентности'
+            }, status=400)
+
+        fingerprint = request_fingerprint(request)
+        now = timezone.now()
+        stored = claim_key(request.user.id, key, fingerprint, now)
+        if stored is not None:
+            return replay(stored, fingerprint)
+
+        # запрос, переживший свою аренду, не трогает ключ, занятый
+        # повтором после нее
+        claimed = IdempotencyKey.objects.filter(user=request.user, key=key,
+                                                created_at=now)
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            claimed.delete()
+            raise
+        # ответы DRF еще не отрисованы, сохраняются только готовые
+        if (response.status_code >= 500 or
+                isinstance(response, SimpleTemplateResponse)):
+            claimed.delete()
+        else:
+            claimed.update(status_code=response.status_code,
+                           content_type=response.get('Content-Type', ''),
+                           content=response.content.decode())
+        return response
+    return wrapper
+
+
+def cleanup_idempotency_keys(now=None):
+    """
+    Удаление ключей старше IDEMPOTENCY_KEY_TTL
+    """
+    now = now or timezone.now()
+    deleted, _ = IdempotencyKey.objects.filter(
+        created_at__lt=now - settings.IDEMPOTENCY_KEY_TTL).delete()
+    return deleted
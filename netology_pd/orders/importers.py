@@ -0,0 +1,601 @@
+import hashlib
+import json
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import current_process
+
+from django.db import transaction
+
+try:
+    from billiard.process import current_process as current_pool_process
+except ImportError:
+    current_pool_process = None
+
+from .caches import bump_catalog, category_cache, parameter_cache
+from .facets import apply_facet_deltas, facet_counts
+from .feeds import FeedError, iter_parsed_feed
+from .models import (Category, OrderItem, Product, ProductInfo,
+                     ProductParameter, Shop)
+from .offers import (refresh_best_offers, refresh_offers,
+                     rename_category_offers)
+from .search import document, index_products
+
+BATCH_SIZE = 1000
+
+MAX_ERRORS = 100
+
+GOODS_FIELDS = ('id', 'category', 'model', 'name', 'price', 'price_rrc',
+                'quantity', 'parameters')
+
+PRODUCT_INFO_FIELDS = ('product_id', 'model', 'price', 'price_rrc',
+                       'quantity', 'fingerprint', 'search_document')
+
+
+def fingerprint(item):
+    """
+    Хэш содержимого строки прайс-листа
+    """
+    content = json.dumps(item, sort_keys=True, ensure_ascii=False,
+                         default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def validate_item(item, categories):
+    """
+    Проверка строки прайс-листа, возвращает текст ошибки
+    """
+    if not isinstance(item, dict):
+        return 'описание товара должно быть словарем'
+    missing = [field for field in GOODS_FIELDS if field not in item]
+    if missing:
+        return 'не указаны поля {}'.format(', '.join(missing))
+    for field in ('id', 'price', 'price_rrc', 'quantity'):
+        if not isinstance(item[field], int) or item[field] < 0:
+            return f'поле {field} должно быть неотрицательным числом'
+    if item['category'] not in categories:
+        return 'категория {} отсутствует в прайс-листе'.format(
+            item['category'])
+    if not isinstance(item['parameters'], dict):
+        return 'параметры товара должны быть словарем'
+    return None
+
+
+def prepare_goods(goods, categories):
+    """
+    Разбор и проверка пачки товаров
+
+    Строки JSON, переданные без разбора, декодируются здесь же.
+    Возвращает список (товар, отпечаток, ошибка) в исходном порядке.
+    Функция не обращается к базе, поэтому может выполняться в
+    дочернем процессе.
+    """
+    prepared = []
+    for item in goods:
+        if isinstance(item, (bytes, str)):
+            try:
+                item = json.loads(item)
+            except ValueError as exc:
+                prepared.append((None, None, f'некорректный JSON: {exc}'))
+                continue
+        error = validate_item(item, categories)
+        prepared.append((item, None if error else fingerprint(item), error))
+    return prepared
+
+
+def can_fork():
+    """
+    Может ли текущий процесс запускать дочерние процессы
+
+    Процессы пула prefork воркера celery - демоны, а демон не может
+    создавать дочерние процессы.
+    """
+    if current_process().daemon:
+        return False
+    if current_pool_process is not None:
+        return not current_pool_process().daemon
+    return True
+
+
+def chunked(iterable, size):
+    """
+    Разбиение последовательности на пачки фиксированного размера
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class CatalogImporter:
+    """
+    Пакетная загрузка прайс-листа магазина
+
+    Существующие ключи продуктов и информации о продуктах собираются
+    в словари за несколько запросов на пачку товаров, категории и
+    параметры берутся из кэша справочников, изменения записываются
+    через bulk_create/bulk_update.
+    Размер пачки запроса Django выбирает сам с учетом ограничений СУБД.
+    Повторная загрузка того же прайса обновляет строки на месте.
+
+    В режиме diff строки, отпечаток которых совпадает с сохраненным,
+    пропускаются, а товары, пропавшие из прайс-листа, удаляются.
+    """
+
+    def __init__(self, shop, batch_size=BATCH_SIZE, progress=None,
+                 mode='full'):
+        self.shop = shop
+        self.batch_size = batch_size
+        self.progress = progress
+        self.mode = mode
+        self.seen = set()
+        # строки, по которым нельзя узнать внешний id товара
+        self.unidentified = 0
+        self.categories = set()
+        self.touched_categories = set()
+        # изменения счетчиков фасетов по строкам параметров этой загрузки
+        self.facet_deltas = Counter()
+        self.parameters = {}
+        self.errors = []
+        self.rows_parsed = 0
+        self.rows_inserted = 0
+        self.rows_updated = 0
+        self.rows_unchanged = 0
+        self.rows_removed = 0
+        self.timings = {'parse': 0.0, 'validate': 0.0, 'write': 0.0}
+
+    @property
+    def rows_written(self):
+        return self.rows_inserted + self.rows_updated + self.rows_removed
+
+    def load_categories(self, categories):
+        """
+        Создание и обновление категорий с привязкой к магазину
+        """
+        names = {}
+        for category in categories:
+            if (not isinstance(category, dict) or
+                    not isinstance(category.get('id'), int) or
+                    not category.get('name')):
+                self.add_error(f'Категория {category}: не указаны '
+                               f'id или название')
+                continue
+            names[category['id']] = category['name']
+        self.categories.update(names)
+        # решение о создании и переименовании принимается по базе: кэш
+        # процесса мог устареть после загрузки в другом процессе
+        existing = dict(Category.objects.filter(
+            id__in=list(names)).values_list('id', 'name'))
+
+        to_create = []
+        to_update = []
+        for category_id, name in names.items():
+            if category_id not in existing:
+                to_create.append(Category(id=category_id, name=name))
+            elif existing[category_id] != name:
+                to_update.append(Category(id=category_id, name=name))
+        Category.objects.bulk_create(to_create)
+        Category.objects.bulk_update(to_update, ['name'])
+        category_cache.remember(names.items())
+        rename_category_offers(
+            {category.id: category.name for category in to_update})
+
+        through = Category.shops.through
+        through.objects.bulk_create(
+            [through(category_id=category_id, shop_id=self.shop.id)
+             for category_id in names],
+            ignore_conflicts=True
+        )
+
+    def load_records(self, records):
+        """
+        Загрузка потока записей прайс-листа
+
+        Товары копятся в пачку фиксированного размера и записываются
+        по мере чтения, поэтому весь прайс-лист в памяти не хранится.
+        """
+        categories = []
+        goods = []
+        for kind, value in self.timed(records):
+            if kind == 'category':
+                categories.append(value)
+            elif kind == 'goods':
+                if categories:
+                    self.load_categories(categories)
+                    categories = []
+                goods.append(value)
+                if len(goods) >= self.batch_size:
+                    self.load_goods(goods)
+                    goods = []
+        if categories:
+            self.load_categories(categories)
+        if goods:
+            self.load_goods(goods)
+
+    def timed(self, records):
+        """
+        Учет времени чтения записей в этапе parse
+        """
+        started = time.perf_counter()
+        for record in records:
+            self.timings['parse'] += time.perf_counter() - started
+            yield record
+            started = time.perf_counter()
+        self.timings['parse'] += time.perf_counter() - started
+
+    def load_goods(self, goods):
+        """
+        Загрузка товаров пачками по batch_size строк
+        """
+        for chunk in chunked(goods, self.batch_size):
+            started = time.perf_counter()
+            prepared = prepare_goods(chunk, self.categories)
+            self.timings['validate'] += time.perf_counter() - started
+            self.apply_prepared(prepared)
+
+    def apply_prepared(self, prepared):
+        """
+        Запись подготовленной пачки товаров
+
+        Некорректные строки пропускаются и попадают в список ошибок,
+        после пачки вызывается обработчик прогресса.
+        """
+        started = time.perf_counter()
+        valid = []
+        fingerprints = {}
+        for item, item_fingerprint, error in prepared:
+            self.rows_parsed += 1
+            if isinstance(item, dict) and 'id' in item:
+                self.seen.add(item['id'])
+            else:
+                self.unidentified += 1
+            if error:
+                self.add_error(f'Строка {self.rows_parsed}: {error}')
+            else:
+                valid.append(item)
+                fingerprints[item['id']] = item_fingerprint
+        if valid:
+            self.write_chunk(valid, fingerprints)
+        self.timings['write'] += time.perf_counter() - started
+        if self.progress is not None:
+            self.progress(self)
+
+    def validate(self, item):
+        """
+        Проверка строки прайс-листа, возвращает текст ошибки
+        """
+        return validate_item(item, self.categories)
+
+    def add_error(self, message):
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(message)
+
+    def write_chunk(self, items, fingerprints=None):
+        # при повторе внешнего id внутри пачки побеждает последняя строка
+        items = list({item['id']: item for item in items}.values())
+        if fingerprints is None:
+            fingerprints = {item['id']: fingerprint(item) for item in items}
+        if self.mode == 'diff':
+            stored = dict(ProductInfo.objects.filter(
+                shop=self.shop, external_id__in=list(fingerprints)
+            ).values_list('external_id', 'fingerprint'))
+            changed = [item for item in items
+                       if stored.get(item['id']) != fingerprints[item['id']]]
+            self.rows_unchanged += len(items) - len(changed)
+            if not changed:
+                return
+            items = changed
+
+        self._resolve_parameters(items)
+        products = self._resolve_products(items)
+        product_infos, changed, previous = self._save_product_infos(
+            items, products, fingerprints)
+        self._save_product_parameters(items, product_infos, previous)
+        refresh_offers(changed)
+
+    def remove_missing(self):
+        """
+        Удаление товаров магазина, которых нет в прайс-листе
+
+        Позиции, уже попавшие в заказы, не удаляются, чтобы сохранить
+        историю заказов, а снимаются с продажи обнулением остатка.
+        Если в прайс-листе есть строки без id (например, нераспознанный
+        JSON), удаление пропускается: такая строка может быть товаром,
+        который продается.
+        """
+        if self.unidentified:
+            self.add_error(f'Удаление пропавших товаров пропущено: строк '
+                           f'без id - {self.unidentified}')
+            return
+        missing = {}
+        rows = ProductInfo.objects.filter(shop=self.shop).exclude(
+            quantity=0, fingerprint=''
+        ).values_list('id', 'external_id', 'product_id',
+                      'product__category_id')
+        for pk, external_id, product_id, category_id in rows.iterator():
+            if external_id not in self.seen:
+                missing[pk] = product_id
+                self.touched_categories.add(category_id)
+        for chunk in chunked(missing, self.batch_size):
+            ordered = set(OrderItem.objects.filter(
+                product_info_id__in=chunk
+            ).values_list('product_info_id', flat=True))
+            ProductInfo.objects.filter(id__in=ordered).update(
+                quantity=0, fingerprint=''
+            )
+            refresh_offers(ordered)
+            deleted = set(chunk).difference(ordered)
+            # параметры удаляются каскадом вместе с информацией о продукте
+            self.facet_deltas.subtract(
+                facet_counts(product_info_id__in=deleted))
+            ProductInfo.objects.filter(id__in=deleted).delete()
+            refresh_best_offers({missing[pk] for pk in deleted})
+            self.rows_removed += len(chunk)
+
+    def _resolve_parameters(self, items):
+        names = {name for item in items for name in item['parameters']}
+        missing = names.difference(self.parameters)
+        if missing:
+            self.parameters.update(
+                parameter_cache.get_ids(missing, create=True)
+            )
+
+    def _resolve_products(self, items):
+        keys = {(item['name'], item['category']) for item in items}
+        names = {name for name, _ in keys}
+        products = self._products_by_key(names)
+
+        missing = keys.difference(products)
+        if missing:
+            Product.objects.bulk_create(
+                [Product(name=name, category_id=category_id)
+                 for name, category_id in missing]
+            )
+            products.update(
+                self._products_by_key({name for name, _ in missing})
+            )
+        return products
+
+    @staticmethod
+    def _products_by_key(names):
+        return {
+            (name, category_id): product_id
+            for name, category_id, product_id in Product.objects.filter(
+                name__in=names
+            ).order_by().values_list('name', 'category_id', 'id')
+        }
+
+    def _save_product_infos(self, items, products, fingerprints):
+        """
+        Создание и обновление информации о продуктах пачки
+
+        Возвращает словарь внешний id -> id, id измененных строк и
+        категории товаров существующих строк до обновления.
+        """
+        existing = {
+            product_info.external_id: product_info
+            for product_info in ProductInfo.objects.filter(
+                shop=self.shop, external_id__in=[item['id'] for item in items]
+            ).select_related('product')
+        }
+        previous = {product_info.id: product_info.product.category_id
+                    for product_info in existing.values()}
+
+        to_create = []
+        to_update = []
+        moved = set()
+        for item in items:
+            values = {
+                'product_id': products[(item['name'], item['category'])],
+                'model': item['model'],
+                'price': item['price'],
+                'price_rrc': item['price_rrc'],
+                'quantity': item['quantity'],
+                'fingerprint': fingerprints[item['id']],
+                'search_document': document(item),
+            }
+            product_info = existing.get(item['id'])
+            if product_info is None:
+                to_create.append(ProductInfo(shop_id=self.shop.id,
+                                             external_id=item['id'],
+                                             **values))
+            elif any(getattr(product_info, field) != value
+                     for field, value in values.items()):
+                if product_info.product_id != values['product_id']:
+                    moved.add(product_info.product_id)
+                for field, value in values.items():
+                    setattr(product_info, field, value)
+                to_update.append(product_info)
+
+        ProductInfo.objects.bulk_create(to_create)
+        ProductInfo.objects.bulk_update(to_update, PRODUCT_INFO_FIELDS)
+        self.rows_inserted += len(to_create)
+        self.rows_updated += len(to_update)
+
+        # bulk_create не везде возвращает первичные ключи, поэтому
+        # идентификаторы новых строк перечитываются одним запросом
+        product_infos = {external_id: product_info.id
+                         for external_id, product_info in existing.items()}
+        if to_create:
+            product_infos.update(ProductInfo.objects.filter(
+                shop=self.shop,
+                external_id__in=[obj.external_id for obj in to_create]
+            ).values_list('external_id', 'id'))
+
+        changed = {obj.external_id for obj in to_create + to_update}
+        index_products({product_infos[item['id']]: item for item in items
+                        if item['id'] in changed})
+        self.touched_categories.update(
+            item['category'] for item in items if item['id'] in changed
+        )
+        if moved:
+            self.touched_categories.update(Product.objects.filter(
+                id__in=moved).values_list('category_id', flat=True))
+        return product_infos, [product_infos[external_id]
+                               for external_id in changed], previous
+
+    def _save_product_parameters(self, items, product_infos, previous):
+        """
+        Запись параметров пачки с учетом изменений счетчиков фасетов
+
+        previous - категории товаров до обновления, при переносе
+        информации о продукте в другую категорию ее параметры
+        переходят в счетчики новой категории.
+        """
+        deltas = self.facet_deltas
+        existing = {
+            (product_info_id, parameter_id): (pk, value)
+            for pk, product_info_id, parameter_id, value in
+            ProductParameter.objects.filter(
+                product_info_id__in=product_infos.values()
+            ).values_list('id', 'product_info_id', 'parameter_id', 'value')
+        }
+
+        to_create = []
+        to_update = []
+        seen = set()
+        for item in items:
+            product_info_id = product_infos[item['id']]
+            category_id = item['category']
+            old_category_id = previous.get(product_info_id, category_id)
+            for name, value in item['parameters'].items():
+                key = (product_info_id, self.parameters[name])
+                value = str(value)
+                seen.add(key)
+                if key not in existing:
+                    to_create.append(ProductParameter(
+                        product_info_id=product_info_id,
+                        parameter_id=key[1],
+                        value=value
+                    ))
+                    deltas[(category_id, key[1], value)] += 1
+                    continue
+                old_value = existing[key][1]
+                if old_value != value:
+                    to_update.append(ProductParameter(id=existing[key][0],
+                                                      value=value))
+                if old_value != value or old_category_id != category_id:
+                    deltas[(old_category_id, key[1], old_value)] -= 1
+                    deltas[(category_id, key[1], value)] += 1
+
+        ProductParameter.objects.bulk_create(to_create)
+        ProductParameter.objects.bulk_update(to_update, ['value'])
+        stale = []
+        for key, (pk, value) in existing.items():
+            if key not in seen:
+                stale.append(pk)
+                deltas[(previous[key[0]], key[1], value)] -= 1
+        if stale:
+            ProductParameter.objects.filter(id__in=stale).delete()
+
+
+class ParallelCatalogImporter(CatalogImporter):
+    """
+    Загрузка прайс-листа с разбором и проверкой товаров в пуле процессов
+
+    Основной процесс читает прайс-лист и режет товары на пачки, пачки
+    разбираются и проверяются в ProcessPoolExecutor, а результаты
+    записываются в базу единственным писателем строго в порядке
+    прайс-листа. Идентификаторы категорий и параметров писатель берет
+    из словарей, построенных до начала загрузки. Число пачек в работе
+    ограничено, поэтому память не растет с размером прайс-листа.
+    """
+
+    def __init__(self, shop, workers=2, **kwargs):
+        super().__init__(shop, **kwargs)
+        self.workers = workers
+
+    def load_records(self, records):
+        categories = []
+        shard = []
+        pending = deque()
+        with ProcessPoolExecutor(self.workers) as executor:
+            for kind, value in self.timed(records):
+                if kind == 'category':
+                    categories.append(value)
+                elif kind == 'goods':
+                    if categories:
+                        self.load_categories(categories)
+                        categories = []
+                    shard.append(value)
+                    if len(shard) >= self.batch_size:
+                        pending.append(self.submit(executor, shard))
+                        shard = []
+                        while len(pending) > self.workers * 2:
+                            self.apply_next(pending)
+            if categories:
+                self.load_categories(categories)
+            if shard:
+                pending.append(self.submit(executor, shard))
+            while pending:
+                self.apply_next(pending)
+
+    def submit(self, executor, shard):
+        return executor.submit(prepare_goods, shard,
+                               frozenset(self.categories))
+
+    def apply_next(self, pending):
+        started = time.perf_counter()
+        prepared = pending.popleft().result()
+        # время ожидания результата пачки - время, на которое запись
+        # отстает от разбора
+        self.timings['validate'] += time.perf_counter() - started
+        self.apply_prepared(prepared)
+
+
+def import_feed(records, user_id, batch_size=BATCH_SIZE, progress=None,
+                mode='full', workers=0):
+    """
+    Загрузка потока записей прайс-листа магазина в одной транзакции
+
+    При workers больше единицы товары разбираются и проверяются
+    в пуле из workers процессов. В процессе-демоне (пул prefork
+    воркера celery) пул не создать, и товары разбираются
+    последовательно.
+    """
+    records = iter(records)
+    kind, shop_name = next(records, (None, None))
+    if kind != 'shop':
+        raise FeedError('В прайс-листе не указано название магазина')
+
+    # словари справочников обновляются до открытия транзакции загрузки
+    parameter_cache.check()
+    category_cache.check()
+    with transaction.atomic():
+        shop, _ = Shop.objects.get_or_create(name=shop_name,
+                                             user_id=user_id)
+        if workers > 1 and can_fork():
+            importer = ParallelCatalogImporter(
+                shop, workers=workers, batch_size=batch_size,
+                progress=progress, mode=mode
+            )
+        else:
+            importer = CatalogImporter(shop, batch_size=batch_size,
+                                       progress=progress, mode=mode)
+        importer.load_records(records)
+        if mode == 'diff':
+            importer.remove_missing()
+        # статус магазина перечитывается под блокировкой: смена статуса,
+        # зафиксированная во время загрузки, уже учла в счетчиках только
+        # строки до загрузки, а ожидающая - учтет строки после нее
+        shop_state = Shop.objects.select_for_update().filter(
+            id=shop.id).values_list('state', flat=True).get()
+        if shop_state:
+            apply_facet_deltas(importer.facet_deltas)
+        bump_catalog(shop_ids=[shop.id], category_ids=(
+            importer.categories | importer.touched_categories))
+    return importer
+
+
+def import_catalog(data, user_id, batch_size=BATCH_SIZE, progress=None,
+                   mode='full', workers=0):
+    """
+    Загрузка прайс-листа, уже разобранного в словарь
+    """
+    return import_feed(iter_parsed_feed(data), user_id,
+                       batch_size=batch_size, progress=progress, mode=mode,
+                       workers=workers)
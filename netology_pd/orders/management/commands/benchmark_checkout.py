@@ -0,0 +1,54 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from orders.benchmarks import create_checkouts, measure_checkout
+
+
+class Command(BaseCommand):
+    help = ('Замер параллельного оформления заказов с резервированием '
+            'товаров. Корзины оформляются в пуле потоков во временной '
+            'тестовой базе той СУБД, что указана в настройках DATABASES')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=200,
+                            help='Число оформляемых корзин')
+        parser.add_argument('--threads', type=int, nargs='+', default=[8],
+                            help='Числа потоков, например 1 8 32')
+        parser.add_argument('--products', type=int, default=20,
+                            help='Число товаров магазина, чем меньше, '
+                                 'тем больше конфликтов блокировок')
+        parser.add_argument('--stock', type=int, default=100,
+                            help='Остаток каждого товара')
+        parser.add_argument('--items', type=int, default=5,
+                            help='Число позиций в корзине')
+
+    def handle(self, *args, **options):
+        database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        oversold = False
+        try:
+            for threads in options['threads']:
+                call_command('flush', interactive=False, verbosity=0)
+                checkouts = create_checkouts(
+                    options['buyers'], options['products'],
+                    options['stock'], options['items'])
+                # в режиме DEBUG Django хранит текст всех запросов
+                with override_settings(DEBUG=False):
+                    result = measure_checkout(checkouts, threads)
+                self.stdout.write(
+                    '{vendor} {threads} потоков: {checkouts} корзин за '
+                    '{seconds} с, {checkouts_per_sec} заказов/с, '
+                    'p50 {p50_ms} мс, p95 {p95_ms} мс; оформлено '
+                    '{placed}, не хватило товара {sold_out}, ошибок '
+                    'базы {failed}'.format(**result)
+                )
+                oversold = oversold or result['oversold']
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+
+        if oversold:
+            raise CommandError('Списанное количество не совпадает '
+                               'с зарезервированным')
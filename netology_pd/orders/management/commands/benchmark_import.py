@@ -0,0 +1,96 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from orders.benchmarks import measure_import, record_result, write_feed
+from orders.feeds import FEED_FORMATS, FeedError
+from orders.models import User
+
+
+class Command(BaseCommand):
+    help = ('Замер скорости загрузки синтетических прайс-листов. '
+            'Загрузка выполняется во временной тестовой базе той СУБД, '
+            'что указана в настройках DATABASES, результаты дописываются '
+            'в файл и сравниваются с прошлым замером')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--goods', type=int, nargs='+', default=[1000],
+                            help='Размеры прайс-листов, например '
+                                 '1000 100000 1000000')
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--parameters', type=int, default=4)
+        parser.add_argument('--format', choices=list(FEED_FORMATS),
+                            default='yaml')
+        parser.add_argument('--mode', choices=('full', 'diff'),
+                            default='full')
+        parser.add_argument('--workers', type=int, default=0,
+                            help='Число процессов разбора товаров')
+        parser.add_argument('--results', default=os.path.join(
+            settings.BASE_DIR, 'benchmarks', 'import.jsonl'),
+            help='Файл с историей замеров')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='Допустимое падение скорости загрузки')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        os.makedirs(os.path.dirname(options['results']), exist_ok=True)
+        database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        regressions = []
+        try:
+            for goods in options['goods']:
+                result = self.run_benchmark(goods, options)
+                previous = record_result(options['results'], result,
+                                         threshold=options['threshold'])
+                self.stdout.write(
+                    '{vendor} {format} {rows} товаров: {seconds} с, '
+                    '{rows_per_sec} строк/с, {queries} запросов, '
+                    '{peak_memory_mb} МБ'.format(**result)
+                )
+                self.stdout.write('  этапы: ' + ', '.join(
+                    f'{stage} {seconds} с'
+                    for stage, seconds in result['timings'].items()
+                ))
+                if previous:
+                    regressions.append(goods)
+                    self.stdout.write(self.style.WARNING(
+                        'Скорость упала относительно {commit}: '
+                        '{rows_per_sec} строк/с'.format(**previous)
+                    ))
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+
+        if regressions and options['fail_on_regression']:
+            raise CommandError('Обнаружено замедление загрузки')
+
+    @staticmethod
+    def run_benchmark(goods, options):
+        call_command('flush', interactive=False, verbosity=0)
+        user = User.objects.create_user(email='benchmark@example.com',
+                                        type='shop', is_active=True)
+        with tempfile.NamedTemporaryFile(
+                suffix='.' + options['format'], delete=False) as stream:
+            try:
+                write_feed(stream, goods, categories=options['categories'],
+                           parameters=options['parameters'],
+                           feed_format=options['format'])
+            except FeedError as exc:
+                os.remove(stream.name)
+                raise CommandError(str(exc))
+        try:
+            # в режиме DEBUG Django хранит текст всех запросов
+            with override_settings(DEBUG=False):
+                result = measure_import(stream.name, options['format'],
+                                        user.id, mode=options['mode'],
+                                        workers=options['workers'])
+        finally:
+            os.remove(stream.name)
+        result.update(format=options['format'], mode=options['mode'],
+                      workers=options['workers'])
+        return result
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from orders.caches import cache_stats, reset_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Статистика попаданий в кэш ответов каталога'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help='Обнулить счетчики после вывода')
+
+    def handle(self, *args, **options):
+        stats = cache_stats()
+        total = stats['hits'] + stats['misses']
+        ratio = stats['hits'] / total if total else 0
+        self.stdout.write(
+            'Попаданий: {hits}, промахов: {misses}, '.format(**stats) +
+            f'доля попаданий: {ratio:.1%}'
+        )
+        if options['reset']:
+            reset_cache_stats()
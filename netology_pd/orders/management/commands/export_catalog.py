@@ -0,0 +1,35 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from orders.exports import EXPORT_FORMATS, export_catalog
+
+
+class Command(BaseCommand):
+    help = ('Потоковая выгрузка предложений каталога в NDJSON или CSV '
+            'в файл или стандартный вывод')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=list(EXPORT_FORMATS),
+                            default='ndjson', dest='export_format',
+                            help='Формат выгрузки')
+        parser.add_argument('--gzip', action='store_true',
+                            help='Сжать выгрузку gzip')
+        parser.add_argument('--output', help='Файл выгрузки, по умолчанию '
+                                             'стандартный вывод')
+        parser.add_argument('--shop', type=int, help='id магазина')
+        parser.add_argument('--category', type=int, help='id категории')
+
+    def handle(self, *args, **options):
+        chunks = export_catalog(options['export_format'],
+                                compress=options['gzip'],
+                                shop_id=options['shop'],
+                                category_id=options['category'])
+        if options['output']:
+            with open(options['output'], 'wb') as stream:
+                for chunk in chunks:
+                    stream.write(chunk)
+        else:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,42 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.benchmarks import write_feed
+from orders.feeds import FEED_FORMATS, FeedError, detect_format
+
+
+class Command(BaseCommand):
+    help = 'Генерация синтетического прайс-листа магазина'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Файл прайс-листа')
+        parser.add_argument('--goods', type=int, default=1000,
+                            help='Количество товаров')
+        parser.add_argument('--categories', type=int, default=10,
+                            help='Количество категорий')
+        parser.add_argument('--parameters', type=int, default=4,
+                            help='Количество параметров у товара')
+        parser.add_argument('--format', choices=list(FEED_FORMATS),
+                            help='Формат прайс-листа, по умолчанию '
+                                 'определяется по расширению файла')
+        parser.add_argument('--shop', default='Benchmark',
+                            help='Название магазина')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        feed_format = options['format'] or detect_format(options['output'])
+        try:
+            with open(options['output'], 'wb') as stream:
+                write_feed(stream, options['goods'],
+                           categories=options['categories'],
+                           parameters=options['parameters'],
+                           feed_format=feed_format, shop=options['shop'],
+                           seed=options['seed'])
+        except FeedError as exc:
+            os.remove(options['output'])
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(
+            'Прайс-лист на {} товаров записан в {}'.format(
+                options['goods'], options['output'])
+        ))
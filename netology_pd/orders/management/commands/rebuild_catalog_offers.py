@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from orders.importers import BATCH_SIZE, chunked
+from orders.models import ProductInfo
+from orders.offers import refresh_offers
+
+
+class Command(BaseCommand):
+    help = ('Полная пересборка таблицы каталога CatalogOffer. При загрузке '
+            'прайс-листов и смене статуса магазина таблица обновляется '
+            'сама, команда нужна для первичного заполнения')
+
+    def handle(self, *args, **options):
+        rows = ProductInfo.objects.order_by('id').values_list(
+            'id', flat=True).iterator(chunk_size=BATCH_SIZE)
+        total = 0
+        for chunk in chunked(rows, BATCH_SIZE):
+            with transaction.atomic():
+                refresh_offers(chunk)
+            total += len(chunk)
+        self.stdout.write(f'Пересобрано предложений: {total}')
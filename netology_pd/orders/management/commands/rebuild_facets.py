@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from orders.facets import refresh_facets
+from orders.models import Category
+
+
+class Command(BaseCommand):
+    help = ('Полный пересчет счетчиков значений параметров (фасетов) по '
+            'категориям. Загрузка прайс-листов и смена статуса магазина '
+            'меняют счетчики сами, команда нужна для первичного заполнения')
+
+    def handle(self, *args, **options):
+        total = 0
+        for category_id in Category.objects.order_by('id').values_list(
+                'id', flat=True):
+            with transaction.atomic():
+                refresh_facets([category_id])
+            total += 1
+        self.stdout.write(f'Пересчитано категорий: {total}')
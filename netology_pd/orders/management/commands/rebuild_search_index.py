@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from orders.importers import BATCH_SIZE, chunked
+from orders.models import ProductInfo, ProductParameter
+from orders.search import document, index_products
+
+
+class Command(BaseCommand):
+    help = ('Полная пересборка поискового индекса товаров. При загрузке '
+            'прайс-листов индекс обновляется сам, команда нужна для '
+            'первичного заполнения')
+
+    def handle(self, *args, **options):
+        rows = ProductInfo.objects.order_by('id').values_list(
+            'id', 'product__name', 'model').iterator(chunk_size=BATCH_SIZE)
+        total = 0
+        for chunk in chunked(rows, BATCH_SIZE):
+            items = {pk: {'name': name, 'model': model, 'parameters': {}}
+                     for pk, name, model in chunk}
+            for pk, parameter_id, value in ProductParameter.objects.filter(
+                    product_info_id__in=list(items)).values_list(
+                    'product_info_id', 'parameter_id', 'value'):
+                items[pk]['parameters'][parameter_id] = value
+
+            with transaction.atomic():
+                updated = [ProductInfo(id=pk, search_document=document(item))
+                           for pk, item in items.items()]
+                ProductInfo.objects.bulk_update(updated, ['search_document'])
+                index_products(items)
+            total += len(items)
+        self.stdout.write(f'Проиндексировано товаров: {total}')
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+
+from orders.importers import BATCH_SIZE, chunked
+from orders.models import Order, OrderItem, ProductInfo
+
+
+class Command(BaseCommand):
+    help = ('Пересчет сумм и числа позиций заказов. Позициям без '
+            'сохраненной цены проставляется текущая цена магазина. '
+            'Изменения корзины и оформление заказа поддерживают суммы '
+            'сами, команда нужна для первичного заполнения')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            priced = OrderItem.objects.filter(price=0).update(
+                price=Subquery(ProductInfo.objects.filter(
+                    id=OuterRef('product_info_id')).values('price')[:1])
+            )
+        self.stdout.write(f'Проставлено цен позиций: {priced}')
+
+        rows = Order.objects.order_by('id').values_list(
+            'id', flat=True).iterator(chunk_size=BATCH_SIZE)
+        total = 0
+        for chunk in chunked(rows, BATCH_SIZE):
+            totals = {
+                order_id: (total_sum, items_count)
+                for order_id, total_sum, items_count in
+                OrderItem.objects.filter(order_id__in=chunk).values(
+                    'order_id'
+                ).annotate(
+                    total_sum=Sum(F('quantity') * F('price')),
+                    items_count=Count('id')
+                ).order_by().values_list('order_id', 'total_sum',
+                                         'items_count')
+            }
+            orders = [Order(id=order_id) for order_id in chunk]
+            for order in orders:
+                order.total_sum, order.items_count = totals.get(
+                    order.id, (0, 0))
+            with transaction.atomic():
+                Order.objects.bulk_update(orders,
+                                          ['total_sum', 'items_count'])
+            total += len(chunk)
+        self.stdout.write(f'Пересчитано заказов: {total}')
@@ -4,6 +4,7 @@ from django.db import models
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 CHARS_CHOICES = (
@@ -19,6 +20,21 @@ STATE_CHOICES = (
     ('canceled', 'Отменен'),
 )
 
+IMPORT_ACTIVE_STATES = ('pending', 'running')
+
+IMPORT_STATE_CHOICES = (
+    ('pending', 'В очереди'),
+    ('running', 'Выполняется'),
+    ('done', 'Завершена'),
+    ('skipped', 'Прайс-лист не изменился'),
+    ('failed', 'Ошибка'),
+)
+
+IMPORT_MODE_CHOICES = (
+    ('full', 'Полная загрузка'),
+    ('diff', 'Только изменения'),
+)
+
 USER_TYPE_CHOICES = (
     ('shop', 'Магазин'),
     ('buyer', 'Покупатель'),
@@ -134,6 +150,17 @@ class Shop(models.Model):
                                 on_delete=models.CASCADE)
     state = models.BooleanField(verbose_name='Прием заказов',
                                 default=True)
+    feed_url = models.URLField(verbose_name='Ссылка на прайс-лист',
+                               max_length=500, null=True, blank=True)
+    feed_interval = models.PositiveIntegerField(
+        verbose_name='Интервал обновления прайс-листа (мин)', default=0
+    )
+    feed_mode = models.CharField(verbose_name='Режим загрузки прайс-листа',
+                                 choices=IMPORT_MODE_CHOICES,
+                                 default='full', max_length=5)
+    feed_checked_at = models.DateTimeField(
+        verbose_name='Последняя плановая загрузка', null=True, blank=True
+    )
 
     class Meta:
         verbose_name = 'Магазин'
@@ -168,6 +195,10 @@ class Product(models.Model):
         verbose_name = 'Продукт'
         verbose_name_plural = "Список продуктов"
         ordering = ('name',)
+        indexes = [
+            models.Index(fields=['category', 'name'],
+                         name='product_category_name'),
+        ]
 
     def __str__(self):
         return self.name
@@ -190,6 +221,12 @@ class ProductInfo(models.Model):
     price_rrc = models.PositiveIntegerField(
         verbose_name='Рекомендуемая розничная цена'
     )
+    fingerprint = models.CharField(
+        verbose_name='Отпечаток строки прайс-листа', max_length=40,
+        blank=True
+    )
+    search_document = models.TextField(verbose_name='Текст для поиска',
+                                       blank=True)
 
     class Meta:
         verbose_name = 'Информация о продукте'
@@ -198,10 +235,15 @@ class ProductInfo(models.Model):
             models.UniqueConstraint(fields=['product', 'shop', 'external_id'],
                                     name='unique_product_info'),
         ]
+        indexes = [
+            models.Index(fields=['shop', 'product'],
+                         name='product_info_shop_product'),
+        ]
 
 
 class Parameter(models.Model):
-    name = models.CharField(max_length=40, verbose_name='Название')
+    name = models.CharField(max_length=40, verbose_name='Название',
+                            unique=True)
 
     class Meta:
         verbose_name = 'Имя параметра'
@@ -229,6 +271,143 @@ class ProductParameter(models.Model):
             models.UniqueConstraint(fields=['product_info', 'parameter'],
                                     name='unique_product_parameter'),
         ]
+        indexes = [
+            models.Index(fields=['parameter', 'value'],
+                         name='product_parameter_value'),
+        ]
+
+
+class FacetCount(models.Model):
+    category = models.ForeignKey(Category, verbose_name='Категория',
+                                 related_name='facet_counts',
+                                 on_delete=models.CASCADE)
+    parameter = models.ForeignKey(Parameter, verbose_name='Параметр',
+                                  related_name='facet_counts',
+                                  on_delete=models.CASCADE)
+    value = models.CharField(verbose_name='Значение', max_length=100)
+    count = models.PositiveIntegerField(verbose_name='Число предложений')
+
+    class Meta:
+        verbose_name = 'Счетчик значения параметра'
+        verbose_name_plural = "Счетчики значений параметров"
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'parameter', 'value'],
+                                    name='unique_facet_count'),
+        ]
+
+
+class CatalogOffer(models.Model):
+    """
+    Предложение магазина в том виде, в котором его читает каталог
+
+    Денормализованная копия информации о продукте с названием товара,
+    категорией, магазином и параметрами, поэтому список товаров
+    читается из одной таблицы без соединений. Строки пересобирает
+    загрузчик прайс-листов, статус магазина обновляет StateChange.
+    """
+    product_info = models.OneToOneField(ProductInfo,
+                                        verbose_name='Информация о продукте',
+                                        related_name='offer',
+                                        primary_key=True,
+                                        on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, verbose_name='Продукт',
+                                related_name='offers',
+                                on_delete=models.CASCADE)
+    product_name = models.CharField(max_length=80,
+                                    verbose_name='Наименование')
+    category = models.ForeignKey(Category, verbose_name='Категория',
+                                 related_name='offers',
+                                 on_delete=models.CASCADE)
+    category_name = models.CharField(max_length=40,
+                                     verbose_name='Название категории')
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='offers', on_delete=models.CASCADE)
+    shop_name = models.CharField(max_length=50,
+                                 verbose_name='Название магазина')
+    shop_state = models.BooleanField(verbose_name='Прием заказов')
+    model = models.CharField(max_length=80, verbose_name='Модель продукта',
+                             blank=True)
+    external_id = models.PositiveIntegerField(
+        verbose_name='Внешний уникальный идентификатор товара из магазина'
+    )
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    price = models.PositiveIntegerField(verbose_name='Цена')
+    price_rrc = models.PositiveIntegerField(
+        verbose_name='Рекомендуемая розничная цена'
+    )
+    parameters = models.TextField(
+        verbose_name='Параметры в JSON: список пар [имя, значение]',
+        default='[]'
+    )
+
+    class Meta:
+        verbose_name = 'Предложение каталога'
+        verbose_name_plural = "Предложения каталога"
+        indexes = [
+            models.Index(fields=['shop_state', 'product_name', 'product_info'],
+                         name='offer_state_name'),
+            models.Index(fields=['category', 'shop_state', 'product_name'],
+                         name='offer_category_name'),
+            models.Index(fields=['shop', 'product_name'],
+                         name='offer_shop_name'),
+            models.Index(fields=['product', 'shop_state'],
+                         name='offer_product'),
+        ]
+
+
+class BestOffer(models.Model):
+    """
+    Лучшее предложение товара среди магазинов, принимающих заказы
+
+    Минимальная цена, число магазинов с товаром в наличии и самое
+    дешевое предложение. Строки пересчитываются вместе со строками
+    CatalogOffer, товары без предложений в наличии в таблице отсутствуют.
+    """
+    product = models.OneToOneField(Product, verbose_name='Продукт',
+                                   related_name='best_offer',
+                                   primary_key=True,
+                                   on_delete=models.CASCADE)
+    product_name = models.CharField(max_length=80,
+                                    verbose_name='Наименование')
+    category = models.ForeignKey(Category, verbose_name='Категория',
+                                 related_name='best_offers',
+                                 on_delete=models.CASCADE)
+    min_price = models.PositiveIntegerField(verbose_name='Минимальная цена')
+    shops_in_stock = models.PositiveIntegerField(
+        verbose_name='Магазинов с товаром в наличии'
+    )
+    shop = models.ForeignKey(Shop, verbose_name='Самый дешевый магазин',
+                             related_name='best_offers',
+                             on_delete=models.CASCADE)
+    product_info = models.ForeignKey(ProductInfo,
+                                     verbose_name='Самое дешевое предложение',
+                                     related_name='best_offers',
+                                     on_delete=models.CASCADE)
+
+    class Meta:
+        verbose_name = 'Лучшее предложение'
+        verbose_name_plural = "Лучшие предложения"
+        indexes = [
+            models.Index(fields=['category', 'min_price', 'product'],
+                         name='best_offer_category_price'),
+        ]
+
+
+class SearchToken(models.Model):
+    product_info = models.ForeignKey(ProductInfo,
+                                     verbose_name='Информация о продукте',
+                                     related_name='search_tokens',
+                                     on_delete=models.CASCADE)
+    token = models.CharField(verbose_name='Слово', max_length=100)
+    weight = models.PositiveSmallIntegerField(verbose_name='Вес')
+
+    class Meta:
+        verbose_name = 'Слово поискового индекса'
+        verbose_name_plural = "Поисковый индекс товаров"
+        constraints = [
+            models.UniqueConstraint(fields=['token', 'product_info'],
+                                    name='unique_search_token'),
+        ]
 
 
 class Order(models.Model):
@@ -241,11 +420,22 @@ class Order(models.Model):
     contact = models.ForeignKey('Contact', verbose_name='Контакт',
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
+    # сумма и число позиций меняются вместе с позициями в той же
+    # транзакции, списки заказов читают их без агрегации
+    total_sum = models.PositiveIntegerField(verbose_name='Сумма заказа',
+                                            default=0)
+    items_count = models.PositiveIntegerField(
+        verbose_name='Количество позиций', default=0)
 
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = "Список заказов"
         ordering = ('-dt',)
+        indexes = [
+            models.Index(fields=['user', 'state', 'dt'],
+                         name='order_user_state_dt'),
+            models.Index(fields=['dt', 'id'], name='order_dt_id'),
+        ]
 
     def __str__(self):
         return str(self.dt)
@@ -262,6 +452,9 @@ class OrderItem(models.Model):
                                      blank=True,
                                      on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(verbose_name='Количество')
+    # цена на момент добавления в корзину, при оформлении фиксируется
+    # текущая цена магазина и дальше не меняется
+    price = models.PositiveIntegerField(verbose_name='Цена', default=0)
 
     class Meta:
         verbose_name = 'Заказанная позиция'
@@ -272,6 +465,129 @@ class OrderItem(models.Model):
         ]
 
 
+class StockReservation(models.Model):
+    """
+    Количество товара, списанное с остатка магазина при оформлении заказа
+
+    При отмене заказа резерв возвращается на остаток и помечается
+    снятым, повторная отмена ничего не меняет.
+    """
+    order = models.ForeignKey(Order, verbose_name='Заказ',
+                              related_name='reservations',
+                              on_delete=models.CASCADE)
+    product_info = models.ForeignKey(ProductInfo,
+                                     verbose_name='Информация о продукте',
+                                     related_name='reservations',
+                                     on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    created_at = models.DateTimeField(auto_now_add=True)
+    released_at = models.DateTimeField(verbose_name='Резерв снят',
+                                       null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Резерв товара'
+        verbose_name_plural = "Резервы товаров"
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'product_info'],
+                                    name='unique_stock_reservation'),
+        ]
+
+
+class FeedSource(models.Model):
+    user = models.ForeignKey(User, verbose_name='Пользователь',
+                             related_name='feed_sources',
+                             on_delete=models.CASCADE)
+    url = models.URLField(verbose_name='Ссылка на прайс-лист',
+                          max_length=500)
+    etag = models.CharField(verbose_name='ETag', max_length=200, blank=True)
+    last_modified = models.CharField(verbose_name='Last-Modified',
+                                     max_length=100, blank=True)
+    content_hash = models.CharField(verbose_name='Хэш содержимого',
+                                    max_length=64, blank=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Источник прайс-листа'
+        verbose_name_plural = "Список источников прайс-листов"
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'url'],
+                                    name='unique_feed_source'),
+        ]
+
+    def __str__(self):
+        return self.url
+
+
+class ImportJob(models.Model):
+    user = models.ForeignKey(User, verbose_name='Пользователь',
+                             related_name='import_jobs',
+                             on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин',
+                             related_name='import_jobs', blank=True,
+                             null=True, on_delete=models.CASCADE)
+    url = models.URLField(verbose_name='Ссылка на прайс-лист',
+                          max_length=500, blank=True)
+    feed_file = models.CharField(verbose_name='Загруженный файл',
+                                 max_length=500, blank=True)
+    state = models.CharField(verbose_name='Статус',
+                             choices=IMPORT_STATE_CHOICES,
+                             default='pending', max_length=10)
+    mode = models.CharField(verbose_name='Режим загрузки',
+                            choices=IMPORT_MODE_CHOICES,
+                            default='full', max_length=5)
+    workers = models.PositiveSmallIntegerField(
+        verbose_name='Процессов разбора', default=0
+    )
+    task_id = models.CharField(verbose_name='Идентификатор задачи',
+                               max_length=50, blank=True)
+    rows_parsed = models.PositiveIntegerField(
+        verbose_name='Прочитано строк', default=0
+    )
+    rows_written = models.PositiveIntegerField(
+        verbose_name='Записано строк', default=0
+    )
+    rows_inserted = models.PositiveIntegerField(
+        verbose_name='Добавлено строк', default=0
+    )
+    rows_updated = models.PositiveIntegerField(
+        verbose_name='Изменено строк', default=0
+    )
+    rows_unchanged = models.PositiveIntegerField(
+        verbose_name='Строк без изменений', default=0
+    )
+    rows_removed = models.PositiveIntegerField(
+        verbose_name='Удалено строк', default=0
+    )
+    parse_seconds = models.FloatField(verbose_name='Чтение, с',
+                                      null=True, blank=True)
+    validate_seconds = models.FloatField(verbose_name='Разбор и проверка, с',
+                                         null=True, blank=True)
+    write_seconds = models.FloatField(verbose_name='Запись, с',
+                                      null=True, blank=True)
+    errors = models.TextField(verbose_name='Ошибки', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Загрузка прайс-листа'
+        verbose_name_plural = "Список загрузок прайс-листов"
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f'{self.url or self.feed_file} ({self.state})'
+
+    @property
+    def elapsed(self):
+        """
+        Время выполнения загрузки в секундах
+        """
+        if not self.started_at:
+            return None
+        finished_at = self.finished_at or timezone.now()
+        return (finished_at - self.started_at).total_seconds()
+
+
 class Contact(models.Model):
     user = models.ForeignKey(User, verbose_name='Пользователь',
                              related_name='contacts',
@@ -332,3 +648,39 @@ class ConfirmEmailKey(models.Model):
     class Meta:
         verbose_name = 'Ключ подтверждения по email'
         verbose_name_plural = 'Ключи подтверждения по email'
+
+
+class IdempotencyKey(models.Model):
+    """
+    Ответ на изменяющий запрос с заголовком Idempotency-Key
+
+    Строка создается до выполнения запроса, ответ записывается после.
+    Повтор запроса с тем же ключом получает сохраненный ответ без
+    повторного выполнения. Строки старше IDEMPOTENCY_KEY_TTL удаляются
+    периодической задачей.
+    """
+    user = models.ForeignKey(User, verbose_name='Пользователь',
+                             related_name='idempotency_keys',
+                             on_delete=models.CASCADE)
+    key = models.CharField(verbose_name='Ключ', max_length=255)
+    fingerprint = models.CharField(verbose_name='Отпечаток запроса',
+                                   max_length=64)
+    status_code = models.PositiveSmallIntegerField(
+        verbose_name='Код ответа', null=True, blank=True
+    )
+    content_type = models.CharField(verbose_name='Тип ответа',
+                                    max_length=100, blank=True)
+    content = models.TextField(verbose_name='Тело ответа', blank=True)
+    # время занятия ключа, повтор после истечения аренды его обновляет
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name = 'Ключ идемпотентности'
+        verbose_name_plural = 'Ключи идемпотентности'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'],
+                                    name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f'{self.key} ({self.status_code or "в работе"})'
@@ -0,0 +1,129 @@
+import json
+
+from django.db import transaction
+
+from .caches import parameter_cache
+from .models import (BestOffer, CatalogOffer, Product, ProductInfo,
+                     ProductParameter)
+
+
+def refresh_offers(product_info_ids):
+    """
+    Пересборка строк каталога для указанных информаций о продуктах
+
+    Строки удаляются и создаются заново одним bulk_create, имена
+    параметров берутся из кэша справочников, а названия категорий -
+    из базы тем же запросом, что и строки: загрузка переименовывает
+    категории в своей транзакции, а кэш узнает новые названия только
+    после нее. Вызывается внутри транзакции загрузки, поэтому читатели
+    не видят пачку наполовину пересобранной. Лучшие предложения пересчитываются для
+    прежних и новых товаров этих строк.
+    """
+    product_info_ids = list(product_info_ids)
+    if not product_info_ids:
+        return
+    offers = CatalogOffer.objects.filter(pk__in=product_info_ids)
+    products = set(offers.values_list('product_id', flat=True))
+    offers.delete()
+
+    rows = list(ProductInfo.objects.filter(
+        id__in=product_info_ids
+    ).order_by().values_list(
+        'id', 'product_id', 'product__name', 'product__category_id',
+        'product__category__name', 'shop_id', 'shop__name', 'shop__state',
+        'model', 'external_id', 'quantity', 'price', 'price_rrc'
+    ))
+    values = ProductParameter.objects.filter(
+        product_info_id__in=product_info_ids
+    ).order_by('id').values_list('product_info_id', 'parameter_id', 'value')
+    parameters = {}
+    for product_info_id, parameter_id, value in values:
+        parameters.setdefault(product_info_id, []).append(
+            (parameter_id, value))
+    parameter_names = parameter_cache.get_names(
+        {parameter_id for pairs in parameters.values()
+         for parameter_id, _ in pairs})
+
+    CatalogOffer.objects.bulk_create([
+        CatalogOffer(
+            product_info_id=pk, product_id=product_id,
+            product_name=product_name, category_id=category_id,
+            category_name=category_name or '',
+            shop_id=shop_id, shop_name=shop_name, shop_state=shop_state,
+            model=model, external_id=external_id, quantity=quantity,
+            price=price, price_rrc=price_rrc,
+            parameters=json.dumps(
+                [[parameter_names.get(parameter_id), value]
+                 for parameter_id, value in parameters.get(pk, [])],
+                ensure_ascii=False
+            )
+        )
+        for (pk, product_id, product_name, category_id, category_name,
+             shop_id, shop_name, shop_state, model, external_id, quantity,
+             price, price_rrc) in rows
+    ])
+    refresh_best_offers(products.union(row[1] for row in rows))
+
+
+def refresh_best_offers(product_ids):
+    """
+    Пересчет лучших предложений указанных товаров по строкам каталога
+
+    Предложения читаются одним запросом в порядке (товар, цена, id),
+    поэтому первое предложение товара - самое дешевое. Строки товаров
+    блокируются в порядке id до пересчета: товар общий для магазинов, и
+    без блокировки параллельные загрузки разных магазинов удаляли бы и
+    вставляли одну строку BestOffer одновременно, а вторая вставка
+    падала бы на первичном ключе.
+    """
+    product_ids = sorted(set(product_ids))
+    if not product_ids:
+        return
+    with transaction.atomic(savepoint=False):
+        list(Product.objects.select_for_update().filter(
+            id__in=product_ids).order_by('id').values_list('id', flat=True))
+        _refresh_best_offers(product_ids)
+
+
+def _refresh_best_offers(product_ids):
+    BestOffer.objects.filter(product_id__in=product_ids).delete()
+    offers = CatalogOffer.objects.filter(
+        product_id__in=product_ids, shop_state=True, quantity__gt=0
+    ).order_by('product_id', 'price', 'product_info').values_list(
+        'product_id', 'product_name', 'category_id', 'price', 'shop_id',
+        'product_info'
+    )
+    best = {}
+    shops = {}
+    for product_id, name, category_id, price, shop_id, pk in offers:
+        if product_id not in best:
+            best[product_id] = BestOffer(
+                product_id=product_id, product_name=name,
+                category_id=category_id, min_price=price, shop_id=shop_id,
+                product_info_id=pk
+            )
+        shops.setdefault(product_id, set()).add(shop_id)
+    for product_id, offer in best.items():
+        offer.shops_in_stock = len(shops[product_id])
+    BestOffer.objects.bulk_create(best.values())
+
+
+def rename_category_offers(names):
+    """
+    Обновление названий категорий в строках каталога
+    """
+    for category_id, name in names.items():
+        CatalogOffer.objects.filter(category_id=category_id).exclude(
+            category_name=name).update(category_name=name)
+
+
+def set_shop_state(shop_id, state, batch_size=1000):
+    """
+    Статус магазина в строках каталога и пересчет лучших предложений
+    """
+    offers = CatalogOffer.objects.filter(shop_id=shop_id)
+    offers.update(shop_state=state)
+    products = list(offers.order_by('product_id').values_list(
+        'product_id', flat=True).distinct())
+    for start in range(0, len(products), batch_size):
+        refresh_best_offers(products[start:start + batch_size])
@@ -0,0 +1,110 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination:
+    """
+    Постраничная выдача по ключу сортировки (keyset)
+
+    Вместо номера страницы клиент получает непрозрачный курсор со
+    значениями полей сортировки последней строки, следующая страница
+    выбирается условием "ключ больше курсора". Поэтому стоимость любой
+    страницы одинакова и не зависит от ее номера. Последнее поле
+    сортировки должно быть уникальным, поле с префиксом '-' сортируется
+    по убыванию.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+    def __init__(self, ordering, page_size=None):
+        self.ordering = ordering
+        self.page_size = page_size or api_settings.PAGE_SIZE
+        self.request = None
+        self.next_position = None
+
+    def paginate_queryset(self, queryset, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+
+        rows = list(queryset[:page_size + 1])
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_position = self.position(rows[-1])
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        cursor = urlsafe_b64encode(
+            json.dumps(self.next_position, default=str).encode()
+        ).decode()
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            position = json.loads(urlsafe_b64decode(cursor.encode()))
+        except (TypeError, ValueError):
+            raise NotFound('Неверный курсор')
+        if not isinstance(position, list) or (
+                len(position) != len(self.ordering)):
+            raise NotFound('Неверный курсор')
+        return position
+
+    def position(self, row):
+        """
+        Значения полей сортировки строки: объекта модели или словаря
+        из .values(), в который поля сортировки должны входить
+        """
+        if isinstance(row, dict):
+            return [row[field.lstrip('-')] for field in self.ordering]
+        values = []
+        for field in self.ordering:
+            value = row
+            for attr in field.lstrip('-').split('__'):
+                value = getattr(value, attr)
+            values.append(value)
+        return values
+
+    def after(self, position):
+        """
+        Условие "строка идет после курсора" для составного ключа
+        """
+        conditions = []
+        for index, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition = {
+                previous.lstrip('-'): position[number]
+                for number, previous in enumerate(self.ordering[:index])
+            }
+            condition[f'{name}__{lookup}'] = position[index]
+            conditions.append(Q(**condition))
+        return reduce(or_, conditions)
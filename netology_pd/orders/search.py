@@ -0,0 +1,111 @@
+import re
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import BooleanField, Count, FloatField, Sum
+from django.db.models.expressions import RawSQL
+
+from .models import ProductInfo, SearchToken
+
+TOKEN_RE = re.compile(r'\w+')
+
+# вес совпадения в названии товара, модели и значениях параметров
+TOKEN_WEIGHTS = (3, 2, 1)
+
+SEARCH_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS product_info_search_fts "
+    "ON orders_productinfo USING gin "
+    "(to_tsvector('{config}'::regconfig, search_document))",
+    "CREATE INDEX IF NOT EXISTS product_info_search_trgm "
+    "ON orders_productinfo USING gin (search_document gin_trgm_ops)",
+)
+
+
+def use_full_text():
+    return connection.vendor == 'postgresql'
+
+
+def document_fields(item):
+    """
+    Поля товара для поиска: название, модель и значения параметров
+    """
+    return (item['name'], item['model'],
+            ' '.join(str(value) for value in item['parameters'].values()))
+
+
+def document(item):
+    return ' '.join(document_fields(item))
+
+
+def tokenize(text):
+    return [token[:100] for token in TOKEN_RE.findall(text.lower())]
+
+
+def index_products(items):
+    """
+    Обновление индекса для словаря id информации о продукте -> товар
+
+    В PostgreSQL поиск идет по GIN-индексам поля search_document,
+    которое записывает загрузчик, здесь обновлять нечего. В остальных
+    СУБД пересобираются строки обратного индекса SearchToken.
+    """
+    if use_full_text() or not items:
+        return
+    SearchToken.objects.filter(product_info_id__in=list(items)).delete()
+    tokens = []
+    for product_info_id, item in items.items():
+        weights = {}
+        for text, weight in zip(document_fields(item), TOKEN_WEIGHTS):
+            for token in tokenize(text):
+                weights[token] = weights.get(token, 0) + weight
+        tokens.extend(
+            SearchToken(product_info_id=product_info_id, token=token,
+                        weight=weight)
+            for token, weight in weights.items()
+        )
+    SearchToken.objects.bulk_create(tokens)
+
+
+def search_products(queryset, query):
+    """
+    Товары queryset, подходящие под запрос, по убыванию релевантности
+    """
+    if use_full_text():
+        config = settings.SEARCH_CONFIG
+        table = ProductInfo._meta.db_table
+        rank = RawSQL(
+            f'ts_rank(to_tsvector(%s::regconfig, "{table}".search_document), '
+            f'plainto_tsquery(%s::regconfig, %s)) + '
+            f'word_similarity(%s, "{table}".search_document)',
+            (config, config, query, query), output_field=FloatField()
+        )
+        matched = RawSQL(
+            f'to_tsvector(%s::regconfig, "{table}".search_document) @@ '
+            f'plainto_tsquery(%s::regconfig, %s) OR '
+            f'%s <%% "{table}".search_document',
+            (config, config, query, query), output_field=BooleanField()
+        )
+        return queryset.annotate(matched=matched, rank=rank).filter(
+            matched=True).order_by('-rank', 'id')
+
+    terms = set(tokenize(query))
+    return queryset.filter(search_tokens__token__in=terms).annotate(
+        terms=Count('search_tokens__token', distinct=True),
+        rank=Sum('search_tokens__weight')
+    ).order_by('-terms', '-rank', 'id')
+
+
+def create_search_indexes(using='default', **kwargs):
+    """
+    Создание GIN-индексов полнотекстового и триграммного поиска
+
+    Выполняется после migrate, так как Django не умеет описывать
+    индексы по выражениям и классам операторов расширения pg_trgm.
+    """
+    db = connections[using]
+    if db.vendor != 'postgresql':
+        return
+    with db.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for statement in SEARCH_INDEXES:
+            cursor.execute(statement.format(config=settings.SEARCH_CONFIG))
@@ -1,7 +1,128 @@
+import json
+from datetime import datetime, time, timedelta
+
 from rest_framework import serializers
 
-from orders.models import (Category, Contact, OrderItem, Order, Parameter,
-                           Product, ProductInfo, ProductParameter, Shop, User)
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from orders.caches import parameter_cache
+from orders.models import (BestOffer, Category, Contact, ImportJob, OrderItem,
+                           Order, Parameter, Product, ProductInfo,
+                           ProductParameter, Shop, User, STATE_CHOICES)
+
+
+class SparseFieldsMixin:
+    """
+    Вывод только запрошенных полей сериализатора
+
+    Выводимые поля передаются аргументом fields, для запроса их
+    возвращает requested_fields по параметрам fields и expand.
+    """
+    # вложенные объекты, вывод которых управляется параметром expand
+    expandable_fields = ()
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields).difference(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def requested_fields(cls, query_params):
+        """
+        Поля для вывода в порядке Meta.fields
+
+        fields=id,price оставляет только перечисленные поля, без него
+        выводятся все. Если передан expand, вложенные объекты выводятся,
+        только если перечислены в нем.
+        """
+        fields = cls.Meta.fields
+        requested = list_param(query_params, 'fields')
+        if requested is not None:
+            unknown = set(requested).difference(fields)
+            if unknown:
+                raise serializers.ValidationError({
+                    'fields': 'Неизвестные поля: {}'.format(
+                        ', '.join(sorted(unknown)))
+                })
+            fields = [field for field in fields if field in requested]
+        expand = list_param(query_params, 'expand')
+        if expand is not None:
+            unknown = set(expand).difference(cls.expandable_fields)
+            if unknown:
+                raise serializers.ValidationError({
+                    'expand': 'Неизвестные вложенные объекты: {}'.format(
+                        ', '.join(sorted(unknown)))
+                })
+            fields = [field for field in fields
+                      if field not in cls.expandable_fields or field in expand]
+        return tuple(fields)
+
+
+def list_param(query_params, name):
+    """
+    Список значений параметра через запятую, None - параметр не передан
+    """
+    if name not in query_params:
+        return None
+    return [value.strip() for values in query_params.getlist(name)
+            for value in values.split(',') if value.strip()]
+
+
+def parse_moment(value, name):
+    """
+    Момент времени из даты или даты со временем в формате ISO
+
+    Возвращает пару (момент, передана ли только дата), для даты
+    момент - начало дня.
+    """
+    try:
+        moment = parse_datetime(value)
+        is_date = moment is None
+        if is_date:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(value)
+            moment = datetime.combine(day, time.min)
+    except ValueError:
+        raise serializers.ValidationError({
+            name: 'Ожидается дата или дата со временем в формате ISO'
+        })
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment, is_date
+
+
+def order_filters(query_params):
+    """
+    Условия отбора заказов по параметрам state, date_from и date_to
+
+    state - статусы через запятую, date_from и date_to - границы даты
+    заказа включительно.
+    """
+    filters = {}
+    states = list_param(query_params, 'state')
+    if states:
+        unknown = set(states).difference(
+            state for state, _ in STATE_CHOICES)
+        if unknown:
+            raise serializers.ValidationError({
+                'state': 'Неизвестные статусы: {}'.format(
+                    ', '.join(sorted(unknown)))
+            })
+        filters['state__in'] = states
+    if query_params.get('date_from'):
+        filters['dt__gte'], _ = parse_moment(query_params['date_from'],
+                                             'date_from')
+    if query_params.get('date_to'):
+        moment, is_date = parse_moment(query_params['date_to'], 'date_to')
+        if is_date:
+            # день date_to входит в период целиком
+            filters['dt__lt'] = moment + timedelta(days=1)
+        else:
+            filters['dt__lte'] = moment
+    return filters
 
 
 class ParameterSerializer(serializers.ModelSerializer):
@@ -12,19 +133,26 @@ class ParameterSerializer(serializers.ModelSerializer):
 
 
 class ProductParameterSerializer(serializers.ModelSerializer):
-    parameter = ParameterSerializer()
+    parameter = serializers.SerializerMethodField()
 
     class Meta:
         model = ProductParameter
         fields = ('value', 'parameter')
 
+    @staticmethod
+    def get_parameter(obj):
+        # имя параметра берется из кэша справочника без join
+        return {'name': parameter_cache.get_name(obj.parameter_id)}
+
 
-class ProductInfoSerializer(serializers.ModelSerializer):
+class ProductInfoSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     product_parameters = ProductParameterSerializer(read_only=True, many=True)
+    expandable_fields = ('product_parameters',)
 
     class Meta:
         model = ProductInfo
-        fields = '__all__'
+        fields = ('id', 'product_parameters', 'model', 'external_id',
+                  'quantity', 'price', 'price_rrc', 'product', 'shop')
 
 
 class ProductSerializer(serializers.ModelSerializer):
@@ -78,6 +206,14 @@ class ShopSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'state')
 
 
+class ShopFeedSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Shop
+        fields = ('feed_url', 'feed_interval', 'feed_mode', 'feed_checked_at')
+        read_only_fields = ('feed_checked_at',)
+
+
 class OrderProductSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -105,18 +241,159 @@ class OrderItemSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = OrderItem
-        fields = ('product_info', 'quantity')
+        fields = ('product_info', 'quantity', 'price')
         read_only_fields = ('id',)
 
 
-class OrdersSerializer(serializers.ModelSerializer):
+class OrdersSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     user = OrderUserSerializer()
     contact = ContactSerializer(read_only=True)
     ordered_items = OrderItemSerializer(read_only=True, many=True)
-    total_sum = serializers.IntegerField()
+    expandable_fields = ('ordered_items', 'user', 'contact')
 
     class Meta:
         model = Order
         fields = ('id', 'ordered_items', 'state', 'dt', 'total_sum', 'user',
                   'contact')
         read_only_fields = ('id',)
+
+
+class BestOfferSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = BestOffer
+        fields = ('product', 'product_name', 'category', 'min_price',
+                  'shops_in_stock', 'shop', 'product_info')
+        read_only_fields = fields
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    elapsed = serializers.FloatField(read_only=True)
+    errors = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'state', 'mode', 'workers', 'url', 'shop',
+                  'rows_parsed', 'rows_written', 'rows_inserted',
+                  'rows_updated', 'rows_unchanged', 'rows_removed',
+                  'elapsed', 'parse_seconds', 'validate_seconds',
+                  'write_seconds', 'errors', 'created_at', 'started_at',
+                  'finished_at')
+        read_only_fields = fields
+
+    @staticmethod
+    def get_errors(obj):
+        return obj.errors.splitlines()
+
+
+# Быстрая сериализация списков каталога и заказов: строки .values()
+# денормализованных таблиц или один сгруппированный запрос вложенных
+# записей вместо вложенных ModelSerializer. Порядок ключей совпадает
+# с сериализаторами выше, fields - поля из requested_fields.
+
+# поля ProductInfoSerializer, которые в CatalogOffer называются иначе
+OFFER_COLUMNS = {'id': 'product_info', 'product_parameters': 'parameters'}
+
+CONTACT_FIELDS = ('id', 'city', 'street', 'house', 'structure', 'building',
+                  'apartment', 'phone')
+
+ORDER_USER_FIELDS = ('first_name', 'last_name', 'patronymic', 'email')
+
+
+def offer_values(fields=ProductInfoSerializer.Meta.fields):
+    """
+    Поля CatalogOffer для .values(), нужные для вывода fields
+    """
+    return ('product_info',) + tuple(
+        OFFER_COLUMNS.get(field, field) for field in fields if field != 'id')
+
+
+def order_values(fields=OrdersSerializer.Meta.fields):
+    """
+    Поля Order для .values(), нужные для вывода fields
+    """
+    values = ['id']
+    for field in fields:
+        if field == 'user':
+            values.extend(f'user__{name}' for name in ORDER_USER_FIELDS)
+        elif field == 'contact':
+            values.append('contact_id')
+            values.extend(f'contact__{name}' for name in CONTACT_FIELDS[1:])
+        elif field not in ('id', 'ordered_items'):
+            values.append(field)
+    return tuple(values)
+
+
+def fast_offers(rows, fields=ProductInfoSerializer.Meta.fields):
+    """
+    Строки каталога CatalogOffer в формате ProductInfoSerializer
+
+    rows - словари из .values(*offer_values(fields))
+    """
+    offers = []
+    for row in rows:
+        offer = {}
+        for field in fields:
+            if field == 'id':
+                offer['id'] = row['product_info']
+            elif field == 'product_parameters':
+                offer[field] = [
+                    {'value': value, 'parameter': {'name': name}}
+                    for name, value in json.loads(row['parameters'])
+                ]
+            else:
+                offer[field] = row[field]
+        offers.append(offer)
+    return offers
+
+
+def fast_order_items(order_ids):
+    items = {pk: [] for pk in order_ids}
+    for (order_id, name, price, shop, quantity,
+         item_price) in OrderItem.objects.filter(
+            order_id__in=list(items)).order_by('id').values_list(
+            'order_id', 'product_info__product__name',
+            'product_info__price', 'product_info__shop', 'quantity',
+            'price'):
+        items[order_id].append({
+            'product_info': {'product': {'name': name}, 'price': price,
+                             'shop': shop},
+            'quantity': quantity,
+            'price': item_price,
+        })
+    return items
+
+
+def fast_orders(rows, fields=OrdersSerializer.Meta.fields):
+    """
+    Заказы в формате OrdersSerializer
+
+    rows - словари из .values(*order_values(fields))
+    """
+    rows = list(rows)
+    if 'ordered_items' in fields:
+        items = fast_order_items(row['id'] for row in rows)
+
+    dt_field = serializers.DateTimeField()
+    orders = []
+    for row in rows:
+        order = {}
+        for field in fields:
+            if field == 'ordered_items':
+                order[field] = items[row['id']]
+            elif field == 'dt':
+                order[field] = dt_field.to_representation(row['dt'])
+            elif field == 'user':
+                order[field] = {name: row[f'user__{name}']
+                                for name in ORDER_USER_FIELDS}
+            elif field == 'contact':
+                contact = None
+                if row['contact_id'] is not None:
+                    contact = {'id': row['contact_id']}
+                    contact.update((name, row[f'contact__{name}'])
+                                   for name in CONTACT_FIELDS[1:])
+                order[field] = contact
+            else:
+                order[field] = row[field]
+        orders.append(order)
+    return orders
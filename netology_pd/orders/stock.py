@@ -0,0 +1,165 @@
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .caches import bump_catalog
+from .cart import CART_STATE, stock_error
+from .models import (CatalogOffer, Order, OrderItem, ProductInfo,
+                     StockReservation, STATE_CHOICES)
+from .offers import refresh_best_offers
+
+NEW_STATE = STATE_CHOICES[1][0]
+
+CANCELED_STATE = STATE_CHOICES[6][0]
+
+# статусы, из которых покупатель может отменить заказ
+CANCELABLE_STATES = ('new', 'confirmed', 'assembled')
+
+
+class StockError(Exception):
+    """
+    Ошибка резервирования товаров заказа
+
+    Атрибуты:
+        errors -- список ошибок по позициям заказа
+    """
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def lock_product_infos(ids):
+    """
+    Блокировка строк информации о продуктах в порядке id
+
+    Одинаковый порядок блокировок во всех транзакциях исключает
+    взаимные блокировки при оформлении пересекающихся заказов.
+    """
+    product_infos = ProductInfo.objects.filter(id__in=ids).order_by('id')
+    if connection.features.has_select_for_update_of:
+        product_infos = product_infos.select_for_update(of=('self',))
+    else:
+        product_infos = product_infos.select_for_update()
+    return {product_info.id: product_info for product_info in
+            product_infos.select_related('shop', 'product')}
+
+
+def apply_stock(product_infos, changes):
+    """
+    Изменение остатков на величины changes одним bulk_update
+
+    Остаток меняется выражением F() на стороне базы, а не записью
+    прочитанного значения. В строках каталога меняется только остаток,
+    лучшие предложения пересчитываются лишь для товаров, предложение
+    которых закончилось или снова появилось в наличии. Сбрасывается
+    кэш товаров, магазинов и категорий этих предложений, списки
+    магазинов и категорий остаются в кэше.
+    """
+    products = set()
+    for product_info_id, change in changes.items():
+        product_info = product_infos[product_info_id]
+        if (product_info.quantity > 0) != (product_info.quantity + change > 0):
+            products.add(product_info.product_id)
+        product_info.quantity = F('quantity') + change
+    ProductInfo.objects.bulk_update(
+        [product_infos[pk] for pk in changes], ['quantity'])
+    CatalogOffer.objects.bulk_update(
+        [CatalogOffer(product_info_id=pk, quantity=F('quantity') + change)
+         for pk, change in changes.items()], ['quantity'])
+    refresh_best_offers(products)
+    bump_catalog(
+        shop_ids={product_infos[pk].shop_id for pk in changes},
+        category_ids={product_infos[pk].product.category_id
+                      for pk in changes},
+        lists=False
+    )
+
+
+def reserve_stock(order):
+    """
+    Списание остатков под позиции заказа
+
+    Должна вызываться в транзакции. Строки остатков блокируются одним
+    запросом, проверки идут в памяти. Если хотя бы одной позиции не
+    хватает товара, ничего не списывается и выбрасывается StockError.
+    Цены позиций фиксируются по текущим ценам магазинов, сумма заказа
+    пересчитывается по ним.
+    """
+    items = list(order.ordered_items.order_by('id'))
+    if not items:
+        raise StockError([{'id': None, 'Error': 'Корзина пуста'}])
+    product_infos = lock_product_infos(
+        {item.product_info_id for item in items})
+
+    errors = []
+    for item in items:
+        product_info = product_infos[item.product_info_id]
+        if not product_info.shop.state:
+            errors.append({'id': item.id,
+                           'Error': 'Магазин {} не принимает заказы '
+                                    'в данный момент'.format(
+                                        product_info.shop.name)})
+        elif product_info.quantity < item.quantity:
+            errors.append({'id': item.id, 'Error': stock_error(product_info)})
+        item.price = product_info.price
+    if errors:
+        raise StockError(errors)
+
+    apply_stock(product_infos, {item.product_info_id: -item.quantity
+                                for item in items})
+    StockReservation.objects.bulk_create([
+        StockReservation(order=order, product_info_id=item.product_info_id,
+                         quantity=item.quantity)
+        for item in items
+    ])
+    OrderItem.objects.bulk_update(items, ['price'])
+    order.total_sum = sum(item.quantity * item.price for item in items)
+    order.items_count = len(items)
+
+
+def release_stock(order):
+    """
+    Возврат на остатки несписанных резервов заказа
+    """
+    reservations = list(order.reservations.filter(
+        released_at=None).values_list('id', 'product_info_id', 'quantity'))
+    if not reservations:
+        return
+    product_infos = lock_product_infos({pk for _, pk, _ in reservations})
+    apply_stock(product_infos, {pk: quantity
+                                for _, pk, quantity in reservations})
+    StockReservation.objects.filter(
+        id__in=[pk for pk, _, _ in reservations]
+    ).update(released_at=timezone.now())
+
+
+def checkout_order(order_id, user_id, contact_id):
+    """
+    Оформление корзины пользователя в заказ с резервированием товаров
+
+    Корзина блокируется до конца транзакции, поэтому параллельное
+    оформление той же корзины дождется первого и не найдет ее.
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(
+            id=order_id, user_id=user_id, state=CART_STATE)
+        reserve_stock(order)
+        order.contact_id = contact_id
+        order.state = NEW_STATE
+        order.save(update_fields=['contact', 'state', 'total_sum',
+                                  'items_count'])
+    return order
+
+
+def cancel_order(order_id, user_id):
+    """
+    Отмена заказа пользователя с возвратом резервов на остатки
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(
+            id=order_id, user_id=user_id, state__in=CANCELABLE_STATES)
+        release_stock(order)
+        order.state = CANCELED_STATE
+        order.save(update_fields=['state'])
+    return order
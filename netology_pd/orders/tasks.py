@@ -1,7 +1,17 @@
+from datetime import timedelta
+
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 
-from orders.models import (ConfirmEmailKey, OrderItem, STATE_CHOICES)
+from orders.feeds import iter_feed
+from orders.fetchers import fetch_feed, local_feed
+from orders.idempotency import cleanup_idempotency_keys
+from orders.importers import import_feed
+from orders.models import (ConfirmEmailKey, FeedSource, IMPORT_ACTIVE_STATES,
+                           ImportJob, OrderItem, Shop, STATE_CHOICES, User)
 
 from netology_pd.celery import app
 
@@ -79,4 +89,144 @@ def send_email_task(instance_state, instance_id, instance_e_mail):
                 # to:
                 [shop_user[1]]
             )
-            msg.send()
\ No newline at end of file
+            msg.send()
+
+
+@app.task(bind=True)
+def load_info_task(self, job_id):
+    """
+    загрузка прайс-листа магазина в фоне
+
+    пока идет транзакция загрузки, прогресс публикуется в хранилище
+    результатов celery, итог сохраняется в ImportJob. Если прайс-лист
+    не изменился с прошлой успешной загрузки, разбор пропускается
+    """
+    job = ImportJob.objects.get(id=job_id)
+    job.state = 'running'
+    job.task_id = self.request.id or ''
+    job.started_at = timezone.now()
+    job.save()
+
+    def progress(importer):
+        if self.request.called_directly or self.request.is_eager:
+            return
+        self.update_state(state='PROGRESS', meta={
+            'rows_parsed': importer.rows_parsed,
+            'rows_written': importer.rows_written,
+        })
+
+    try:
+        if job.feed_file:
+            source = None
+            feed = local_feed(job.feed_file)
+        else:
+            source, _ = FeedSource.objects.get_or_create(user_id=job.user_id,
+                                                         url=job.url)
+            feed = fetch_feed(source)
+        if not feed.modified:
+            job.state = 'skipped'
+        else:
+            try:
+                with feed.open() as stream:
+                    importer = import_feed(
+                        iter_feed(stream, feed.feed_format,
+                                  raw=job.workers > 1),
+                        job.user_id, progress=progress, mode=job.mode,
+                        workers=job.workers
+                    )
+            finally:
+                feed.remove()
+            job.state = 'done'
+            job.shop = importer.shop
+            job.rows_parsed = importer.rows_parsed
+            job.rows_written = importer.rows_written
+            job.rows_inserted = importer.rows_inserted
+            job.rows_updated = importer.rows_updated
+            job.rows_unchanged = importer.rows_unchanged
+            job.rows_removed = importer.rows_removed
+            job.parse_seconds = round(importer.timings['parse'], 3)
+            job.validate_seconds = round(importer.timings['validate'], 3)
+            job.write_seconds = round(importer.timings['write'], 3)
+            job.errors = '\n'.join(importer.errors)
+        if source is not None:
+            source.etag = feed.etag
+            source.last_modified = feed.last_modified
+            source.content_hash = feed.content_hash
+            source.fetched_at = timezone.now()
+            source.save()
+    except Exception as exc:
+        job.state = 'failed'
+        job.errors = f'{type(exc).__name__}: {exc}'
+    job.finished_at = timezone.now()
+    job.save()
+
+
+def active_import_jobs():
+    """
+    Загрузки в очереди и в работе, кроме зависших
+    """
+    return ImportJob.objects.filter(
+        state__in=IMPORT_ACTIVE_STATES,
+        created_at__gte=timezone.now() - settings.IMPORT_JOB_TIMEOUT
+    )
+
+
+def queue_import_job(user_id, url='', mode='full', shop_id=None,
+                     feed_file='', workers=0):
+    """
+    Постановка загрузки прайс-листа по ссылке или из файла в очередь
+
+    У магазина одновременно может быть только одна активная загрузка,
+    при наличии такой загрузки возвращается None.
+    """
+    with transaction.atomic():
+        # блокировка строки пользователя упорядочивает конкурентные запросы
+        list(User.objects.select_for_update().filter(
+            id=user_id).values_list('id', flat=True))
+        if active_import_jobs().filter(user_id=user_id).exists():
+            return None
+        job = ImportJob.objects.create(user_id=user_id, shop_id=shop_id,
+                                       url=url, feed_file=feed_file,
+                                       mode=mode, workers=workers)
+        transaction.on_commit(lambda: load_info_task.delay(job.id))
+    return job
+
+
+@app.task()
+def schedule_imports_task():
+    """
+    постановка в очередь плановых загрузок прайс-листов магазинов
+
+    запускается celery beat, число одновременных загрузок ограничено
+    настройкой IMPORT_MAX_CONCURRENCY
+    """
+    now = timezone.now()
+    slots = settings.IMPORT_MAX_CONCURRENCY - active_import_jobs().count()
+    queued = 0
+    shops = Shop.objects.filter(
+        feed_url__isnull=False, feed_interval__gt=0, user__isnull=False
+    ).exclude(feed_url='').order_by(
+        F('feed_checked_at').asc(nulls_first=True), 'id'
+    )
+    for shop in shops.iterator():
+        if queued >= slots:
+            break
+        if (shop.feed_checked_at and now < shop.feed_checked_at +
+                timedelta(minutes=shop.feed_interval)):
+            continue
+        job = queue_import_job(shop.user_id, shop.feed_url,
+                               mode=shop.feed_mode, shop_id=shop.id)
+        if job is not None:
+            Shop.objects.filter(id=shop.id).update(feed_checked_at=now)
+            queued += 1
+    return queued
+
+
+@app.task()
+def cleanup_idempotency_keys_task():
+    """
+    удаление сохраненных ответов на запросы с заголовком Idempotency-Key
+
+    запускается celery beat, ответы хранятся IDEMPOTENCY_KEY_TTL
+    """
+    return cleanup_idempotency_keys()
@@ -1,13 +1,121 @@
+import csv
+import gzip
+import hashlib
+import io
 import json
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import skipIf
 
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.exceptions import ViewDoesNotExist
-from django.test import SimpleTestCase, TestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import (SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.urls import get_callable, reverse
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from yaml import dump as dump_yaml, load as load_yaml, SafeLoader
 
-from orders.models import (Shop, Category, User, Product,
-                           ProductInfo, Parameter, ProductParameter)
-from orders.views import empty_view
+from orders.benchmarks import measure_import, write_feed
+from orders.caches import (bump_catalog, cache_stats, category_cache,
+                           parameter_cache)
+from orders.feeds import (FeedError, detect_format, iter_feed,
+                          iter_parsed_feed, msgpack)
+from orders.idempotency import REPLAYED_HEADER
+from orders.importers import import_catalog, import_feed
+from orders.models import (Shop, BestOffer, CatalogOffer, Category, Contact,
+                           FacetCount, FeedSource, ImportJob, Order,
+                           OrderItem, User, Product, ProductInfo, Parameter,
+                           ProductParameter, StockReservation,
+                           IdempotencyKey)
+from orders.offers import refresh_offers
+from orders.renderers import FastJSONRenderer
+from orders.serializers import ProductParameterSerializer
+from orders.stock import apply_stock, lock_product_infos
+from orders.tasks import (cleanup_idempotency_keys_task, load_info_task,
+                          schedule_imports_task)
+from orders.views import (OrdersView, ProductSearchView, ProductsView,
+                          ShopOrders, empty_view)
+
+FEED_PATH = os.path.join(settings.BASE_DIR, '..', 'data', 'shop1.yaml')
+
+
+def read_feed():
+    """
+    Содержимое тестового прайс-листа data/shop1.yaml
+    """
+    with open(FEED_PATH, 'rb') as stream:
+        return stream.read()
+
+
+def create_shop_user(email='shop@mail.ru'):
+    return User.objects.create_user(email=email, password=12345,
+                                    type='shop', is_active=True)
+
+
+def create_buyer(email='buyer@mail.ru'):
+    return User.objects.create_user(email=email, password=12345,
+                                    is_active=True)
+
+
+class CatalogMixin:
+    """
+    Магазин user с прайс-листом data/shop1.yaml в data
+
+    При import_data = True прайс-лист загружается в базу. Кэш ответов
+    каталога очищается перед каждым тестом.
+    """
+    import_data = True
+
+    @classmethod
+    def create_catalog(cls):
+        cls.user = create_shop_user()
+        cls.data = load_yaml(read_feed(), Loader=SafeLoader)
+        if cls.import_data:
+            import_catalog(cls.data, cls.user.id)
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+class CatalogTestCase(CatalogMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_catalog()
+
+
+class CatalogTransactionTestCase(CatalogMixin, TransactionTestCase):
+    """
+    Каталог, который создается заново для каждого теста
+
+    Таблицы очищаются после теста, поэтому словари имен справочников
+    сбрасываются вместе с кэшем.
+    """
+
+    def setUp(self):
+        super().setUp()
+        parameter_cache.clear()
+        category_cache.clear()
+        self.create_catalog()
+
+    def tearDown(self):
+        cache.clear()
+        parameter_cache.clear()
+        category_cache.clear()
 
 
 class ViewLoadingTests(SimpleTestCase):
@@ -50,6 +158,9 @@ class ShopsViewTest(TestCase):
         for shop_num in range(number_of_shops):
             Shop.objects.create(name='Shop %s' % shop_num)
 
+    def setUp(self):
+        cache.clear()
+
     def test_view_url_exists_at_desired_location(self):
         resp = self.client.get('http://127.0.0.1:8000/api/shops')
         self.assertNotEqual(resp.status_code, 404)
@@ -74,6 +185,9 @@ class CategoriesViewTest(TestCase):
         for category_num in range(number_of_categories):
             Category.objects.create(name='Category %s' % category_num)
 
+    def setUp(self):
+        cache.clear()
+
     def test_view_url_exists_at_desired_location(self):
         resp = self.client.get('http://127.0.0.1:8000/api/categories')
         self.assertNotEqual(resp.status_code, 404)
@@ -98,6 +212,9 @@ class CategoriesViewTest(TestCase):
         for category_num in range(number_of_categories):
             Category.objects.create(name='Category %s' % category_num)
 
+    def setUp(self):
+        cache.clear()
+
     def test_view_url_exists_at_desired_location(self):
         resp = self.client.get('http://127.0.0.1:8000/api/categories')
         self.assertNotEqual(resp.status_code, 404)
@@ -225,6 +342,11 @@ class ProductViewTest(TestCase):
         ProductParameter.objects.create(product_info=cls.product_info_2,
                                         parameter=cls.parameter,
                                         value='Value')
+        # строки каталога обычно собирает загрузчик прайс-листов
+        refresh_offers([cls.product_info.id, cls.product_info_2.id])
+
+    def setUp(self):
+        cache.clear()
 
     def test_view_url_exists_at_desired_location(self):
         resp = self.client.get('http://127.0.0.1:8000/api/products')
@@ -238,5 +360,1457 @@ class ProductViewTest(TestCase):
         resp = self.client.get(reverse('orders:products'))
         self.assertEqual(resp.status_code, 200)
         resp_json = json.loads(resp.content)
-        self.assertEqual(len(resp_json), 2)
+        self.assertEqual(len(resp_json['results']), 2)
+
+    def test_cursor_pagination(self):
+        resp = self.client.get(reverse('orders:products'), {'limit': 1})
+        first = resp.json()
+        self.assertEqual([item['id'] for item in first['results']],
+                         [self.product_info.id])
+
+        resp = self.client.get(first['next'])
+        second = resp.json()
+        self.assertEqual([item['id'] for item in second['results']],
+                         [self.product_info_2.id])
+        self.assertIsNone(second['next'])
+
+    def test_query_string_filters(self):
+        resp = self.client.get(reverse('orders:products'),
+                               {'category': self.category_2.id})
+        self.assertEqual([item['id'] for item in resp.json()['results']],
+                         [self.product_info_2.id])
+
+    def test_invalid_cursor(self):
+        resp = self.client.get(reverse('orders:products'),
+                               {'cursor': 'broken'})
+        self.assertEqual(resp.status_code, 404)
+
+
+def import_in_process(data, user_id, results):
+    """
+    Загрузка с пулом разбора в дочернем процессе, итог - в очередь
+    """
+    try:
+        importer = import_catalog(data, user_id, workers=2)
+        results.put((True, importer.rows_parsed))
+    except Exception as exc:
+        results.put((False, repr(exc)))
+
+
+class ImportCatalogTest(CatalogTestCase):
+    import_data = False
+
+    def test_import_catalog(self):
+        importer = import_catalog(self.data, self.user.id)
+        self.assertEqual(importer.rows_parsed, len(self.data['goods']))
+        self.assertEqual(ProductInfo.objects.count(),
+                         len(self.data['goods']))
+        self.assertEqual(
+            ProductParameter.objects.count(),
+            sum(len(item['parameters']) for item in self.data['goods'])
+        )
+        self.assertEqual(Parameter.objects.count(), 4)
+        self.assertTrue(
+            Category.objects.filter(shops__name=self.data['shop']).exists()
+        )
+
+    def test_reimport_updates_in_place(self):
+        import_catalog(self.data, self.user.id)
+        item = self.data['goods'][0]
+
+        def change(goods, price):
+            return dict(goods, price=price, parameters=dict(
+                goods['parameters'], **{'Цвет': 'серый'}))
+
+        changed = dict(self.data, goods=[change(item, 1)] +
+                       self.data['goods'][1:])
+        with CaptureQueriesContext(connection) as one:
+            importer = import_catalog(changed, self.user.id)
+        self.assertEqual(importer.rows_inserted, 0)
+        self.assertEqual(importer.rows_updated, 1)
+        self.assertEqual(ProductInfo.objects.count(),
+                         len(self.data['goods']))
+        product_info = ProductInfo.objects.get(external_id=item['id'])
+        self.assertEqual(product_info.price, 1)
+        self.assertEqual(product_info.product_parameters.get(
+            parameter__name='Цвет').value, 'серый')
+
+        # число запросов не растет с числом измененных товаров
+        changed = dict(self.data, goods=[change(goods, 2)
+                                         for goods in self.data['goods']])
+        with CaptureQueriesContext(connection) as every:
+            importer = import_catalog(changed, self.user.id)
+        self.assertEqual(importer.rows_updated, len(self.data['goods']))
+        self.assertEqual(len(every), len(one))
+
+    def test_diff_mode(self):
+        import_catalog(self.data, self.user.id)
+        first, second, third, fourth = self.data['goods']
+        ordered = ProductInfo.objects.get(external_id=third['id'])
+        order = Order.objects.create(user=self.user, state='new')
+        OrderItem.objects.create(order=order, product_info=ordered,
+                                 quantity=1)
+        new_item = dict(first, id=1, name='Новый товар')
+        changed = dict(self.data, goods=[first, dict(second, quantity=0),
+                                         new_item])
+
+        importer = import_catalog(changed, self.user.id, mode='diff')
+        self.assertEqual(importer.rows_unchanged, 1)
+        self.assertEqual(importer.rows_updated, 1)
+        self.assertEqual(importer.rows_inserted, 1)
+        self.assertEqual(importer.rows_removed, 2)
+        self.assertFalse(
+            ProductInfo.objects.filter(external_id=fourth['id']).exists()
+        )
+        ordered.refresh_from_db()
+        self.assertEqual(ordered.quantity, 0)
+
+        importer = import_catalog(changed, self.user.id, mode='diff')
+        self.assertEqual(importer.rows_written, 0)
+        self.assertEqual(importer.rows_unchanged, 3)
+
+    def test_parallel_mode(self):
+        def snapshot():
+            return list(ProductInfo.objects.order_by(
+                'external_id'
+            ).values_list('external_id', 'product__name', 'price',
+                          'quantity', 'fingerprint'))
+
+        import_catalog(self.data, self.user.id)
+        expected = snapshot()
+        ProductInfo.objects.all().delete()
+
+        lines = [json.dumps({'shop': self.data['shop'],
+                             'categories': self.data['categories']})]
+        lines += [json.dumps(item) for item in self.data['goods']]
+        lines.insert(2, '{"id": ')
+        stream = io.BytesIO('\n'.join(lines).encode())
+        importer = import_feed(iter_feed(stream, 'jsonl', raw=True),
+                               self.user.id, batch_size=2, workers=2)
+
+        self.assertEqual(snapshot(), expected)
+        self.assertEqual(importer.rows_parsed, 5)
+        self.assertEqual(importer.rows_inserted, 4)
+        self.assertEqual(len(importer.errors), 1)
+        self.assertTrue(importer.errors[0].startswith('Строка 2:'))
+        self.assertEqual(set(importer.timings),
+                         {'parse', 'validate', 'write'})
+
+        # процесс пула prefork celery - демон, загрузка в нем идет
+        # последовательно
+        results = multiprocessing.get_context('fork').Queue()
+        process = multiprocessing.get_context('fork').Process(
+            target=import_in_process, args=(self.data, self.user.id, results),
+            daemon=True)
+        process.start()
+        process.join()
+        self.assertEqual(results.get(timeout=5), (True, 4))
+
+        # нераспознанная строка в режиме diff не снимает товар с продажи
+        del lines[2]
+        lines[2] = lines[2][:-1]
+        stream = io.BytesIO('\n'.join(lines).encode())
+        importer = import_feed(iter_feed(stream, 'jsonl', raw=True),
+                               self.user.id, batch_size=2, workers=2,
+                               mode='diff')
+
+        self.assertEqual(snapshot(), expected)
+        self.assertEqual(importer.rows_removed, 0)
+        self.assertEqual(len(importer.errors), 2)
+
+
+class ProductSearchTest(CatalogTestCase):
+
+    def search(self, query):
+        resp = self.client.get(reverse('orders:products-search'),
+                               {'q': query})
+        self.assertEqual(resp.status_code, 200)
+        return [ProductInfo.objects.get(id=item['id']).external_id
+                for item in resp.json()['results']]
+
+    def test_ranked_results(self):
+        found = self.search('iphone xs max')
+        self.assertEqual(found[0], 4216292)
+        self.assertEqual(len(found), 4)
+        self.assertEqual(self.search('XR красный')[0], 4216313)
+        self.assertEqual(set(self.search('1792x828')),
+                         {4216226, 4216313, 4672670})
+
+    def test_index_updated_by_import(self):
+        goods = [dict(self.data['goods'][0], name='Смартфон Xiaomi Mi 9')]
+        import_catalog(dict(self.data, goods=goods), self.user.id)
+        self.assertEqual(self.search('xiaomi'), [4216292])
+        self.assertEqual(self.search('золотистый'), [4216292])
+        # совпадение осталось только в модели, поэтому товар ниже других
+        self.assertEqual(self.search('apple')[-1], 4216292)
+
+    def test_query_required(self):
+        resp = self.client.get(reverse('orders:products-search'))
+        self.assertFalse(resp.json()['Status'])
+
+
+class FastSerializerTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.token = Token.objects.create(user=cls.user)
+        cls.buyer = create_buyer()
+        cls.buyer_token = Token.objects.create(user=cls.buyer)
+        contact = Contact.objects.create(user=cls.buyer, city='Москва',
+                                         street='Тверская', phone='+7000')
+        for state, contact in (('new', contact), ('confirmed', None)):
+            order = Order.objects.create(user=cls.buyer, state=state,
+                                         contact=contact)
+            for product_info in ProductInfo.objects.order_by('id')[:3]:
+                OrderItem.objects.create(order=order, quantity=2,
+                                         product_info=product_info)
+
+    def compare(self, view, url, params=None, **extra):
+        """
+        Ответы быстрого пути и вложенных сериализаторов побайтно равны
+        """
+        self.addCleanup(setattr, view, 'fast_serializer', True)
+        contents = []
+        for fast in (True, False):
+            view.fast_serializer = fast
+            cache.clear()
+            resp = self.client.get(url, params, **extra)
+            self.assertEqual(resp.status_code, 200)
+            contents.append(resp.content)
+        self.assertEqual(contents[0], contents[1])
+        return json.loads(contents[0])
+
+    def test_products(self):
+        data = self.compare(ProductsView, reverse('orders:products'),
+                            {'limit': 2})
+        self.assertEqual(len(data['results']), 2)
+        self.assertTrue(data['results'][0]['product_parameters'])
+        ids = {item['id'] for item in data['results']}
+        data = self.compare(ProductsView, data['next'])
+        self.assertTrue(data['results'])
+        self.assertFalse(ids & {item['id'] for item in data['results']})
+
+    def test_search(self):
+        data = self.compare(ProductSearchView,
+                            reverse('orders:products-search'),
+                            {'q': 'iphone'})
+        self.assertTrue(data['results'])
+
+    def test_orders(self):
+        data = self.compare(
+            OrdersView, reverse('orders:orders'),
+            HTTP_AUTHORIZATION=f'Token {self.buyer_token.key}'
+        )
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(len(data['results'][0]['ordered_items']), 3)
+        data = self.compare(ShopOrders, reverse('orders:partner-orders'),
+                            HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(len(data['results']), 2)
+
+    def test_sparse_fields(self):
+        url = reverse('orders:products')
+        data = self.compare(ProductsView, url, {'fields': 'id,price'})
+        self.assertEqual(list(data['results'][0]), ['id', 'price'])
+        data = self.compare(ProductSearchView,
+                            reverse('orders:products-search'),
+                            {'q': 'iphone', 'fields': 'id,product_parameters',
+                             'expand': 'product_parameters'})
+        self.assertEqual(list(data['results'][0]),
+                         ['id', 'product_parameters'])
+        data = self.compare(ProductsView, url, {'expand': ''})
+        self.assertNotIn('product_parameters', data['results'][0])
+
+        # без параметров товаров нет и запроса за ними
+        ProductsView.fast_serializer = False
+        self.addCleanup(setattr, ProductsView, 'fast_serializer', True)
+        with self.assertNumQueries(1):
+            self.client.get(url, {'fields': 'id,price'})
+
+        resp = self.client.get(url, {'fields': 'id,secret'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('secret', resp.json()['fields'])
+
+    def test_sparse_order_fields(self):
+        auth = {'HTTP_AUTHORIZATION': f'Token {self.buyer_token.key}'}
+        data = self.compare(OrdersView, reverse('orders:orders'),
+                            {'fields': 'id,state,total_sum'}, **auth)
+        self.assertEqual(list(data['results'][0]),
+                         ['id', 'state', 'total_sum'])
+        data = self.compare(OrdersView, reverse('orders:orders'),
+                            {'expand': 'contact'}, **auth)
+        self.assertEqual(list(data['results'][0]),
+                         ['id', 'state', 'dt', 'total_sum', 'contact'])
+        resp = self.client.get(reverse('orders:orders'),
+                               {'expand': 'shop'}, **auth)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_renderer(self):
+        data = {'name': 'Смартфон\u2028', 'items': [1, None, True],
+                'price': 1.5}
+        self.assertEqual(FastJSONRenderer().render(data),
+                         JSONRenderer().render(data))
+
+
+class CatalogOfferTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.token = Token.objects.create(user=cls.user)
+
+    def offer(self, external_id):
+        return CatalogOffer.objects.get(external_id=external_id)
+
+    def test_offers_built_by_import(self):
+        self.assertEqual(CatalogOffer.objects.count(),
+                         ProductInfo.objects.count())
+        item = self.data['goods'][0]
+        offer = self.offer(item['id'])
+        self.assertEqual(offer.product_name, item['name'])
+        self.assertEqual(offer.category_name, 'Смартфоны')
+        self.assertEqual(offer.shop_name, 'Евросеть')
+        self.assertEqual(dict(json.loads(offer.parameters)),
+                         {name: str(value) for name, value
+                          in item['parameters'].items()})
+
+    def test_offers_follow_import(self):
+        item = self.data['goods'][0]
+        categories = [dict(category, name=f'{category["name"]} и аксессуары')
+                      for category in self.data['categories']]
+        goods = [dict(item, price=1, parameters={'Цвет': 'серый'})]
+        import_catalog(dict(self.data, categories=categories, goods=goods),
+                       self.user.id, mode='diff')
+
+        offer = self.offer(item['id'])
+        self.assertEqual(offer.price, 1)
+        self.assertEqual(json.loads(offer.parameters), [['Цвет', 'серый']])
+        self.assertEqual(offer.category_name, 'Смартфоны и аксессуары')
+        self.assertEqual(CatalogOffer.objects.count(), 1)
+
+    def test_offers_follow_shop_state(self):
+        resp = self.client.put(reverse('orders:partner-state'),
+                               {'state': 'off'},
+                               content_type='application/json',
+                               HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertTrue(resp.json()['Status'])
+        self.assertFalse(CatalogOffer.objects.filter(shop_state=True).exists())
+        resp = self.client.get(reverse('orders:products'))
+        self.assertEqual(resp.json()['results'], [])
+
+    def test_rebuild_command(self):
+        CatalogOffer.objects.all().delete()
+        call_command('rebuild_catalog_offers', stdout=io.StringIO())
+        self.assertEqual(CatalogOffer.objects.count(),
+                         ProductInfo.objects.count())
+
+
+class CatalogExportTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.token = Token.objects.create(user=cls.user)
+
+    def export(self, **params):
+        resp = self.client.get(reverse('orders:products-export'), params,
+                               HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        return resp, b''.join(resp.streaming_content)
+
+    def test_ndjson(self):
+        resp, content = self.export()
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        offers = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(len(offers), len(self.data['goods']))
+        item = self.data['goods'][0]
+        offer = next(offer for offer in offers
+                     if offer['external_id'] == item['id'])
+        self.assertEqual(offer['product_name'], item['name'])
+        self.assertEqual(offer['parameters']['Цвет'],
+                         item['parameters']['Цвет'])
+
+    def test_csv_gzip(self):
+        resp, content = self.export(export_format='csv', gzip='true')
+        self.assertEqual(resp['Content-Type'], 'application/gzip')
+        self.assertIn('catalog.csv.gz', resp['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(
+            gzip.decompress(content).decode())))
+        self.assertEqual(len(rows), len(self.data['goods']))
+        self.assertEqual(
+            {int(row['external_id']) for row in rows},
+            {item['id'] for item in self.data['goods']}
+        )
+
+    def test_errors(self):
+        resp = self.client.get(reverse('orders:products-export'))
+        self.assertEqual(resp.status_code, 403)
+        resp = self.client.get(reverse('orders:products-export'),
+                               {'export_format': 'xml'},
+                               HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertFalse(resp.json()['Status'])
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'catalog.ndjson.gz')
+            call_command('export_catalog', output=path, gzip=True,
+                         category=224)
+            with gzip.open(path) as stream:
+                lines = stream.read().splitlines()
+        self.assertEqual(len(lines), len(
+            [item for item in self.data['goods'] if item['category'] == 224]
+        ))
+
+
+class BestOfferTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = create_shop_user('shop2@mail.ru')
+        cls.token = Token.objects.create(user=cls.other)
+
+        # второй магазин продает первый товар дешевле, второго нет
+        # в наличии
+        goods = cls.data['goods']
+        import_catalog(dict(cls.data, shop='Другой магазин', goods=[
+            dict(goods[0], price=goods[0]['price'] - 1000),
+            dict(goods[1], price=1, quantity=0),
+        ]), cls.other.id)
+        cls.product = ProductInfo.objects.filter(
+            external_id=goods[0]['id']).values_list(
+            'product_id', flat=True).first()
+
+    def best_offer(self):
+        resp = self.client.get(reverse('orders:product-best-offer',
+                                       args=[self.product]))
+        return resp.json()
+
+    def test_best_offer(self):
+        item = self.data['goods'][0]
+        offer = self.best_offer()
+        self.assertEqual(offer['min_price'], item['price'] - 1000)
+        self.assertEqual(offer['shops_in_stock'], 2)
+        self.assertEqual(offer['shop'],
+                         Shop.objects.get(user=self.other).id)
+
+    def test_category_sorted_by_price(self):
+        resp = self.client.get(reverse('orders:category-best-offers',
+                                       args=[224]), {'limit': 2})
+        data = resp.json()
+        prices = [offer['min_price'] for offer in data['results']]
+        resp = self.client.get(data['next'])
+        prices += [offer['min_price'] for offer in resp.json()['results']]
+        expected = sorted(item['price'] for item in self.data['goods']
+                          if item['category'] == 224)
+        expected[expected.index(self.data['goods'][0]['price'])] -= 1000
+        self.assertEqual(prices, sorted(expected))
+
+    def test_shop_state(self):
+        resp = self.client.put(reverse('orders:partner-state'),
+                               {'state': 'off'},
+                               content_type='application/json',
+                               HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertTrue(resp.json()['Status'])
+        # внутри TestCase версии кэша каталога не увеличиваются
+        cache.clear()
+        offer = self.best_offer()
+        self.assertEqual(offer['min_price'], self.data['goods'][0]['price'])
+        self.assertEqual(offer['shops_in_stock'], 1)
+
+    def test_out_of_stock(self):
+        ProductInfo.objects.filter(shop__user=self.user).update(quantity=0)
+        refresh_offers(ProductInfo.objects.values_list('id', flat=True))
+        self.assertEqual(self.best_offer()['shops_in_stock'], 1)
+        resp = self.client.get(reverse('orders:category-best-offers',
+                                       args=[224]))
+        self.assertEqual([offer['product'] for offer in
+                          resp.json()['results']], [self.product])
+
+
+class CartViewTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.buyer = create_buyer()
+        cls.token = Token.objects.create(user=cls.buyer)
+        cls.product_infos = list(ProductInfo.objects.order_by('id'))
+
+    def request(self, method, data):
+        return getattr(self.client, method)(
+            reverse('orders:cart'), data, content_type='application/json',
+            HTTP_AUTHORIZATION=f'Token {self.token.key}'
+        ).json()
+
+    def add(self, product_infos, quantity=1):
+        return self.request('post', {'items': [
+            {'product_info': product_info.id, 'quantity': quantity}
+            for product_info in product_infos
+        ]})
+
+    def cart_items(self):
+        return dict(OrderItem.objects.filter(
+            order__user=self.buyer, order__state='basket'
+        ).values_list('product_info_id', 'quantity'))
+
+    def test_add_batch(self):
+        self.assertTrue(self.add(self.product_infos[:1])['Status'])
+        with CaptureQueriesContext(connection) as single:
+            self.assertTrue(self.add(self.product_infos[1:2])['Status'])
+        with CaptureQueriesContext(connection) as batch:
+            self.assertTrue(self.add(self.product_infos[2:])['Status'])
+        # число запросов не зависит от числа позиций
+        self.assertEqual(len(batch), len(single))
+        self.assertEqual(len(self.cart_items()), len(self.product_infos))
+
+    def test_add_errors(self):
+        self.add(self.product_infos[:1])
+        product_info = self.product_infos[1]
+        resp = self.request('post', {'items': [
+            {'product_info': self.product_infos[0].id, 'quantity': 1},
+            {'product_info': product_info.id,
+             'quantity': product_info.quantity + 1},
+            {'product_info': 10 ** 6, 'quantity': 1},
+            {'product_info': self.product_infos[2].id, 'quantity': 1},
+        ]})
+        self.assertFalse(resp['Status'])
+        self.assertEqual([error['index'] for error in resp['Errors']],
+                         [0, 1, 2])
+        self.assertIn('недостаточное количество', resp['Errors'][1]['Error'])
+        # при ошибках корзина не меняется
+        self.assertEqual(list(self.cart_items()), [self.product_infos[0].id])
+
+    def test_legacy_string_body(self):
+        resp = self.client.post(
+            reverse('orders:cart'),
+            {'items': json.dumps([{'product_info': self.product_infos[0].id,
+                                   'quantity': 2}])},
+            HTTP_AUTHORIZATION=f'Token {self.token.key}'
+        )
+        self.assertTrue(resp.json()['Status'])
+        resp = self.request('post', {'items': "[{'product_info': 1}]"})
+        self.assertFalse(resp['Status'])
+
+    def test_update_and_delete(self):
+        self.add(self.product_infos[:3])
+        items = dict(OrderItem.objects.values_list('product_info_id', 'id'))
+        other = Order.objects.create(user=self.user, state='basket')
+        foreign = OrderItem.objects.create(
+            order=other, product_info=self.product_infos[3], quantity=1)
+
+        resp = self.request('put', {'items': [
+            {'id': items[self.product_infos[0].id], 'quantity': 2},
+            {'id': foreign.id, 'quantity': 2},
+        ]})
+        self.assertEqual(resp['Errors'], [{
+            'index': 1, 'Error': 'Нельзя вносить изменения не в свою корзину'
+        }])
+        resp = self.request('put', {'items': [
+            {'id': items[self.product_infos[0].id], 'quantity': 2},
+            {'id': items[self.product_infos[1].id], 'quantity': 3},
+        ]})
+        self.assertTrue(resp['Status'])
+        self.assertEqual(self.cart_items()[self.product_infos[1].id], 3)
+
+        resp = self.request('delete', {'order_items': [
+            items[self.product_infos[0].id], foreign.id]})
+        self.assertEqual(resp['Errors'][0]['index'], 1)
+        resp = self.request('delete', {'order_items': '{}, {}'.format(
+            items[self.product_infos[0].id], items[self.product_infos[1].id]
+        )})
+        self.assertTrue(resp['Status'])
+        self.assertEqual(list(self.cart_items()), [self.product_infos[2].id])
+
+    def assertTotals(self):
+        cart = Order.objects.get(user=self.buyer, state='basket')
+        items = cart.ordered_items.all()
+        self.assertEqual(cart.total_sum, sum(item.quantity * item.price
+                                             for item in items))
+        self.assertEqual(cart.items_count, len(items))
+        return cart
+
+    def test_totals(self):
+        self.add(self.product_infos[:3], quantity=2)
+        cart = self.assertTotals()
+        self.assertEqual(cart.total_sum, 2 * sum(
+            product_info.price for product_info in self.product_infos[:3]))
+
+        # изменение количества обновляет цену позиции до текущей
+        ProductInfo.objects.filter(id=self.product_infos[0].id).update(
+            price=1)
+        item = cart.ordered_items.get(product_info=self.product_infos[0])
+        self.request('put', {'items': [{'id': item.id, 'quantity': 3}]})
+        self.assertEqual(OrderItem.objects.get(id=item.id).price, 1)
+        self.assertTotals()
+
+        self.request('delete', {'order_items': [item.id]})
+        cart = self.assertTotals()
+        self.assertEqual(cart.items_count, 2)
+
+        Order.objects.filter(id=cart.id).update(total_sum=0, items_count=0)
+        call_command('recalculate_order_totals', stdout=io.StringIO())
+        self.assertTotals()
+
+
+class OrderHistoryTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.token = Token.objects.create(user=cls.user)
+        cls.buyer = create_buyer()
+        cls.buyer_token = Token.objects.create(user=cls.buyer)
+        product_infos = list(ProductInfo.objects.order_by('id')[:3])
+        start = timezone.now() - timedelta(days=10)
+        cls.orders = []
+        for number in range(6):
+            order = Order.objects.create(
+                user=cls.buyer, state=('new', 'delivered')[number % 2])
+            # одинаковая дата у пары заказов проверяет второй ключ курсора
+            Order.objects.filter(id=order.id).update(
+                dt=start + timedelta(days=number // 2 * 2))
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product_info=product_info,
+                          quantity=1, price=product_info.price)
+                for product_info in product_infos[:number % 3 + 1]
+            ])
+            cls.orders.append(order)
+        cls.start = start
+
+    def pages(self, url, token, params=None):
+        ids = []
+        data = self.client.get(url, params,
+                               HTTP_AUTHORIZATION=f'Token {token}').json()
+        ids.extend(order['id'] for order in data['results'])
+        while data['next']:
+            data = self.client.get(
+                data['next'], HTTP_AUTHORIZATION=f'Token {token}').json()
+            ids.extend(order['id'] for order in data['results'])
+        return ids
+
+    def test_keyset_pages(self):
+        expected = [order.id for order in reversed(self.orders)]
+        for view in (OrdersView, ShopOrders):
+            self.addCleanup(setattr, view, 'fast_serializer', True)
+            for fast in (True, False):
+                view.fast_serializer = fast
+                self.assertEqual(self.pages(reverse('orders:orders'),
+                                            self.buyer_token.key,
+                                            {'limit': 2}), expected)
+                self.assertEqual(self.pages(reverse('orders:partner-orders'),
+                                            self.token.key,
+                                            {'limit': 4}), expected)
+
+    def test_shop_sees_own_total(self):
+        other = create_shop_user('other@mail.ru')
+        shop = Shop.objects.create(name='Связной', user=other)
+        own = ProductInfo.objects.order_by('id').first()
+        foreign = ProductInfo.objects.create(
+            product=own.product, shop=shop, external_id=own.external_id,
+            model=own.model, quantity=5, price=own.price * 2,
+            price_rrc=own.price * 2)
+        order = self.orders[0]
+        OrderItem.objects.create(order=order, product_info=foreign,
+                                 quantity=1, price=foreign.price)
+        Order.objects.filter(id=order.id).update(
+            total_sum=own.price + foreign.price)
+
+        self.addCleanup(setattr, ShopOrders, 'fast_serializer', True)
+        for fast in (True, False):
+            ShopOrders.fast_serializer = fast
+            data = self.client.get(
+                reverse('orders:partner-orders'), {'limit': 10},
+                HTTP_AUTHORIZATION=f'Token {self.token.key}').json()
+            totals = {row['id']: row['total_sum'] for row in data['results']}
+            self.assertEqual(totals[order.id], own.price)
+
+    def test_filters(self):
+        url = reverse('orders:orders')
+        token = self.buyer_token.key
+        self.assertEqual(
+            self.pages(url, token, {'state': 'delivered'}),
+            [order.id for order in reversed(self.orders[1::2])]
+        )
+        day = (self.start + timedelta(days=2)).date().isoformat()
+        self.assertEqual(
+            self.pages(url, token, {'date_from': day, 'date_to': day}),
+            [self.orders[3].id, self.orders[2].id]
+        )
+        resp = self.client.get(url, {'state': 'lost'},
+                               HTTP_AUTHORIZATION=f'Token {token}')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(url, {'date_from': 'вчера'},
+                               HTTP_AUTHORIZATION=f'Token {token}')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_query_count_constant(self):
+        auth = {'HTTP_AUTHORIZATION': f'Token {self.buyer_token.key}'}
+        self.addCleanup(setattr, OrdersView, 'fast_serializer', True)
+        for fast in (True, False):
+            OrdersView.fast_serializer = fast
+            counts = []
+            for limit in (1, 6):
+                with CaptureQueriesContext(connection) as queries:
+                    self.client.get(reverse('orders:orders'),
+                                    {'limit': limit}, **auth)
+                counts.append(len(queries))
+            self.assertEqual(counts[0], counts[1])
+
+
+class CheckoutTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.buyer = create_buyer()
+        cls.token = Token.objects.create(user=cls.buyer)
+        cls.contact = Contact.objects.create(user=cls.buyer, city='Москва',
+                                             street='Тверская',
+                                             phone='+7000')
+        cls.product_infos = list(ProductInfo.objects.order_by('id')[:2])
+
+    def setUp(self):
+        super().setUp()
+        self.cart = Order.objects.create(user=self.buyer, state='basket')
+        for product_info in self.product_infos:
+            OrderItem.objects.create(order=self.cart, quantity=2,
+                                     product_info=product_info)
+
+    def request(self, method, data):
+        return getattr(self.client, method)(
+            reverse('orders:order'), data, content_type='application/json',
+            HTTP_AUTHORIZATION=f'Token {self.token.key}'
+        ).json()
+
+    def checkout(self):
+        return self.request('post', {'id': self.cart.id,
+                                     'contact_id': self.contact.id})
+
+    def stock(self):
+        return [ProductInfo.objects.get(id=product_info.id).quantity
+                for product_info in self.product_infos]
+
+    def test_checkout_reserves_stock(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.checkout()['Status'])
+        # товар остался в наличии, лучшие предложения не пересчитываются
+        self.assertFalse([query for query in queries
+                          if 'orders_bestoffer' in query['sql']])
+        self.assertEqual(self.stock(), [product_info.quantity - 2 for
+                                        product_info in self.product_infos])
+        self.assertEqual(StockReservation.objects.filter(
+            order=self.cart, released_at=None).count(), 2)
+        self.assertEqual(Order.objects.get(id=self.cart.id).state, 'new')
+        # каталог показывает остаток после резервирования
+        self.assertEqual(
+            CatalogOffer.objects.get(pk=self.product_infos[0].id).quantity,
+            self.product_infos[0].quantity - 2
+        )
+        # корзина уже оформлена
+        self.assertFalse(self.checkout()['Status'])
+
+    def test_sold_out_leaves_best_offer(self):
+        product_info = self.product_infos[0]
+        OrderItem.objects.filter(order=self.cart,
+                                 product_info=product_info).update(
+            quantity=product_info.quantity)
+        self.assertTrue(self.checkout()['Status'])
+        self.assertEqual(CatalogOffer.objects.get(pk=product_info.id).quantity,
+                         0)
+        self.assertFalse(BestOffer.objects.filter(
+            product_info=product_info).exists())
+
+        self.request('delete', {'id': self.cart.id})
+        self.assertTrue(BestOffer.objects.filter(
+            product_id=product_info.product_id).exists())
+
+    def test_price_snapshot(self):
+        ProductInfo.objects.filter(id=self.product_infos[0].id).update(
+            price=1)
+        self.checkout()
+        order = Order.objects.get(id=self.cart.id)
+        self.assertEqual(order.total_sum,
+                         2 + 2 * self.product_infos[1].price)
+        self.assertEqual(order.items_count, 2)
+
+        # последующая смена цен не меняет оформленный заказ
+        ProductInfo.objects.update(price=10 ** 6)
+        resp = self.client.get(
+            reverse('orders:orders'), {'expand': 'ordered_items'},
+            HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        data = resp.json()['results'][0]
+        self.assertEqual(data['total_sum'], order.total_sum)
+        self.assertEqual([item['price'] for item in data['ordered_items']],
+                         [1, self.product_infos[1].price])
+
+    def test_insufficient_stock(self):
+        ProductInfo.objects.filter(id=self.product_infos[1].id).update(
+            quantity=1)
+        resp = self.checkout()
+        self.assertFalse(resp['Status'])
+        self.assertEqual(len(resp['Errors']), 1)
+        self.assertIn('недостаточное количество', resp['Errors'][0]['Error'])
+        self.assertEqual(self.stock(), [self.product_infos[0].quantity, 1])
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(Order.objects.get(id=self.cart.id).state, 'basket')
+
+    def test_cancel_releases_stock(self):
+        self.checkout()
+        self.assertTrue(self.request('delete', {'id': self.cart.id})['Status'])
+        self.assertEqual(self.stock(), [product_info.quantity for
+                                        product_info in self.product_infos])
+        self.assertEqual(Order.objects.get(id=self.cart.id).state,
+                         'canceled')
+        self.assertFalse(StockReservation.objects.filter(
+            released_at=None).exists())
+        # повторная отмена не возвращает товар второй раз
+        self.assertFalse(self.request('delete', {'id': self.cart.id})[
+            'Status'])
+        self.assertEqual(self.stock(), [product_info.quantity for
+                                        product_info in self.product_infos])
+
+
+class IdempotencyTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.buyer = create_buyer()
+        cls.token = Token.objects.create(user=cls.buyer)
+        cls.contact = Contact.objects.create(user=cls.buyer, city='Москва',
+                                             street='Тверская',
+                                             phone='+7000')
+        cls.product_info = ProductInfo.objects.order_by('id').first()
+
+    def request(self, method, name, data, key):
+        return getattr(self.client, method)(
+            reverse(name), data, content_type='application/json',
+            HTTP_AUTHORIZATION=f'Token {self.token.key}',
+            HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def add(self, key, quantity=1):
+        return self.request('post', 'orders:cart', {'items': [
+            {'product_info': self.product_info.id, 'quantity': quantity}
+        ]}, key)
+
+    def test_cart_retry_replayed(self):
+        first = self.add('cart-1')
+        self.assertTrue(first.json()['Status'])
+        self.assertNotIn(REPLAYED_HEADER, first)
+        with self.assertNumQueries(2):
+            # авторизация и чтение сохраненного ответа
+            retry = self.add('cart-1')
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(retry[REPLAYED_HEADER], 'true')
+        cart = Order.objects.get(user=self.buyer, state='basket')
+        self.assertEqual(cart.items_count, 1)
+
+        # тот же ключ с другим телом - ошибка клиента
+        self.assertEqual(self.add('cart-1', quantity=2).status_code, 422)
+        # без ключа повтор выполняется заново
+        self.assertFalse(self.add('').json()['Status'])
+
+    def test_checkout_retry_replayed(self):
+        self.add('cart-1')
+        cart = Order.objects.get(user=self.buyer, state='basket')
+        data = {'id': cart.id, 'contact_id': self.contact.id}
+        first = self.request('post', 'orders:order', data, 'order-1')
+        self.assertTrue(first.json()['Status'])
+        sent = len(mail.outbox)
+        retry = self.request('post', 'orders:order', data, 'order-1')
+        self.assertEqual(retry.json(), {'Status': True})
+        self.assertEqual(len(mail.outbox), sent)
+        self.assertEqual(StockReservation.objects.count(), 1)
+
+    def test_stuck_claim_reclaimed_after_lease(self):
+        self.add('cart-1')
+        # процесс убит после занятия ключа, ответ не сохранен
+        IdempotencyKey.objects.update(status_code=None, content='')
+        self.assertEqual(self.add('cart-1').status_code, 409)
+
+        IdempotencyKey.objects.update(
+            created_at=timezone.now() - settings.IDEMPOTENCY_KEY_LEASE -
+            timedelta(seconds=1))
+        resp = self.add('cart-1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn(REPLAYED_HEADER, resp)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, 200)
+        # повтор после завершения получает сохраненный ответ
+        self.assertEqual(self.add('cart-1')[REPLAYED_HEADER], 'true')
+
+    def test_cleanup(self):
+        self.add('cart-1')
+        IdempotencyKey.objects.update(
+            created_at=timezone.now() - settings.IDEMPOTENCY_KEY_TTL -
+            timedelta(minutes=1))
+        # истекший ключ не повторяет ответ
+        self.assertNotIn(REPLAYED_HEADER, self.add('cart-1'))
+        IdempotencyKey.objects.update(
+            created_at=timezone.now() - settings.IDEMPOTENCY_KEY_TTL -
+            timedelta(minutes=1))
+        self.assertEqual(cleanup_idempotency_keys_task(), 1)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class FacetTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.token = Token.objects.create(user=cls.user)
+
+    def facets(self):
+        resp = self.client.get(reverse('orders:category-facets',
+                                       args=[224]))
+        return {facet['parameter']: {value['value']: value['count']
+                                     for value in facet['values']}
+                for facet in resp.json()}
+
+    def test_parameter_filter(self):
+        resp = self.client.get(reverse('orders:products'), {
+            'param[Встроенная память (Гб)]': '256',
+        })
+        self.assertEqual(len(resp.json()['results']), 3)
+
+        resp = self.client.get(reverse('orders:products'), {
+            'param[Встроенная память (Гб)]': '256',
+            'param[Цвет]': ['красный', 'синий'],
+        })
+        self.assertEqual(
+            sorted(item['external_id'] for item in resp.json()['results']),
+            [4216313, 4672670]
+        )
+
+        resp = self.client.get(reverse('orders:products'),
+                               {'param[Вес]': '1'})
+        self.assertEqual(resp.json()['results'], [])
+
+    def test_facets_refreshed_by_import(self):
+        facets = self.facets()
+        self.assertEqual(facets['Встроенная память (Гб)'],
+                         {'256': 3, '512': 1})
+        self.assertEqual(facets['Цвет']['красный'], 1)
+
+        item = self.data['goods'][1]
+        goods = [dict(item, parameters=dict(item['parameters'],
+                                            **{'Цвет': 'синий'}))]
+        import_catalog(dict(self.data, goods=goods), self.user.id)
+        # внутри TestCase on_commit не срабатывает и версии кэша каталога
+        # не увеличиваются, поэтому кэш сбрасывается вручную
+        cache.clear()
+        facets = self.facets()
+        self.assertNotIn('красный', facets['Цвет'])
+        self.assertEqual(facets['Цвет']['синий'], 2)
+
+    def test_facets_follow_shop_state(self):
+        resp = self.client.put(reverse('orders:partner-state'),
+                               {'state': 'off'},
+                               content_type='application/json',
+                               HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertTrue(resp.json()['Status'])
+        self.assertEqual(self.facets(), {})
+
+    def counts(self):
+        return sorted(FacetCount.objects.values_list(
+            'category_id', 'parameter_id', 'value', 'count'))
+
+    def test_deltas_match_full_recount(self):
+        expected = self.counts()
+        # повторное выключение не вычитает строки магазина второй раз
+        for state in ('off', 'off', 'on'):
+            self.client.put(reverse('orders:partner-state'),
+                            {'state': state},
+                            content_type='application/json',
+                            HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(self.counts(), expected)
+
+        item = self.data['goods'][0]
+        goods = [dict(item, parameters={'Цвет': 'серый'})]
+        goods += self.data['goods'][2:]
+        import_catalog(dict(self.data, goods=goods), self.user.id,
+                       mode='diff')
+        counts = self.counts()
+        call_command('rebuild_facets', stdout=io.StringIO())
+        self.assertEqual(counts, self.counts())
+
+    def test_prices_only_import_keeps_facets(self):
+        goods = [dict(item, price=item['price'] + 1)
+                 for item in self.data['goods']]
+        with CaptureQueriesContext(connection) as queries:
+            import_catalog(dict(self.data, goods=goods), self.user.id)
+        self.assertFalse([query for query in queries
+                          if 'orders_facetcount' in query['sql']])
+
+
+def bump_category(category_id):
+    """
+    Смена версии категории в отдельном процессе, как при загрузке
+    прайс-листа воркером celery
+    """
+    bump_catalog(category_ids=[category_id])
+
+
+class CatalogCacheTest(CatalogTransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.token = Token.objects.create(user=self.user)
+
+    def get(self, name, *args, **params):
+        return self.client.get(reverse(name, args=args), params)
+
+    def test_hits_and_precise_invalidation(self):
+        other = Category.objects.create(id=2, name='Ноутбуки')
+        self.assertEqual(self.get('orders:products')['X-Cache'], 'MISS')
+        self.assertEqual(self.get('orders:products')['X-Cache'], 'HIT')
+        self.assertEqual(
+            self.get('orders:products', category=other.id)['X-Cache'], 'MISS'
+        )
+        self.assertEqual(cache_stats(), {'hits': 1, 'misses': 2})
+
+        goods = [dict(self.data['goods'][0], price=1)]
+        import_catalog(dict(self.data, goods=goods), self.user.id)
+
+        resp = self.get('orders:products')
+        self.assertEqual(resp['X-Cache'], 'MISS')
+        self.assertIn(1, [item['price'] for item in resp.json()['results']])
+        # категория не из прайс-листа магазина осталась в кэше
+        self.assertEqual(
+            self.get('orders:products', category=other.id)['X-Cache'], 'HIT'
+        )
+
+    def test_stock_change_invalidates_products(self):
+        product_info = ProductInfo.objects.filter(quantity__gt=1).first()
+        self.get('orders:products')
+        self.get('orders:categories')
+
+        with transaction.atomic():
+            apply_stock(lock_product_infos([product_info.id]),
+                        {product_info.id: 1 - product_info.quantity})
+
+        resp = self.get('orders:products')
+        self.assertEqual(resp['X-Cache'], 'MISS')
+        self.assertIn(
+            {'id': product_info.id, 'quantity': 1},
+            [{'id': item['id'], 'quantity': item['quantity']}
+             for item in resp.json()['results']]
+        )
+        self.assertEqual(self.get('orders:categories')['X-Cache'], 'HIT')
+
+    def test_etag(self):
+        resp = self.get('orders:categories')
+        etag = resp['ETag']
+        with self.assertNumQueries(0):
+            resp = self.client.get(reverse('orders:categories'),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+
+        product = Product.objects.first()
+        resp = self.get('orders:product_info', product.id)
+        product_etag = resp['ETag']
+        with self.assertNumQueries(1):
+            resp = self.client.get(
+                reverse('orders:product_info', args=[product.id]),
+                HTTP_IF_NONE_MATCH=product_etag
+            )
+        self.assertEqual(resp.status_code, 304)
+
+        goods = [dict(self.data['goods'][0], price=1)]
+        import_catalog(dict(self.data, goods=goods), self.user.id)
+        for name, args, old in (('orders:categories', [], etag),
+                                ('orders:product_info', [product.id],
+                                 product_etag)):
+            resp = self.client.get(reverse(name, args=args),
+                                   HTTP_IF_NONE_MATCH=old)
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp['ETag'], old)
+
+    def test_etag_follows_other_process(self):
+        product = Product.objects.first()
+        url = reverse('orders:product_info', args=[product.id])
+        with tempfile.TemporaryDirectory() as directory, self.settings(
+                CACHES={'default': {
+                    'BACKEND': 'django.core.cache.backends.filebased.'
+                               'FileBasedCache',
+                    'LOCATION': directory,
+                }}):
+            etag = self.client.get(url)['ETag']
+            with ProcessPoolExecutor(1) as executor:
+                executor.submit(bump_category, product.category_id).result()
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+
+    def test_state_change_invalidates(self):
+        product = Product.objects.first()
+        self.assertEqual(
+            self.get('orders:product_info', product.id)['X-Cache'], 'MISS'
+        )
+        self.client.put(reverse('orders:partner-state'), {'state': 'off'},
+                        content_type='application/json',
+                        HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        resp = self.get('orders:product_info', product.id)
+        self.assertEqual(resp['X-Cache'], 'MISS')
+        self.assertEqual(resp.json()['product_infos'], [])
+
+
+class NameCacheTest(CatalogTransactionTestCase):
+    import_data = False
+
+    def test_steady_state_without_lookups(self):
+        import_catalog(self.data, self.user.id)
+        self.assertIn('Цвет', parameter_cache.ids)
+        self.assertEqual(
+            category_cache.get_names([self.data['categories'][0]['id']]),
+            {self.data['categories'][0]['id']:
+                self.data['categories'][0]['name']}
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            import_catalog(self.data, self.user.id)
+        tables = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertNotIn('orders_parameter"', tables)
+        # категории прайс-листа читаются из базы одним запросом
+        self.assertEqual(tables.count('FROM "orders_category"'), 1)
+
+        product_parameter = ProductParameter.objects.first()
+        with self.assertNumQueries(0):
+            data = ProductParameterSerializer(product_parameter).data
+        self.assertEqual(data['parameter'],
+                         {'name': product_parameter.parameter.name})
+
+    def test_stale_category_name_renamed(self):
+        import_catalog(self.data, self.user.id)
+        category = self.data['categories'][0]
+        # переименование другим процессом, кэш этого процесса устарел
+        Category.objects.filter(id=category['id']).update(name='Другое')
+
+        import_catalog(self.data, self.user.id)
+        self.assertEqual(Category.objects.get(id=category['id']).name,
+                         category['name'])
+
+    def test_renamed_category_in_rebuilt_offers(self):
+        import_catalog(self.data, self.user.id)
+        categories = [dict(category, name=f'{category["name"]} и аксессуары')
+                      for category in self.data['categories']]
+        goods = [dict(self.data['goods'][0], price=1)] + self.data['goods'][1:]
+        import_catalog(dict(self.data, categories=categories, goods=goods),
+                       self.user.id)
+
+        names = {category['id']: category['name'] for category in categories}
+        self.assertEqual(
+            set(CatalogOffer.objects.values_list('category_id',
+                                                 'category_name')),
+            {(item['category'], names[item['category']])
+             for item in self.data['goods']}
+        )
+
+    def test_rolled_back_rows_not_cached(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            parameter_cache.get_ids(['Новый параметр'], create=True)
+            raise RuntimeError
+        self.assertNotIn('Новый параметр', parameter_cache.ids)
+        self.assertFalse(Parameter.objects.filter(
+            name='Новый параметр').exists())
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    """
+    Сервер поставщика: отдает прайс-листы с ETag и поддержкой 304
+    """
+    feeds = {}
+    requests = []
+    # пути, ответ по которым обрывается на середине тела
+    truncated = set()
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        content, content_type = self.feeds[self.path]
+        etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip.compress(content)
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if self.path in self.truncated:
+            content = content[:len(content) // 2]
+            self.close_connection = True
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class LoadInfoTaskTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                         FeedRequestHandler)
+        threading.Thread(target=cls.server.serve_forever,
+                         daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_shop_user()
+        cls.token = Token.objects.create(user=cls.user)
+        cls.feed = read_feed()
+
+    def setUp(self):
+        FeedRequestHandler.requests = []
+
+    def run_job(self, content, path='/shop1.yaml',
+                content_type='application/x-yaml'):
+        FeedRequestHandler.feeds[path] = (content, content_type)
+        host, port = self.server.server_address
+        job = ImportJob.objects.create(user=self.user,
+                                       url=f'http://{host}:{port}{path}')
+        load_info_task(job.id)
+        job.refresh_from_db()
+        return job
+
+    def test_job_done(self):
+        job = self.run_job(self.feed)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.rows_parsed, 4)
+        self.assertEqual(job.rows_written, 4)
+        self.assertEqual(job.shop.name, 'Евросеть')
+        self.assertIsNotNone(job.elapsed)
+
+        resp = self.client.get(
+            reverse('orders:partner-update-status', args=[job.id]),
+            HTTP_AUTHORIZATION=f'Token {self.token.key}'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['state'], 'done')
+        self.assertEqual(resp.data['rows_written'], 4)
+        self.assertEqual(resp.data['errors'], [])
+
+    def test_invalid_rows_reported(self):
+        content = self.feed.replace(b'price: 120000', b'price: free')
+        job = self.run_job(content)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.rows_written, 3)
+        self.assertEqual(len(job.errors.splitlines()), 1)
+
+    def test_unchanged_feed_skipped(self):
+        self.assertEqual(self.run_job(self.feed).state, 'done')
+        job = self.run_job(self.feed)
+        self.assertEqual(job.state, 'skipped')
+        self.assertEqual(FeedRequestHandler.requests[-1]['If-None-Match'],
+                         FeedSource.objects.get(user=self.user).etag)
+
+    def test_gzip_feed(self):
+        content = gzip.compress(self.feed)
+        job = self.run_job(content, path='/shop1.yaml.gz',
+                           content_type='application/gzip')
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.rows_written, 4)
+
+    def test_truncated_download_removed(self):
+        FeedRequestHandler.truncated.add('/truncated.yaml')
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(FEED_SPOOL_DIR=directory):
+            job = self.run_job(self.feed, path='/truncated.yaml')
+            self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(job.state, 'failed')
+
+    def test_uploaded_feed(self):
+        upload = SimpleUploadedFile('shop1.yaml.gz', gzip.compress(self.feed),
+                                    content_type='application/gzip')
+        resp = self.client.post(
+            reverse('orders:partner-update'), {'file': upload},
+            HTTP_AUTHORIZATION=f'Token {self.token.key}'
+        )
+        self.assertTrue(resp.json()['Status'])
+        job = ImportJob.objects.get(id=resp.json()['Job'])
+        self.assertTrue(job.feed_file.endswith('.yaml.gz'))
+
+        load_info_task(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.rows_written, 4)
+        self.assertFalse(os.path.exists(job.feed_file))
+        self.assertFalse(FeedSource.objects.exists())
+
+
+class FeedParserTest(SimpleTestCase):
+
+    def setUp(self):
+        self.feed = read_feed()
+        self.data = load_yaml(self.feed, Loader=SafeLoader)
+
+    def test_yaml_stream_matches_full_load(self):
+        records = list(iter_feed(io.BytesIO(self.feed), 'yaml'))
+        self.assertEqual(records, list(iter_parsed_feed(self.data)))
+
+    def test_yaml_shop_after_categories(self):
+        content = dump_yaml({'categories': self.data['categories'],
+                             'shop': self.data['shop'],
+                             'goods': self.data['goods']},
+                            allow_unicode=True, sort_keys=False)
+        records = list(iter_feed(io.BytesIO(content.encode()), 'yaml'))
+        self.assertEqual(records, list(iter_parsed_feed(self.data)))
+
+        content = dump_yaml({'goods': self.data['goods'],
+                             'shop': self.data['shop']},
+                            allow_unicode=True, sort_keys=False)
+        with self.assertRaises(FeedError):
+            list(iter_feed(io.BytesIO(content.encode()), 'yaml'))
+
+    def test_jsonl_stream(self):
+        lines = [json.dumps({'shop': self.data['shop'],
+                             'categories': self.data['categories']})]
+        lines += [json.dumps(item) for item in self.data['goods']]
+        stream = io.BytesIO('\n'.join(lines).encode())
+        records = list(iter_feed(stream, detect_format('feed.jsonl')))
+        self.assertEqual(records, list(iter_parsed_feed(self.data)))
+
+    @skipIf(msgpack is None, 'msgpack не установлен')
+    def test_msgpack_stream(self):
+        stream = io.BytesIO()
+        stream.write(msgpack.packb({'shop': self.data['shop'],
+                                    'categories': self.data['categories']}))
+        for item in self.data['goods']:
+            stream.write(msgpack.packb(item))
+        stream.seek(0)
+        records = list(iter_feed(stream, detect_format('feed.msgpack')))
+        self.assertEqual(records, list(iter_parsed_feed(self.data)))
+
+    def test_csv_stream(self):
+        names = {category['id']: category['name']
+                 for category in self.data['categories']}
+        content = io.StringIO()
+        writer = csv.writer(content)
+        writer.writerow(['shop', 'category', 'category_name', 'id', 'model',
+                         'name', 'price', 'price_rrc', 'quantity',
+                         'parameters'])
+        for item in self.data['goods']:
+            writer.writerow([
+                self.data['shop'], item['category'], names[item['category']],
+                item['id'], item['model'], item['name'], item['price'],
+                item['price_rrc'], item['quantity'],
+                json.dumps(item['parameters'], ensure_ascii=False)
+            ])
+        stream = io.BytesIO(content.getvalue().encode())
+        records = list(iter_feed(stream, detect_format('feed.csv')))
+
+        self.assertEqual(records[0], ('shop', self.data['shop']))
+        self.assertEqual(
+            [value for kind, value in records if kind == 'goods'],
+            self.data['goods']
+        )
+        for kind, value in records:
+            if kind == 'category':
+                self.assertIn(value, self.data['categories'])
+
+    def test_aliases_rejected(self):
+        stream = io.BytesIO(b'shop: &name Shop\ngoods:\n  - *name\n')
+        with self.assertRaises(FeedError):
+            list(iter_feed(stream))
+
+
+class ScheduleImportsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for number in range(3):
+            user = create_shop_user(f'shop{number}@mail.ru')
+            Shop.objects.create(name=f'Shop {number}', user=user,
+                                feed_url=f'http://127.0.0.1/{number}.yaml',
+                                feed_interval=60)
+        Shop.objects.create(name='Manual shop')
+
+    @override_settings(IMPORT_MAX_CONCURRENCY=2)
+    def test_global_limit(self):
+        self.assertEqual(schedule_imports_task(), 2)
+        self.assertEqual(ImportJob.objects.count(), 2)
+        self.assertEqual(schedule_imports_task(), 0)
+
+    def test_one_import_per_shop(self):
+        self.assertEqual(schedule_imports_task(), 3)
+        Shop.objects.update(feed_checked_at=None)
+        self.assertEqual(schedule_imports_task(), 0)
+        self.assertEqual(ImportJob.objects.count(), 3)
+
+        user = User.objects.get(email='shop0@mail.ru')
+        token = Token.objects.create(user=user)
+        resp = self.client.post(reverse('orders:partner-update'),
+                                data={'url': 'http://127.0.0.1/0.yaml'},
+                                HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.assertFalse(json.loads(resp.content)['Status'])
+
+    def test_interval(self):
+        schedule_imports_task()
+        ImportJob.objects.update(state='done')
+        self.assertEqual(schedule_imports_task(), 0)
+        Shop.objects.update(
+            feed_checked_at=timezone.now() - timedelta(minutes=61)
+        )
+        self.assertEqual(schedule_imports_task(), 3)
+
+
+class ImportBenchmarkTest(TestCase):
+
+    def test_generated_feeds(self):
+        user = create_shop_user()
+        formats = ['yaml', 'jsonl', 'csv']
+        if msgpack is not None:
+            formats.append('msgpack')
+        for feed_format in formats:
+            with tempfile.NamedTemporaryFile(delete=False) as stream:
+                write_feed(stream, 50, categories=3, parameters=5,
+                           feed_format=feed_format)
+            try:
+                result = measure_import(stream.name, feed_format, user.id)
+            finally:
+                os.remove(stream.name)
+            self.assertEqual(result['rows'], 50)
+            self.assertEqual(ProductInfo.objects.count(), 50)
+            self.assertEqual(ProductParameter.objects.count(), 250)
+
+    def test_memory_measured_per_run(self):
+        user = create_shop_user()
+        peaks = []
+        for goods in (1000, 10):
+            with tempfile.NamedTemporaryFile(delete=False) as stream:
+                write_feed(stream, goods, feed_format='jsonl')
+            try:
+                peaks.append(measure_import(stream.name, 'jsonl',
+                                            user.id)['peak_memory_mb'])
+            finally:
+                os.remove(stream.name)
+        # малый прайс-лист после большого не наследует его пик
+        self.assertLess(peaks[1], peaks[0])
 
+    def test_generate_feed_formats(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'feed.csv')
+            call_command('generate_feed', path, goods=5, categories=2,
+                         stdout=io.StringIO())
+            with open(path, 'rb') as stream:
+                records = list(iter_feed(stream, detect_format(path)))
+        self.assertEqual(records[0], ('shop', 'Benchmark'))
+        self.assertEqual(
+            [value['id'] for kind, value in records if kind == 'goods'],
+            [1, 2, 3, 4, 5]
+        )
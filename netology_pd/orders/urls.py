@@ -1,11 +1,15 @@
 from django.urls import path
 from rest_framework import renderers
 
-from orders.views import (CategoriesView, CartView, ConfirmAccountView,
-                          ContactView, LoadInfo, LoginView, OrderView,
-                          OrdersView, RegisterView, PasswordConfirmView,
-                          PasswordResetView, ProductInfoView, ProductsView,
-                          ShopOrders, ShopsView, StateChange, UserView)
+from orders.views import (CatalogExportView, CategoriesView,
+                          CategoryBestOffersView, CartView,
+                          ConfirmAccountView, ContactView, FacetsView,
+                          FeedView, LoadInfo, LoadInfoStatus, LoginView,
+                          OrderView, OrdersView, RegisterView,
+                          PasswordConfirmView, PasswordResetView,
+                          ProductBestOfferView, ProductInfoView,
+                          ProductSearchView, ProductsView, ShopOrders,
+                          ShopsView, StateChange, UserView)
 
 shops_list = ShopsView.as_view({'get': 'list'})
 categories_list = CategoriesView.as_view({'get': 'list'})
@@ -13,7 +17,10 @@ categories_list = CategoriesView.as_view({'get': 'list'})
 app_name = 'orders'
 urlpatterns = [
     path('partner/loadinfo', LoadInfo.as_view(), name='partner-update'),
+    path('partner/loadinfo/<int:job_id>', LoadInfoStatus.as_view(),
+         name='partner-update-status'),
     path('partner/state', StateChange.as_view(), name='partner-state'),
+    path('partner/feed', FeedView.as_view(), name='partner-feed'),
     path('partner/orders', ShopOrders.as_view(), name='partner-orders'),
     path('user/register', RegisterView.as_view(), name='user-register'),
     path('user/register/confirm', ConfirmAccountView.as_view(),
@@ -26,8 +33,18 @@ urlpatterns = [
     path('user/password_reset/confirm', PasswordConfirmView.as_view(),
          name='password-reset-confirm'),
     path('categories', categories_list, name='categories'),
+    path('categories/<int:category_id>/facets', FacetsView.as_view(),
+         name='category-facets'),
+    path('categories/<int:category_id>/best_offers',
+         CategoryBestOffersView.as_view(), name='category-best-offers'),
     path('shops', shops_list, name='shops'),
     path('products', ProductsView.as_view(), name='products'),
+    path('products/export', CatalogExportView.as_view(),
+         name='products-export'),
+    path('products/search', ProductSearchView.as_view(),
+         name='products-search'),
+    path('products/<int:product_id>/best_offer',
+         ProductBestOfferView.as_view(), name='product-best-offer'),
     path('product_info/<int:product_id>/', ProductInfoView.as_view(),
          name='product_info'),
     path('cart', CartView.as_view(), name='cart'),
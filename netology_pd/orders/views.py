@@ -1,44 +1,53 @@
-import ast
 from distutils.util import strtobool
 
 from rest_framework import viewsets
 from rest_framework.authtoken.models import Token
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 from rest_framework.throttling import AnonRateThrottle
 from rest_framework.views import APIView
-from yaml import load as load_yaml, Loader
 
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
 from django.db import IntegrityError, transaction
-from django.db.models import Q, F, Sum, Prefetch
-from django.http import JsonResponse, HttpResponse
-from requests import get
-
-from .models import (Category, ConfirmEmailKey, Contact, Order, OrderItem,
-                     Parameter, Product, ProductInfo, ProductParameter,
-                     Shop, STATE_CHOICES, User)
-from .serializers import (CategoriesSerializer, ContactSerializer,
-                          OrderItemSerializer, OrdersSerializer,
-                          ProductSerializer, ProductInfoSerializer,
-                          ProductsSerializer,
-                          ShopSerializer, UserSerializer)
-from .tasks import send_auth_key_task, send_email_task
-
-
-class CartException(Exception):
-    """Ошибка добавления товаров в коризну
-
-    Атрибуты:
-        product_info -- информация о продукте
-        reason -- причина возникновения ошибки
-    """
-
-    def __init__(self, product_info, reason):
-        self.product_info = product_info
-        self.reason = reason
+from django.db.models import Exists, F, OuterRef, Q, Prefetch, Subquery, Sum
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+
+from .caches import (CachedListMixin, bump_catalog, cached_response,
+                     catalog_etag)
+from .cart import (CartError, add_items, delete_items, parse_ids,
+                   parse_items, update_items)
+from .exports import EXPORT_FORMATS, export_catalog
+from .facets import (apply_facet_deltas, category_facets, facet_counts,
+                     filter_by_parameters, parameter_filters,
+                     shop_categories)
+from .fetchers import spool_upload
+from .idempotency import idempotent
+from .offers import set_shop_state
+from .pagination import KeysetPagination
+from .renderers import FastJSONRenderer
+from .search import search_products
+from .stock import StockError, cancel_order, checkout_order
+from .models import (BestOffer, CatalogOffer, Category, ConfirmEmailKey,
+                     Contact, ImportJob, IMPORT_MODE_CHOICES, Order,
+                     OrderItem, Product, ProductInfo, Shop, STATE_CHOICES,
+                     User)
+from .serializers import (BestOfferSerializer, CategoriesSerializer,
+                          ContactSerializer, ImportJobSerializer,
+                          OrderItemSerializer,
+                          OrdersSerializer, ProductSerializer,
+                          ProductInfoSerializer, ProductsSerializer,
+                          ShopFeedSerializer, ShopSerializer, UserSerializer,
+                          fast_offers, fast_orders, offer_values,
+                          order_filters, order_values)
+from .tasks import (load_info_task, queue_import_job, send_auth_key_task,
+                    send_email_task)
 
 
 class RegisterView(APIView):
@@ -235,24 +244,76 @@ class PasswordConfirmView(APIView):
                 return JsonResponse({'Status': True})
 
 
-class ShopsView(viewsets.ReadOnlyModelViewSet):
+@method_decorator(condition(etag_func=catalog_etag([('shops',)])),
+                  name='list')
+class ShopsView(CachedListMixin, viewsets.ReadOnlyModelViewSet):
     """
     Список магазинов
     """
+    cache_scopes = [('shops',)]
     queryset = Shop.objects.all()
     serializer_class = ShopSerializer
 
 
+def sparse_product_infos(products, fields, *extra):
+    """
+    Чтение только колонок и вложенных объектов, нужных для вывода fields
+    """
+    products = products.only('id', *extra, *(
+        field for field in fields
+        if field not in ProductInfoSerializer.expandable_fields))
+    if 'product_parameters' in fields:
+        products = products.prefetch_related('product_parameters')
+    return products
+
+
 class ProductsView(APIView):
     """
-    Список всех товаров без описания и привязки к магазину
+    Список товаров магазинов
+
+    Фильтры shop, category и param[<имя параметра>]=<значение>
+    передаются в строке запроса, выдача постраничная по курсору
+    в порядке (название товара, id)
     """
     throttle_classes = [AnonRateThrottle]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+    # списки строятся из .values() без вложенных сериализаторов
+    fast_serializer = True
 
     @staticmethod
     def get(request, *args, **kwargs):
-        shop = request.data.get('shop')
-        category = request.data.get('category')
+        shop = request.query_params.get('shop')
+        category = request.query_params.get('category')
+
+        scopes = []
+        if shop:
+            scopes.append(('shop', shop))
+        if category:
+            scopes.append(('category', category))
+        return cached_response(
+            request, scopes or [('products',)],
+            lambda: ProductsView.list_products(request, shop, category)
+        )
+
+    @staticmethod
+    def list_products(request, shop, category):
+        filters = parameter_filters(request.query_params)
+        fields = ProductInfoSerializer.requested_fields(request.query_params)
+
+        if ProductsView.fast_serializer:
+            # одна таблица каталога вместо соединения шести таблиц
+            offers = CatalogOffer.objects.filter(shop_state=True)
+            if shop:
+                offers = offers.filter(shop_id=shop)
+            if category:
+                offers = offers.filter(category_id=category)
+            paginator = KeysetPagination(
+                ordering=('product_name', 'product_info'))
+            page = paginator.paginate_queryset(filter_by_parameters(
+                offers, filters).values('product_name', *offer_values(fields)),
+                request)
+            return paginator.get_paginated_response(
+                fast_offers(page, fields))
 
         filter = Q(shop__state=True)
 
@@ -262,41 +323,241 @@ class ProductsView(APIView):
         if category:
             filter = filter & Q(product__category_id=category)
 
-        products = ProductInfo.objects.filter(
-            filter).select_related(
-            'shop', 'product__category').prefetch_related(
-            'product_parameters__parameter').distinct()
+        products = filter_by_parameters(ProductInfo.objects.filter(filter),
+                                        filters)
+        paginator = KeysetPagination(ordering=('product__name', 'id'))
+        # название товара нужно для курсора следующей страницы
+        products = sparse_product_infos(products.select_related(
+            'product'), fields, 'product__name')
+        page = paginator.paginate_queryset(products, request)
+        products_serializer = ProductInfoSerializer(page, many=True,
+                                                    fields=fields)
 
-        products_serializer = ProductInfoSerializer(products, many=True)
+        return paginator.get_paginated_response(products_serializer.data)
 
-        return Response(products_serializer.data)
+
+class ProductSearchView(APIView):
+    """
+    Поиск товаров по названию, модели и значениям параметров
+    """
+    throttle_classes = [AnonRateThrottle]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+    fast_serializer = True
+
+    @staticmethod
+    def get(request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return JsonResponse({'Status': False,
+                                 'Errors': 'Не указан поисковый запрос'})
+
+        fields = ProductInfoSerializer.requested_fields(request.query_params)
+        products = search_products(filter_by_parameters(
+            ProductInfo.objects.filter(shop__state=True),
+            parameter_filters(request.query_params)
+        ), query)
+        paginator = PageNumberPagination()
+
+        if ProductSearchView.fast_serializer:
+            # ранжирование по индексу, содержимое страницы - из каталога
+            page = paginator.paginate_queryset(
+                products.values_list('id', flat=True), request)
+            offers = {row['product_info']: row
+                      for row in CatalogOffer.objects.filter(
+                          pk__in=page).values(*offer_values(fields))}
+            return paginator.get_paginated_response(fast_offers(
+                (offers[pk] for pk in page if pk in offers), fields))
+
+        products = sparse_product_infos(products, fields)
+        page = paginator.paginate_queryset(products, request)
+        products_serializer = ProductInfoSerializer(page, many=True,
+                                                    fields=fields)
+
+        return paginator.get_paginated_response(products_serializer.data)
+
+
+class FacetsView(APIView):
+    """
+    Значения параметров товаров категории с числом предложений
+    """
+    throttle_classes = [AnonRateThrottle]
+
+    @staticmethod
+    def get(request, category_id, *args, **kwargs):
+        return cached_response(
+            request, [('category', category_id)],
+            lambda: Response(category_facets(category_id))
+        )
 
 
-class CategoriesView(viewsets.ReadOnlyModelViewSet):
+class CategoryBestOffersView(APIView):
+    """
+    Товары категории по возрастанию лучшей цены
+
+    Выдача постраничная по курсору в порядке (минимальная цена, id
+    товара), строки читаются из таблицы лучших предложений без
+    группировки предложений магазинов.
+    """
+    throttle_classes = [AnonRateThrottle]
+
+    @staticmethod
+    def get(request, category_id, *args, **kwargs):
+        return cached_response(
+            request, [('category', category_id)],
+            lambda: CategoryBestOffersView.list_offers(request, category_id)
+        )
+
+    @staticmethod
+    def list_offers(request, category_id):
+        paginator = KeysetPagination(ordering=('min_price', 'product_id'))
+        page = paginator.paginate_queryset(
+            BestOffer.objects.filter(category_id=category_id), request)
+        return paginator.get_paginated_response(
+            BestOfferSerializer(page, many=True).data)
+
+
+class ProductBestOfferView(APIView):
+    """
+    Лучшее предложение товара: минимальная цена, число магазинов
+    с товаром в наличии и самый дешевый магазин
+    """
+    throttle_classes = [AnonRateThrottle]
+
+    @staticmethod
+    def get(request, product_id, *args, **kwargs):
+        scopes = product_scopes(request, product_id)
+        if scopes is None:
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Товара с указанным id не существует'
+            })
+        return cached_response(
+            request, scopes,
+            lambda: ProductBestOfferView.best_offer(product_id)
+        )
+
+    @staticmethod
+    def best_offer(product_id):
+        try:
+            offer = BestOffer.objects.get(product_id=product_id)
+        except BestOffer.DoesNotExist:
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Товара нет в наличии'
+            })
+        return Response(BestOfferSerializer(offer).data)
+
+
+class CatalogExportView(APIView):
+    """
+    Потоковая выгрузка всех предложений каталога
+
+    Параметры строки запроса: export_format (ndjson или csv), gzip,
+    shop и category. Ответ отдается по мере чтения строк из базы,
+    поэтому память сервера не зависит от размера каталога.
+    """
+
+    @staticmethod
+    def get(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False,
+                                 'Error': 'Для выгрузки каталога '
+                                          'необходима авторизация'},
+                                status=403)
+
+        export_format = request.query_params.get('export_format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return JsonResponse({
+                'Status': False,
+                'Errors': 'Формат выгрузки должен быть одним из: {}'.format(
+                    ', '.join(EXPORT_FORMATS))
+            })
+        try:
+            compress = strtobool(request.query_params.get('gzip', 'false'))
+        except ValueError:
+            return JsonResponse(
+                {'Status': False,
+                 'Errors': 'Переданный параметр gzip некорректен'}
+            )
+
+        content_type, extension = EXPORT_FORMATS[export_format]
+        filename = f'catalog{extension}'
+        if compress:
+            content_type = 'application/gzip'
+            filename += '.gz'
+        response = StreamingHttpResponse(
+            export_catalog(export_format, compress=compress,
+                           shop_id=request.query_params.get('shop'),
+                           category_id=request.query_params.get('category')),
+            content_type=content_type
+        )
+        response['Content-Disposition'] = f'attachment; filename={filename}'
+        return response
+
+
+@method_decorator(condition(etag_func=catalog_etag([('categories',)])),
+                  name='list')
+class CategoriesView(CachedListMixin, viewsets.ReadOnlyModelViewSet):
     """
     Список магазинов
     """
+    cache_scopes = [('categories',)]
     queryset = Category.objects.all()
     serializer_class = CategoriesSerializer
 
 
+def product_scopes(request, product_id=None, *args, **kwargs):
+    """
+    Версия карточки товара - версия его категории
+    """
+    category = Product.objects.filter(id=product_id).values_list(
+        'category_id', flat=True).first()
+    if category is None:
+        return None
+    return [('category', category)]
+
+
 class ProductInfoView(APIView):
     """
     Карточка товара с описанием и привязкой к магазинам
     """
     throttle_classes = [AnonRateThrottle]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+    fast_serializer = True
 
     @staticmethod
+    @condition(etag_func=catalog_etag(product_scopes))
     def get(request, product_id=False, *args, **kwargs):
         if not product_id:
             return JsonResponse(
                 {'Status': False,
                  'Errors': 'Необходимо передать id товара в параметрах запроса'}
             )
+        scopes = product_scopes(request, product_id)
+        if scopes is None:
+            return ProductInfoView.product_card(product_id)
+        return cached_response(
+            request, scopes,
+            lambda: ProductInfoView.product_card(product_id)
+        )
+
+    @staticmethod
+    def product_card(product_id):
+        if ProductInfoView.fast_serializer:
+            offers = list(CatalogOffer.objects.filter(
+                product_id=product_id, shop_state=True
+            ).order_by('product_info').values(
+                'product_name', 'category', *offer_values()))
+            if offers:
+                return Response({'name': offers[0]['product_name'],
+                                 'category': offers[0]['category'],
+                                 'product_infos': fast_offers(offers)})
+
         try:
             product = Product.objects.prefetch_related(Prefetch(
                 'product_infos',
-                queryset=ProductInfo.objects.filter(shop__state=True)
+                queryset=ProductInfo.objects.filter(
+                    shop__state=True).prefetch_related('product_parameters')
             )).get(id=product_id)
         except Product.DoesNotExist:
             return JsonResponse({
@@ -335,18 +596,13 @@ class CartView(APIView):
             state=STATE_CHOICES[0][0],
         )
         order_items = OrderItem.objects.filter(order=cart).select_related(
-            'product_info__product', 'product_info__shop').annotate(
-            total_sum=Sum(
-                F('quantity') * F(
-                    'product_info__price'
-                )
-            )
-        )
+            'product_info__product')
         order_items_serializer = OrderItemSerializer(order_items, many=True)
 
         return Response(order_items_serializer.data)
 
     @staticmethod
+    @idempotent
     def delete(request, *args, **kwargs):
         """
         Удаление товаров из корзины
@@ -372,28 +628,18 @@ class CartView(APIView):
                            'в теле запроса'}
             )
 
-        order_items = order_items.split(',')
         try:
-            with transaction.atomic():
-                for item in order_items:
-                    order_item = OrderItem.objects.get(id=item.strip())
-                    if order_item.order.user != request.user:
-                        return JsonResponse({
-                            'Status': False,
-                            'Error': 'Нельзя вносить изменения '
-                                     'не в свою корзину'
-                        })
-                    else:
-                        order_item.delete()
-        except OrderItem.DoesNotExist:
-            return JsonResponse({
-                'Status': False,
-                'Error': 'Информация о товаре отсутствует'
-            })
-        else:
-            return JsonResponse({'Status': True})
+            ids = parse_ids(order_items)
+        except CartError as exc:
+            return JsonResponse({'Status': False, 'Errors': str(exc)})
+        with transaction.atomic():
+            errors = delete_items(request.user, ids)
+        if errors:
+            return JsonResponse({'Status': False, 'Errors': errors})
+        return JsonResponse({'Status': True})
 
     @staticmethod
+    @idempotent
     def put(request, *args, **kwargs):
         """
         Изменение количества товаров в корзине
@@ -419,46 +665,18 @@ class CartView(APIView):
                            'в теле запроса'}
             )
         try:
-            data = ast.literal_eval(data)
-        except SyntaxError:
-            JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
-
-        try:
-            with transaction.atomic():
-                for item in data:
-                    order_item = OrderItem.objects.get(id=item['id'])
-                    if order_item.product_info.quantity < item['quantity']:
-                        raise CartException(
-                            product_info=order_item.product_info,
-                            reason='quantity')
-                    elif order_item.order.user != request.user:
-                        return JsonResponse({
-                            'Status': False,
-                            'Error': 'Нельзя вносить изменения не в свою корзину'
-                        })
-                    else:
-                        order_item.quantity = item['quantity']
-                        order_item.save()
-        except CartException as exc:
-            if exc.reason == 'quantity':
-                return JsonResponse({
-                    'Status': False,
-                    'Error': 'У магазина {} недостаточное количество товара {}'
-                             ' для добавления в корзину.Всего в магазине {} '
-                             'штук, доступных для добавления '
-                             'в корзину'.format(exc.product_info.shop.name,
-                                                exc.product_info.product.name,
-                                                exc.product_info.quantity)
-                })
-        except OrderItem.DoesNotExist:
-            return JsonResponse({
-                'Status': False,
-                'Error': 'Информация о товаре отсутствует'
-            })
-
+            items = parse_items(data, 'id')
+        except CartError as exc:
+            return JsonResponse({'Status': False, 'Errors': str(exc)})
+
+        with transaction.atomic():
+            errors = update_items(request.user, items)
+        if errors:
+            return JsonResponse({'Status': False, 'Errors': errors})
         return JsonResponse({'Status': True})
 
     @staticmethod
+    @idempotent
     def post(request, *args, **kwargs):
         """
         Добавление товаров в коризну
@@ -483,68 +701,88 @@ class CartView(APIView):
                  'Errors': 'Не передан параметр с инофрмацией о товарах'
                            'в теле запроса'}
             )
-        cart, _ = Order.objects.get_or_create(
-            user=request.user,
-            state=STATE_CHOICES[0][0],
-        )
         try:
-            data = ast.literal_eval(data)
-        except SyntaxError:
-            JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
+            items = parse_items(data, 'product_info')
+        except CartError as exc:
+            return JsonResponse({'Status': False, 'Errors': str(exc)})
 
         try:
             with transaction.atomic():
-                for item in data:
-                    product_info = ProductInfo.objects.get(
-                        id=item['product_info'])
-                    if product_info.quantity < item['quantity']:
-                        raise CartException(product_info=product_info,
-                                            reason='quantity')
-                    elif not product_info.shop.state:
-                        raise CartException(product_info=product_info,
-                                            reason='state')
-                    try:
-                        OrderItem.objects.create(
-                            order=cart,
-                            product_info=product_info,
-                            quantity=item['quantity']
-                        )
-                    except IntegrityError:
-                        return JsonResponse({
-                            'Status': False,
-                            'Error': 'В корзину уже добавлен товар с '
-                                     'информацией по id {}. Если хотите '
-                                     'изменить информацию по данному id '
-                                     'используйте метод PUT'.format(
-                                        product_info.id
-                                     )
-                        })
-        except CartException as exc:
-            if exc.reason == 'quantity':
-                return JsonResponse({
-                    'Status': False,
-                    'Error': 'У магазина {} недостаточное количество товара {}'
-                             ' для добавления в корзину.Всего в магазине {} '
-                             'штук, доступных для добавления '
-                             'в корзину'.format(exc.product_info.shop.name,
-                                                exc.product_info.product.name,
-                                                exc.product_info.quantity)
-                })
-            elif exc.reason == 'state':
-                return JsonResponse({
-                    'Status': False,
-                    'Error': 'Магазин {} не принимает заказы '
-                             'в данный момент '.format(
-                                exc.product_info.shop.name
-                             )
-                })
+                cart, _ = Order.objects.get_or_create(
+                    user=request.user,
+                    state=STATE_CHOICES[0][0],
+                )
+                errors = add_items(cart, items)
+        except IntegrityError:
+            # те же товары одновременно добавлены параллельным запросом
+            return JsonResponse({
+                'Status': False,
+                'Errors': 'Товары уже добавлены в корзину, для изменения '
+                          'количества используйте метод PUT'
+            })
+        if errors:
+            return JsonResponse({'Status': False, 'Errors': errors})
         return JsonResponse({'Status': True})
 
 
+def list_orders(request, orders, fast_serializer, total_sum=None):
+    """
+    Список заказов с полями из параметров fields и expand
+
+    Заказы отбираются по параметрам state, date_from и date_to и
+    выдаются по курсору от новых к старым. Сумма заказа хранится в
+    самом заказе, пользователь, контакт и позиции заказа читаются,
+    только если они выводятся, число запросов не зависит от числа
+    заказов и позиций на странице. total_sum - выражение, которое
+    выводится вместо сохраненной суммы заказа.
+    """
+    fields = OrdersSerializer.requested_fields(request.query_params)
+    orders = orders.filter(**order_filters(request.query_params))
+    paginator = KeysetPagination(ordering=('-dt', '-id'))
+    if total_sum is not None and 'total_sum' in fields:
+        orders = orders.annotate(scoped_total_sum=total_sum)
+    else:
+        total_sum = None
+
+    if fast_serializer:
+        values = order_values(fields)
+        if total_sum is not None:
+            values = tuple(value for value in values
+                           if value != 'total_sum') + ('scoped_total_sum',)
+        if 'dt' not in values:
+            # дата заказа нужна для курсора следующей страницы
+            values += ('dt',)
+        page = paginator.paginate_queryset(orders.values(*values), request)
+        if total_sum is not None:
+            for row in page:
+                row['total_sum'] = row.pop('scoped_total_sum')
+        return paginator.get_paginated_response(fast_orders(page, fields))
+
+    for field in ('user', 'contact'):
+        if field in fields:
+            orders = orders.select_related(field)
+    if 'ordered_items' in fields:
+        # позиции с информацией о продукте и товаром одним запросом
+        orders = orders.prefetch_related(Prefetch(
+            'ordered_items',
+            queryset=OrderItem.objects.select_related(
+                'product_info__product').order_by('id')
+        ))
+    page = paginator.paginate_queryset(orders, request)
+    if total_sum is not None:
+        for order in page:
+            order.total_sum = order.scoped_total_sum
+    orders_serializer = OrdersSerializer(page, many=True, fields=fields)
+
+    return paginator.get_paginated_response(orders_serializer.data)
+
+
 class OrdersView(APIView):
     """
     Заказы
     """
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+    fast_serializer = True
 
     @staticmethod
     def get(request, *args, **kwargs):
@@ -562,18 +800,9 @@ class OrdersView(APIView):
                 'Status': False,
                 'Error': 'Заказы доступны только покупателям'
             }, status=403)
-        orders = Order.objects.select_related('contact').prefetch_related(
-            'ordered_items'
-        ).filter(user=request.user).exclude(state=STATE_CHOICES[0][0]).annotate(
-            total_sum=Sum(
-                F('ordered_items__quantity') * F(
-                    'ordered_items__product_info__price'
-                )
-            )
-        ).distinct()
-        orders_serializer = OrdersSerializer(orders, many=True)
-
-        return Response(orders_serializer.data)
+        orders = Order.objects.filter(user=request.user).exclude(
+            state=STATE_CHOICES[0][0])
+        return list_orders(request, orders, OrdersView.fast_serializer)
 
 
 class OrderView(APIView):
@@ -599,13 +828,7 @@ class OrderView(APIView):
             }, status=403)
         try:
             orders = Order.objects.select_related('contact').prefetch_related(
-                'ordered_items').annotate(
-                total_sum=Sum(
-                    F('ordered_items__quantity') * F(
-                        'ordered_items__product_info__price'
-                    )
-                )
-            ).get(
+                'ordered_items__product_info__product').get(
                 id=request.data.get('id')
             )
         except Order.DoesNotExist:
@@ -618,6 +841,7 @@ class OrderView(APIView):
         return Response(orders_serializer.data)
 
     @staticmethod
+    @idempotent
     def post(request, *args, **kwargs):
         """
         Создать заказ
@@ -641,31 +865,61 @@ class OrderView(APIView):
             )
 
         try:
-            order = Order.objects.get(
-                id=request.data.get('id'),
-                state=STATE_CHOICES[0][0],
-            )
             contact = Contact.objects.get(id=request.data.get('contact_id'))
-
+            order = checkout_order(request.data.get('id'), request.user.id,
+                                   contact.id)
         except Contact.DoesNotExist:
             return JsonResponse({
                 'Status': False,
                 'Error': 'Указанного id контакта не существует'
             })
-        except Order.DoesNotExist:
+        except (Order.DoesNotExist, ValueError):
             return JsonResponse({
                 'Status': False,
                 'Error': 'Указанный id корзины не существует'
             })
+        except StockError as exc:
+            return JsonResponse({'Status': False, 'Errors': exc.errors})
         else:
-            order.contact = contact
-            order.state = ''.join(STATE_CHOICES[1][0])
-            order.save()
             send_email_task.delay(instance_state=order.state,
                                   instance_id=order.id,
-                                  instance_e_mail=order.user.email)
+                                  instance_e_mail=request.user.email)
             return JsonResponse({'Status': True})
 
+    @staticmethod
+    @idempotent
+    def delete(request, *args, **kwargs):
+        """
+        Отменить заказ и вернуть зарезервированные товары магазинам
+        """
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False,
+                                 'Error': 'Для отмены заказа '
+                                          'необходима авторизация'},
+                                status=403)
+
+        if request.user.type != 'buyer':
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Отменить заказ доступно только покупателям'
+            }, status=403)
+
+        if 'id' not in request.data:
+            return JsonResponse(
+                {'Status': False,
+                 'Errors': 'Не указаны все необходимые аргументы'}
+            )
+
+        try:
+            cancel_order(request.data.get('id'), request.user.id)
+        except (Order.DoesNotExist, ValueError):
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Заказа с указанным id, который можно отменить, '
+                         'не существует'
+            })
+        return JsonResponse({'Status': True})
+
 
 class ContactView(APIView):
     """
@@ -799,8 +1053,37 @@ class LoadInfo(APIView):
     Обновление информации о товарах от поставщика
     """
 
+    @staticmethod
+    def get(request, *args, **kwargs):
+        """
+        Последние загрузки прайс-листов магазина
+        """
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False,
+                                 'Error': 'Для получения списка загрузок '
+                                          'необходима авторизация'},
+                                status=403)
+        if request.user.type != 'shop':
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Получать информацию о загрузках '
+                         'возможно только магазинам'
+            }, status=403)
+
+        jobs = ImportJob.objects.filter(user=request.user)[:20]
+        jobs_serializer = ImportJobSerializer(jobs, many=True)
+
+        return Response(jobs_serializer.data)
+
     @staticmethod
     def post(request, *args, **kwargs):
+        """
+        Поставить загрузку прайс-листа в очередь
+
+        Прайс-лист передается ссылкой url или файлом file
+        (YAML, JSON Lines, MessagePack или CSV, возможно сжатый gzip).
+        При workers больше единицы товары разбираются в пуле процессов
+        """
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False,
                                  'Error': 'Для обновления товаров '
@@ -814,53 +1097,84 @@ class LoadInfo(APIView):
             }, status=403)
 
         url = request.data.get('url')
-        if url:
+        upload = request.FILES.get('file')
+        mode = request.data.get('mode', IMPORT_MODE_CHOICES[0][0])
+        if mode not in dict(IMPORT_MODE_CHOICES):
+            return JsonResponse({'Status': False,
+                                 'Errors': 'Неверно указан режим загрузки'})
+        try:
+            workers = int(request.data.get('workers', 0))
+        except (TypeError, ValueError):
+            workers = -1
+        if not 0 <= workers <= settings.IMPORT_MAX_WORKERS:
+            return JsonResponse({
+                'Status': False,
+                'Errors': 'Число процессов разбора должно быть от 0 до '
+                          f'{settings.IMPORT_MAX_WORKERS}'
+            })
+        if upload:
+            feed = spool_upload(upload)
+            job = queue_import_job(request.user.id, mode=mode,
+                                   feed_file=feed.path, workers=workers)
+            if job is None:
+                feed.remove()
+        elif url:
             validate_url = URLValidator()
             try:
                 validate_url(url)
             except ValidationError as e:
                 return JsonResponse({'Status': False, 'Error': str(e)})
-            else:
-                stream = get(url).content
-                data = load_yaml(stream, Loader=Loader)
-                shop, _ = Shop.objects.get_or_create(name=data['shop'],
-                                                     user_id=request.user.id)
-                for category in data['categories']:
-                    category_object, _ = Category.objects.get_or_create(
-                        id=category['id'], name=category['name']
-                    )
-                    category_object.shops.add(shop.id)
-                    category_object.save()
-
-                for item in data['goods']:
-                    product, _ = Product.objects.get_or_create(
-                        name=item['name'],
-                        category_id=item['category'])
-
-                    product_info, _ = ProductInfo.objects.get_or_create(
-                        product_id=product.id,
-                        external_id=item['id'],
-                        model=item['model'],
-                        price=item['price'],
-                        price_rrc=item['price_rrc'],
-                        quantity=item['quantity'],
-                        shop_id=shop.id
-                    )
-                    for name, value in item['parameters'].items():
-                        parameter, _ = Parameter.objects.get_or_create(
-                            name=name
-                        )
-                        ProductParameter.objects.create(
-                            product_info_id=product_info.id,
-                            parameter_id=parameter.id,
-                            value=value
-                        )
+            job = queue_import_job(request.user.id, url, mode=mode,
+                                   workers=workers)
+        else:
+            return JsonResponse(
+                {'Status': False,
+                 'Errors': 'Не указаны все необходимые аргументы'}
+            )
 
-                return JsonResponse({'Status': True})
+        if job is None:
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Загрузка прайс-листа магазина уже выполняется'
+            })
+        return JsonResponse({'Status': True, 'Job': job.id})
 
-        return JsonResponse(
-            {'Status': False, 'Errors': 'Не указаны все необходимые аргументы'}
-        )
+
+class LoadInfoStatus(APIView):
+    """
+    Ход загрузки информации о товарах от поставщика
+    """
+
+    @staticmethod
+    def get(request, job_id, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False,
+                                 'Error': 'Для получения статуса загрузки '
+                                          'необходима авторизация'},
+                                status=403)
+        if request.user.type != 'shop':
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Получать информацию о загрузке '
+                         'возможно только магазинам'
+            }, status=403)
+
+        try:
+            job = ImportJob.objects.get(id=job_id, user=request.user)
+        except ImportJob.DoesNotExist:
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Загрузки с указанным id не существует'
+            })
+
+        job_data = ImportJobSerializer(job).data
+        if job.state == 'running' and job.task_id:
+            # до завершения транзакции счетчики есть только у celery
+            progress = load_info_task.AsyncResult(job.task_id).info
+            if isinstance(progress, dict):
+                job_data.update(progress)
+
+        return Response(job_data)
 
 
 class StateChange(APIView):
@@ -923,14 +1237,93 @@ class StateChange(APIView):
                  'Errors': 'Переданный параметр статуса некорректен'}
             )
         else:
-            shop.save()
+            with transaction.atomic():
+                previous = Shop.objects.select_for_update().filter(
+                    id=shop.id).values_list('state', flat=True).get()
+                shop.save()
+                if previous != shop.state:
+                    set_shop_state(shop.id, shop.state)
+                    # строки параметров магазина входят в счетчики
+                    # фасетов только при включенном приеме заказов
+                    sign = 1 if shop.state else -1
+                    apply_facet_deltas({
+                        key: sign * count for key, count in
+                        facet_counts(product_info__shop_id=shop.id).items()
+                    })
+                    bump_catalog(shop_ids=[shop.id],
+                                 category_ids=shop_categories(shop.id))
+            return JsonResponse({'Status': True})
+
+
+class FeedView(APIView):
+    """
+    Настройки плановой загрузки прайс-листа магазина
+    """
+
+    @staticmethod
+    def get(request, *args, **kwargs):
+        """
+        Получить настройки загрузки прайс-листа
+        """
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False,
+                                 'Error': 'Для получения настроек '
+                                          'необходима авторизация'},
+                                status=403)
+        if request.user.type != 'shop':
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Получать настройки загрузки '
+                         'возможно только магазинам'
+            }, status=403)
+
+        try:
+            shop = Shop.objects.get(user=request.user)
+        except Shop.DoesNotExist:
+            return JsonResponse({'Status': False,
+                                 'Error': 'Магазин пользователя не найден'})
+
+        return Response(ShopFeedSerializer(shop).data)
+
+    @staticmethod
+    def put(request, *args, **kwargs):
+        """
+        Изменить ссылку, интервал и режим плановой загрузки
+        """
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False,
+                                 'Error': 'Для изменения настроек '
+                                          'необходима авторизация'},
+                                status=403)
+        if request.user.type != 'shop':
+            return JsonResponse({
+                'Status': False,
+                'Error': 'Изменять настройки загрузки '
+                         'возможно только магазинам'
+            }, status=403)
+
+        try:
+            shop = Shop.objects.get(user=request.user)
+        except Shop.DoesNotExist:
+            return JsonResponse({'Status': False,
+                                 'Error': 'Магазин пользователя не найден'})
+
+        serializer = ShopFeedSerializer(shop, data=request.data,
+                                        partial=True)
+        if serializer.is_valid():
+            serializer.save()
             return JsonResponse({'Status': True})
+        else:
+            return JsonResponse({'Status': False,
+                                 'Errors': serializer.errors})
 
 
 class ShopOrders(APIView):
     """
     Заказы магазина
     """
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+    fast_serializer = True
 
     @staticmethod
     def get(request, *args, **kwargs):
@@ -949,21 +1342,19 @@ class ShopOrders(APIView):
                          'возможно только магазинам'
             }, status=403)
 
-        orders = Order.objects.select_related('contact').prefetch_related(
-            'ordered_items').exclude(
+        # EXISTS не размножает строки заказов и позволяет идти по индексу
+        # даты заказа до заполнения страницы
+        shop_items = OrderItem.objects.filter(
+            order=OuterRef('pk'), product_info__shop__user=request.user)
+        orders = Order.objects.exclude(
             state=STATE_CHOICES[0][0]
-        ).filter(
-            ordered_items__product_info__shop__user=request.user
-        ).annotate(
-            total_sum=Sum(
-                F('ordered_items__quantity') * F(
-                    'ordered_items__product_info__price'
-                )
-            )
-        ).distinct()
-        orders_serializer = OrdersSerializer(orders, many=True)
-
-        return Response(orders_serializer.data)
+        ).filter(Exists(shop_items))
+        # магазину выводится сумма только его позиций заказа
+        shop_sum = Subquery(shop_items.values('order').annotate(
+            total=Sum(F('quantity') * F('price'))
+        ).values('total'))
+        return list_orders(request, orders, ShopOrders.fast_serializer,
+                           total_sum=shop_sum)
 
 
 def empty_view(request, *args, **kwargs):